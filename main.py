@@ -10,14 +10,33 @@ logging.basicConfig(level='INFO', stream=sys.stdout)
 if os.environ.get('WADWISE_VENDOR') == '1':
     sys.path.insert(0, os.path.dirname(__file__) + '/vendor')
 
-from wadwise import db, web
+from wadwise import db, verify, web
 
 db.DB = os.environ.get('WADWISE_DB', 'data.sqlite')
 
 
 @click.command()
 @click.option('-b', '--bind', default='127.0.0.10:5000')
-def main(bind):
+@click.option(
+    '--maintain-idle',
+    type=float,
+    default=lambda: float(os.environ.get('WADWISE_MAINTAIN_IDLE', 0)),
+    help='Run database maintenance after this many idle seconds, 0 disables',
+)
+@click.option(
+    '--ledgers',
+    default=lambda: os.environ.get('WADWISE_LEDGERS'),
+    help='Directory of additional ledgers served under /l/<name>/ or selected by X-Wadwise-Ledger header,'
+    ' new ones are made by `python -m wadwise create-ledger`',
+)
+@click.option(
+    '--verify',
+    'verify_rate',
+    type=float,
+    default=lambda: float(os.environ.get('WADWISE_VERIFY', 0)),
+    help='Fraction of cache hits to recompute from SQL in background and log mismatches, 0 disables',
+)
+def main(bind, maintain_idle, ledgers, verify_rate):
     host, sep, port = bind.rpartition(':')
     if not sep:
         host, port = port, ''
@@ -25,6 +44,13 @@ def main(bind):
     port = port or '5000'
 
     web.init()
+    if ledgers:
+        os.makedirs(ledgers, exist_ok=True)
+        web.ledgers_dir = ledgers
+    if maintain_idle:
+        web.start_idle_maintenance(maintain_idle)
+    if verify_rate:
+        verify.enable(verify_rate)
     web.app.run(host=host, port=int(port))
 
 
@@ -0,0 +1,47 @@
+import json
+
+from wadwise import audit, db
+from wadwise import model as m
+
+from .test_model import dbconn, make_acc
+
+_used = dbconn
+
+
+def test_audit(dbconn):
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    ok = m.create_transaction(m.op2(a, e, 10, 'USD'), meta={'type': 'via', 'src': a, 'dest': e, 'via': a})
+    m.create_transaction([m.op(a, -10, 'USD'), m.op(a, 8, 'GBP')])
+    assert audit.audit() == []
+
+    bad = m.create_transaction([m.op(a, -10, 'USD'), m.op(e, 9.99, 'USD')])
+    lost = m.create_transaction(m.op2(a, e, 5, 'EUR'))
+    empty = m.create_transaction([])
+    db.execute_raw(
+        """\
+            INSERT INTO ops (tx_id, n, acc_id, cur_id, amount, date)
+            SELECT 999, 0, id, 1, 0, 0 FROM accounts WHERE aid = ?
+        """,
+        [a],
+    )
+    db.execute_raw(
+        """\
+            UPDATE ops SET acc_id = 999
+            WHERE tx_id = (SELECT id FROM transactions WHERE tid = ?) AND n = 1
+        """,
+        [lost],
+    )
+    db.execute_raw("INSERT INTO accounts (aid, parent, name, type) VALUES ('lost', 'gone', 'x', 'a')")
+    db.execute_raw('UPDATE transactions SET meta = ? WHERE tid = ?', [json.dumps({'src': 'other', 'dest': e}), ok])
+
+    issues = sorted(audit.audit(), key=lambda it: tuple(str(v) for v in it.values()))
+    issues = [(it['check'], it['tid'], it['aid'], it['cur'], it['amount']) for it in issues]
+    assert issues == [
+        ('bad_meta', ok, 'other', None, None),
+        ('dangling_account', lost, None, 'EUR', 5.0),
+        ('dangling_parent', None, 'lost', None, None),
+        ('empty_transaction', empty, None, None, None),
+        ('orphan_op', None, a, 'USD', 0.0),
+        ('unbalanced', bad, None, 'USD', -0.01),
+    ]
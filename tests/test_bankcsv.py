@@ -0,0 +1,116 @@
+import io
+from datetime import datetime
+
+from wadwise import bankcsv, jobs, monzo, web
+from wadwise import model as m
+
+from .test_model import dbconn, from_ts, make_acc
+
+_used = dbconn
+
+MONZO_CSV = """\
+Transaction ID,Date,Time,Type,Name,Emoji,Category,Amount,Currency
+tx_1,01/02/2024,10:20:30,Card payment,Tesco,,Groceries,-12.50,GBP
+tx_2,02/02/2024,08:00:00,Faster payment,ACME,,Income,"1,000.00",GBP
+"""
+
+
+def test_monzo_prepare():
+    data = monzo.prepare(io.StringIO(MONZO_CSV))
+    assert [(it['date'], it['amount'], it['cur'], it['key']) for it in data] == [
+        (datetime(2024, 2, 1, 10, 20, 30), -12.5, 'GBP', 'Card payment:Tesco'),
+        (datetime(2024, 2, 2, 8, 0, 0), 1000.0, 'GBP', 'Faster payment:ACME'),
+    ]
+    assert data[0]['txkey'] == m.seen_tx_key(datetime(2024, 2, 1, 10, 20, 30), -12.5, 'GBP')
+
+
+def test_debit_credit_profile():
+    profile: bankcsv.Profile = {
+        'name': 'bank',
+        'columns': {'date': 'Posted', 'debit': 'Out', 'credit': 'In', 'name': 'Payee', 'cur': 'Ccy'},
+        'date_fmt': '%Y-%m-%d',
+        'cur': 'EUR',
+        'sign': -1,
+    }
+    src = 'Posted,Payee,Out,In,Ccy\n2024-01-05,Shop,10.00,,\n2024-01-06,Boss,,50,USD\n,,,,\n'
+    data = list(bankcsv.parse(io.StringIO(src), profile))
+    assert [(it['date'], it['name'], it['amount'], it['cur']) for it in data] == [
+        (datetime(2024, 1, 5), 'Shop', 10.0, 'EUR'),
+        (datetime(2024, 1, 6), 'Boss', -50.0, 'USD'),
+    ]
+
+
+def test_chunked():
+    assert list(bankcsv.chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(bankcsv.chunked([], 2)) == []
+
+
+def test_mark_known(dbconn):
+    a = make_acc('a:bank')
+    e = make_acc('e:food')
+    m.create_transaction(m.op2(e, a, 10, 'GBP'), from_ts(100))
+    m.update_seen_transactions(a, from_ts(200), [m.seen_tx_key(from_ts(200), 20, 'GBP')])
+
+    rows = [
+        {'txkey': m.seen_tx_key(from_ts(ts), amount, 'GBP'), 'state': None}
+        for ts, amount in ((100, 10), (200, 20), (300, 30))
+    ]
+    result = list(bankcsv.mark_known(rows, a, [a], size=2))  # type: ignore[arg-type]
+    assert [it['state'] for it in result] == ['imported', 'seen', None]
+
+
+def test_profiles(dbconn):
+    assert list(bankcsv.get_profiles()) == ['monzo']
+    profile = dict(bankcsv.MONZO, name='other')
+    bankcsv.set_profiles([profile])  # type: ignore[list-item]
+    assert bankcsv.get_profiles()['other'] == profile
+
+
+def test_suggest_dest(dbconn):
+    bank = make_acc('a:bank')
+    food = make_acc('e:food')
+    fun = make_acc('e:fun')
+    salary = make_acc('i:salary')
+    m.create_transaction(m.op2(bank, food, 10, 'GBP'), from_ts(10), 'TESCO 123')
+    m.create_transaction(m.op2(bank, fun, 10, 'GBP'), from_ts(20), 'Tesco')
+    m.create_transaction(m.op2(bank, food, 10, 'GBP'), from_ts(30), 'tesco  ')
+    m.rebuild_payee_index()
+
+    assert m.payee_suggestions(bank, ['n:tesco']) == {'n:tesco': [(food, 2), (fun, 1)]}
+    assert m.payee_suggestions(food, ['n:tesco']) == {'n:tesco': [(bank, 2)]}
+
+    data = monzo.prepare(io.StringIO(MONZO_CSV))
+    bankcsv.suggest_dest(data, bank)
+    assert data[0]['dest'] == food
+    assert 'dest' not in data[1]
+
+    rows = [dict(it, date=it['date'].timestamp(), dest=salary, desc=None) for it in data[1:]]
+    monzo.import_data(bank, rows)
+    data = monzo.prepare(io.StringIO(MONZO_CSV.replace('ACME', 'Other')))
+    bankcsv.suggest_dest(data, bank)
+    assert data[1]['dest'] == salary
+
+    # Terms learned from imports survive maintenance
+    terms = ['n:acme', 'c:income']
+    learned = m.payee_suggestions(bank, terms)
+    assert learned.keys() == set(terms)
+    web.maintain_job(jobs.Job('maintain'))
+    assert m.payee_suggestions(bank, terms) == learned
+
+
+def test_payee_index_follows_edits(dbconn):
+    bank = make_acc('a:bank')
+    food = make_acc('e:food')
+    fun = make_acc('e:fun')
+    term = m.payee_terms('Tesco Store 999')
+    assert m.payee_suggestions(bank, term) == {}
+
+    tid = m.create_transaction(m.op2(bank, food, 10, 'GBP'), from_ts(10), 'Tesco Store 123')
+    assert m.payee_suggestions(bank, term) == {'n:tesco store': [(food, 1)]}
+
+    m.update_transaction(tid, m.op2(bank, fun, 10, 'GBP'), from_ts(10), 'Tesco Store 123')
+    assert m.payee_suggestions(bank, term) == {'n:tesco store': [(fun, 1)]}
+
+    m.delete_transaction(tid)
+    assert m.payee_suggestions(bank, term) == {}
+    assert m.payee_suggestions(fun, term) == {}
@@ -0,0 +1,50 @@
+import io
+import json
+
+from wadwise import export
+from wadwise import model as m
+
+DATA = [
+    m.ExportTransaction('t1', 43200, 'pay', [('i', -100.0, 'USD'), ('a', 100.0, 'USD')]),
+    m.ExportTransaction('t2', 129600, None, [('a', -1.5, 'USD'), ('e', 1.5, 'USD')]),
+]
+NAMES = {'i': 'Income:Salary', 'a': 'Assets:Cash', 'e': 'Expenses'}
+
+
+def run(fmt):
+    out = io.StringIO()
+    assert export.writers[fmt](out, iter(DATA), NAMES) == 2
+    return out.getvalue()
+
+
+def test_csv():
+    lines = run('csv').splitlines()
+    assert lines[0] == 'tid,date,desc,account,amount,cur'
+    assert lines[1] == f't1,{export.fmt_date(43200)},pay,Income:Salary,-100.00,USD'
+    assert lines[4] == f't2,{export.fmt_date(129600)},,Expenses,1.50,USD'
+
+
+def test_jsonl():
+    lines = run('jsonl').splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[1]) == {
+        'tid': 't2',
+        'date': export.fmt_date(129600),
+        'desc': None,
+        'ops': [
+            {'account': 'Assets:Cash', 'amount': -1.5, 'cur': 'USD'},
+            {'account': 'Expenses', 'amount': 1.5, 'cur': 'USD'},
+        ],
+    }
+
+
+def test_ledger():
+    assert run('ledger') == (
+        '1970/01/01 pay\n'
+        '    Income:Salary  -100.00 USD\n'
+        '    Assets:Cash  100.00 USD\n'
+        '\n'
+        '1970/01/02\n'
+        '    Assets:Cash  -1.50 USD\n'
+        '    Expenses  1.50 USD\n'
+    )
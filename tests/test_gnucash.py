@@ -0,0 +1,53 @@
+import datetime
+
+from wadwise import gnucash
+from wadwise import model as m
+
+from .test_model import dbconn, make_acc
+
+_used = dbconn
+
+
+def test_guid():
+    value = '0123456789abcdef0123456789abcdef'
+    assert gnucash.guid(gnucash.b64id(value)) == value
+    assert len(gnucash.guid('a')) == 32
+    assert gnucash.guid(m.gen_id()) != gnucash.guid(m.gen_id())
+
+
+def test_split_values():
+    ops = [('a', -10000, 'USD'), ('b', 9000, 'EUR')]
+    assert list(gnucash.split_values('USD', ops)) == [-10000, 10000]
+    ops = [('a', -100, 'USD'), ('b', 100, 'USD')]
+    assert list(gnucash.split_values('USD', ops)) == [-100, 100]
+    ops = [('a', -10000, 'USD'), ('b', 3000, 'EUR'), ('c', 3000, 'EUR'), ('d', 3000, 'EUR')]
+    assert list(gnucash.split_values('USD', ops)) == [-10000, 3333, 3333, 3334]
+
+    # Balanced transaction currency ops, foreign splits are valued by their own rate
+    ops = [('a', -500, 'USD'), ('b', 500, 'USD'), ('c', -1000, 'EUR'), ('d', 1000, 'EUR')]
+    assert list(gnucash.split_values('USD', ops, lambda cur: 1.1)) == [-500, 500, -1100, 1100]
+    assert list(gnucash.split_values('USD', ops)) == [-500, 500, -1000, 1000]
+
+
+def test_export_import_roundtrip(dbconn, tmp_path):
+    a = make_acc('a:cash')
+    b = make_acc('a:bank')
+    e = make_acc('e:food')
+    dt = datetime.datetime(2024, 1, 1, 10)
+    m.create_transaction(m.op2(a, e, 10.5, 'USD'), dt, 'lunch')
+    m.create_transaction(m.op2(b, e, 3, 'EUR'), dt)
+    m.create_transaction(m.op2(a, e, 1, 'USD'), dt)
+    m.create_transaction([m.op(a, -100, 'USD'), m.op(b, 90, 'EUR')], dt, 'exchange')
+
+    def named_balance():
+        amap = m.account_list()
+        return {amap[aid].full_name: state for aid, state in m.balance().items()}
+
+    expected = named_balance()
+
+    fname = str(tmp_path / 'book.gnucash')
+    gnucash.export_data(fname)
+    gnucash.import_data(fname)
+
+    assert named_balance() == expected
+    assert sorted(it['desc'] or '' for it in m.account_transactions()) == ['', '', 'exchange', 'lunch']
@@ -0,0 +1,57 @@
+import threading
+
+from wadwise import jobs, monzo
+from wadwise import model as m
+
+from .test_model import dbconn, make_acc
+
+_used = dbconn
+
+
+def test_job_success():
+    event = threading.Event()
+
+    def work(job, total):
+        event.wait(5)
+        for it in range(total):
+            job.progress(it + 1, total)
+        job.row_error(1, 'boo')
+
+    job = jobs.submit('test', work, 3)
+    assert jobs.get(job.id) is job
+    assert job.state()['status'] in ('pending', 'running')
+    event.set()
+    assert job.wait(5)
+    assert job.state() == {
+        'id': job.id,
+        'name': 'test',
+        'status': 'done',
+        'total': 3,
+        'done': 3,
+        'errors': [{'row': 1, 'error': 'boo'}],
+        'error': None,
+    }
+
+
+def test_job_failure():
+    def work(job):
+        raise RuntimeError('boom')
+
+    job = jobs.submit('test', work)
+    assert job.wait(5)
+    assert job.status == 'failed'
+    assert job.error == 'boom'
+
+
+def test_monzo_import_job(dbconn):
+    a = make_acc('a:bank')
+    e = make_acc('e:food')
+    row = {'date': 100, 'amount': -10, 'cur': 'GBP', 'name': 'Shop', 'desc': None, 'state': None, 'txkey': ''}
+    data = [dict(row, dest=e), dict(row, dest='missing'), dict(row, dest=e, amount=-5)]
+
+    job = jobs.submit('import', lambda job: monzo.import_data(a, data, job))
+    assert job.wait(5)
+    assert job.status == 'done'
+    assert (job.done, job.total) == (2, 2)
+    assert job.errors == [{'row': 1, 'error': 'missing not found'}]
+    assert m.balance()[e]['GBP'].sum == 15
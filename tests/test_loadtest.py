@@ -0,0 +1,26 @@
+import pytest
+
+from wadwise import db, loadtest
+
+
+def test_percentile():
+    values = [float(it) for it in range(1, 101)]
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([1.0], 95) == 1
+    assert loadtest.percentile([], 95) == 0
+
+
+def test_parse_mix():
+    assert loadtest.parse_mix('balance=3, import') == {'balance': 3, 'import': 1}
+    with pytest.raises(ValueError):
+        loadtest.parse_mix('boo=1')
+
+
+def test_run_local():
+    prev = db.DB
+    result = loadtest.run_local(2, 0.3, {'balance': 1, 'transaction_save': 1}, transactions=100)
+    assert db.DB == prev
+    assert result['requests'] == sum(it['count'] for it in result['actions'].values())
+    assert result['busy'] == 0
+    assert all(it['errors'] == 0 for it in result['actions'].values())
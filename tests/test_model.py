@@ -1,8 +1,10 @@
 import datetime
+import os
+import threading
 
 import pytest
 
-from wadwise import db, state
+from wadwise import audit, db, state
 from wadwise import model as m
 
 
@@ -16,7 +18,7 @@ def make_acc(name, type=None):
 @pytest.fixture
 def dbconn(mocker):
     mocker.patch('wadwise.db.DB', '/tmp/wadwise-test.sqlite')
-    db._get_connection.cache_clear()
+    db.close_connections()
     m.drop_tables()
     m.create_tables()
     with m.transaction():
@@ -53,6 +55,34 @@ def test_account_flow(dbconn):
     assert m.account_list()
 
 
+def test_account_list(dbconn):
+    food = make_acc('e:food')
+    cafe = make_acc('e:food:cafe')
+    tea = make_acc('e:food:cafe:tea')
+    bar = make_acc('e:food:bar')
+    m.set_joint_accounts([{'parent': food, 'clear': cafe, 'joints': [cafe], 'assets': []}])
+
+    e = m.account_by_name('e')['aid']
+    amap = m.account_list()
+    assert [amap[it].name for it in amap.top] == ['a', 'e', 'i', 'l', 'q']
+    assert amap[tea].to_json() == {
+        'aid': tea,
+        'type': 'e',
+        'name': 'tea',
+        'desc': None,
+        'parent': cafe,
+        'is_placeholder': 0,
+        'is_hidden': None,
+        'is_sheet': False,
+        'parents': (e, food, cafe),
+        'children': (),
+        'full_name': 'e:food:cafe:tea',
+    }
+    assert amap[food].children == (bar, cafe)
+    assert amap[amap.top[0]].is_sheet
+    assert amap[food + '.joint'].to_json() == {'name': 'food (joint)', 'full_name': 'e:food (joint)'}
+
+
 def test_delete_account(dbconn):
     a1 = make_acc('a:bank')
     a2 = make_acc('a:bank:main')
@@ -90,7 +120,7 @@ def test_transaction_flow(dbconn):
     assert result == {}
 
     # make shure transaction cleans up ops
-    ops = db.select('ops', '*', tid=tid)
+    ops = db.select('ops', '*')
     assert not ops
 
 
@@ -209,3 +239,593 @@ def test_seen_transactions(dbconn):
 def test_seen_tx_key():
     assert m.seen_tx_key(from_ts(100), 1 / 3, 'GBP') == '100-0.33-GBP'
     assert m.seen_tx_key(from_ts(100), 1000000.0, 'GBP') == '100-1000000.00-GBP'
+
+
+def test_seen_transactions_keys(dbconn):
+    m.update_seen_transactions('acc', from_ts(100), ('boo', 'foo'))
+    m.update_seen_transactions('acc', from_ts(200), ('boo', 'bar'))
+    assert m.seen_transactions('acc', keys=['boo', 'zoo']) == {'boo'}
+    assert m.seen_transactions('acc', keys=[]) == set()
+    assert db.select('seen_transactions', 'date', key='boo') == [{'date': 100}]
+
+
+def test_imported_transactions(dbconn):
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    tid = m.create_transaction(m.op2(e, a, 10.5, 'GBP'), from_ts(100))
+
+    key = m.seen_tx_key(from_ts(100), 10.5, 'GBP')
+    assert m.imported_transactions([a], [key, 'boo']) == {key}
+    assert m.imported_transactions([e], [key]) == set()
+
+    m.update_transaction(tid, m.op2(e, a, 20, 'GBP'), from_ts(100), None)
+    assert m.imported_transactions([a], [key]) == set()
+    assert m.imported_transactions([a], [m.seen_tx_key(from_ts(100), 20, 'GBP')])
+
+
+def test_period_balance(dbconn):
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    m.create_transaction(m.op2(a, e, 10, 'USD'), datetime.datetime(2024, 1, 31, 23))
+    m.create_transaction(m.op2(a, e, 20, 'USD'), datetime.datetime(2024, 2, 1))
+    m.create_transaction(m.op2(a, e, 30, 'USD'), datetime.datetime(2024, 4, 1))
+
+    result = m.period_balance('month')
+    assert list(result) == ['2024-01', '2024-02', '2024-04']
+    assert result['2024-02'] == {a: {'USD': amnt(-20)}, e: {'USD': amnt(20)}}
+
+    result = m.period_balance('quarter', end=datetime.datetime(2024, 4, 1).timestamp())
+    assert result == {'2024-Q1': {a: {'USD': amnt(-30)}, e: {'USD': amnt(30)}}}
+
+    assert list(m.period_balance('week')) == ['2024-01-29', '2024-04-01']
+
+
+def test_report(dbconn):
+    from wadwise import report
+
+    state.accounts_changed()
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    e2 = make_acc('e:food:cafe')
+    root_e = m.account_by_name('e')['aid']
+    m.create_transaction(m.op2(a, e, 10, 'USD'), datetime.datetime(2024, 1, 10))
+    m.create_transaction(m.op2(a, e2, 5, 'GBP'), datetime.datetime(2024, 2, 10))
+
+    result = report.report('month', aid=root_e)
+    assert result == {
+        'by': 'month',
+        'periods': ['2024-01', '2024-02'],
+        'accounts': {
+            root_e: [{'USD': 10}, {'GBP': 5}],
+            e: [{'USD': 10}, {'GBP': 5}],
+            e2: [{}, {'GBP': 5}],
+        },
+    }
+
+
+def test_running_balance(dbconn):
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    i = make_acc('i:salary')
+    m.create_transaction(m.op2(i, a, 100, 'USD'), from_ts(10))
+    m.create_transaction(m.op2(a, e, 30, 'USD'), from_ts(20))
+    m.create_transaction(m.op2(i, a, 5, 'GBP'), from_ts(25))
+    m.create_transaction(m.op2(a, e, 20, 'USD'), from_ts(30))
+
+    result = m.account_transactions(aid=a, running=True)
+    assert [it['balance'] for it in result] == [{'USD': 50}, {'GBP': 5}, {'USD': 70}, {'USD': 100}]
+
+    result = m.account_transactions(aid=a, running=True, limit=2, offset=1)
+    assert [it['balance'] for it in result] == [{'GBP': 5}, {'USD': 70}]
+
+    result = m.account_transactions(aid=a, running=True, start_date=from_ts(20), end_date=from_ts(30))
+    assert [it['balance'] for it in result] == [{'GBP': 5}, {'USD': 70}]
+
+    result = m.account_transactions(aid=e, running=True, start_date=from_ts(30))
+    assert [it['balance'] for it in result] == [{'USD': 50}]
+
+    assert 'balance' not in m.account_transactions(aid=a)[0]
+
+
+def test_iter_transactions(dbconn):
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    i = make_acc('i:salary')
+    t1 = m.create_transaction(m.op2(i, a, 100, 'USD'), from_ts(10), 'pay')
+    t2 = m.create_transaction(m.op2(a, e, 30, 'USD'), from_ts(20))
+
+    result = list(m.iter_transactions())
+    assert [it.tid for it in result] == [t1, t2]
+    assert result[0] == (t1, 10, 'pay', [(i, -100, 'USD'), (a, 100, 'USD')])
+
+    assert [it.tid for it in m.iter_transactions(start=15)] == [t2]
+    assert [it.tid for it in m.iter_transactions(aids=[i])] == [t1]
+    assert list(m.iter_transactions(aids=[])) == []
+
+
+def test_close_year(dbconn):
+    import os
+
+    if os.path.exists(db.archive_name()):
+        os.remove(db.archive_name())
+
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    i = make_acc('i:salary')
+    m.create_transaction(m.op2(i, a, 100, 'USD'), datetime.datetime(2023, 3, 1))
+    m.create_transaction(m.op2(a, e, 30, 'USD'), datetime.datetime(2023, 5, 1))
+    m.create_transaction(m.op2(a, e, 5, 'GBP'), datetime.datetime(2023, 6, 1))
+    m.create_transaction(m.op2(a, e, 20, 'USD'), datetime.datetime(2024, 2, 1))
+    assert m.account_transactions(aid=a, archived=True) == []
+
+    def totals():
+        return {aid: {cur: v.sum for cur, v in st.items()} for aid, st in m.balance().items()}
+
+    expected = totals()
+    assert m.close_year(2023) == 3
+    # Income and expenses are closed into equity
+    retained = m.account_by_name('q:Retained earnings')['aid']
+    assert totals() == {a: expected[a], e: {'USD': 20}, retained: {'USD': -70, 'GBP': 5}}
+    december = m.balance(datetime.datetime(2023, 12, 1).timestamp(), datetime.datetime(2024, 1, 1).timestamp())
+    assert december.keys() == {a, retained}
+
+    result = m.account_transactions(aid=a)
+    assert [(it['date'], it['desc']) for it in result] == [
+        (datetime.datetime(2024, 2, 1), None),
+        (datetime.datetime(2023, 12, 31, 23, 59, 59), 'Opening balance 2024'),
+        (datetime.datetime(2023, 12, 31, 23, 59, 59), 'Opening balance 2024'),
+    ]
+    assert m.balance(start=datetime.datetime(2024, 1, 1).timestamp()) == {a: {'USD': amnt(-20)}, e: {'USD': amnt(20)}}
+
+    archived = m.account_transactions(aid=a, archived=True, running=True)
+    assert [it['balance'] for it in archived] == [{'GBP': -5}, {'USD': 70}, {'USD': 100}]
+
+
+def test_close_year_twice(dbconn):
+    import os
+
+    if os.path.exists(db.archive_name()):
+        os.remove(db.archive_name())
+
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    # Closed transactions get the highest ids, they must not be reused
+    m.create_transaction(m.op2(a, e, 20, 'USD'), datetime.datetime(2024, 2, 1), 'dinner')
+    m.create_transaction(m.op2(a, e, 10, 'GBP'), datetime.datetime(2023, 5, 1), 'lunch')
+    m.create_transaction(m.op2(a, e, 3, 'USD'), datetime.datetime(2022, 5, 1), 'tea')
+
+    m.close_year(2022)
+    m.close_year(2023)
+
+    ids = db.execute_raw('SELECT id FROM archive.transactions').fetchall()
+    assert len(ids) == len(set(ids))
+    archived = {it['desc']: it['ops'] for it in m.account_transactions(archived=True)}
+    assert archived['tea'] == [(a, -3.0, 'USD', 1), (e, 3.0, 'USD', 1)]
+    assert archived['lunch'] == [(a, -10.0, 'GBP', 1), (e, 10.0, 'GBP', 1)]
+    assert [it['desc'] for it in m.account_transactions()] == ['dinner'] + ['Opening balance 2024'] * 2
+
+
+def test_close_year_exchange(dbconn):
+    if os.path.exists(db.archive_name()):
+        os.remove(db.archive_name())
+
+    a = make_acc('a:cash')
+    b = make_acc('a:card')
+    m.create_transaction(m.op2(b, a, 100, 'USD'), datetime.datetime(2023, 3, 1))
+    m.create_transaction([m.op(a, -50, 'USD'), m.op(a, 45, 'EUR')], datetime.datetime(2023, 5, 1))
+
+    def totals():
+        return {aid: {cur: v.sum for cur, v in st.items()} for aid, st in m.balance().items()}
+
+    expected = totals()
+    m.close_year(2023)
+
+    assert audit.audit() == []
+    retained = m.account_by_name('q:Retained earnings')['aid']
+    assert totals() == {**expected, retained: {'USD': 50, 'EUR': -45}}
+
+
+def test_migrate_lost_ops(tmp_path, caplog):
+    with db.use(str(tmp_path / 'old.sqlite')):
+        for q in (
+            'CREATE TABLE accounts (aid, type, name, desc, parent, is_placeholder DEFAULT 0, is_hidden)',
+            'CREATE TABLE transactions (tid, date, desc, meta)',
+            'CREATE TABLE ops (tid, aid, amount, cur, is_main)',
+            'CREATE TABLE params (name PRIMARY KEY, value)',
+            'CREATE TABLE seen_transactions (aid, key, date)',
+            "INSERT INTO accounts (aid, type, name) VALUES ('a', 'a', 'Assets'), ('e', 'e', 'Expenses')",
+            "INSERT INTO transactions VALUES ('t1', 10, NULL, NULL)",
+            "INSERT INTO ops VALUES ('t1', 'a', -100, 'USD', 1), ('t1', 'e', 100, 'USD', 1)",
+            "INSERT INTO ops VALUES ('t1', 'gone', 5, 'USD', 1), ('t2', 'a', 7, 'USD', 1)",
+        ):
+            db.execute_raw(q)
+        # Last released schema
+        db.set_version(5)
+
+        m.create_tables()
+        assert m.balance() == {'a': {'USD': amnt(-1)}, 'e': {'USD': amnt(1)}}
+        lost = db.execute_raw('SELECT tid, aid, amount FROM ops_lost ORDER BY tid').fetchall()
+        assert lost == [('t1', 'gone', 5), ('t2', 'a', 7)]
+        assert '2 ops refer to missing' in caplog.text
+
+
+def test_backup(dbconn, mocker, tmp_path):
+    import gzip
+    import sqlite3
+    from unittest import mock
+
+    mocker.patch('wadwise.db.zstandard', None)
+    mocker.patch('wadwise.db.backup_dir', lambda: str(tmp_path))
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    m.create_transaction(m.op2(a, e, 100, 'USD'))
+
+    calls = []
+    fname = db.backup(progress=lambda *args: calls.append(args), pages=1, sleep=0)
+    assert fname.endswith('.sqlite.gz')
+    assert calls and calls[-1][1] == 0
+
+    restored = tmp_path / 'restored.sqlite'
+    with gzip.open(fname) as f:
+        restored.write_bytes(f.read())
+    conn = sqlite3.connect(restored)
+    assert conn.execute('select count(*) from ops').fetchone() == (2,)
+    conn.close()
+
+    # Backups within one second get their own files
+    assert db.backup() != db.backup()
+
+    # Failures are reported as they are and leave no temporary copy
+    with mock.patch('wadwise.db._compress', side_effect=OSError('disk full')), pytest.raises(OSError, match='disk'):
+        db.backup()
+    error = sqlite3.OperationalError('unable to open')
+    with mock.patch('sqlite3.connect', side_effect=error), pytest.raises(sqlite3.OperationalError, match='unable'):
+        db.backup()
+    assert not any(it.name.startswith('.') for it in tmp_path.iterdir())
+
+    for i in range(3):
+        (tmp_path / f'{db.BACKUP_PREFIX}0000010{i}-000000.sqlite.gz').write_bytes(b'')
+    latest = db.backup(keep=2)
+    names = db.backup_list()
+    assert len(names) == 2
+    assert names[0] == os.path.basename(latest)
+    assert f'{db.BACKUP_PREFIX}00000100-000000.sqlite.gz' not in names
+
+
+def test_maintain(dbconn):
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    with m.transaction():
+        tids = [m.create_transaction(m.op2(a, e, i, 'USD'), desc='x' * 1000) for i in range(200)]
+        for tid in tids:
+            m.delete_transaction(tid)
+
+    result = db.maintain(vacuum=True)
+    assert set(result['steps']) == {'analyze', 'optimize', 'vacuum', 'wal_checkpoint'}
+    assert result['after']['free_pages'] == 0
+    assert result['after']['wal'] == 0
+    assert db.execute_raw('pragma auto_vacuum').fetchone() == (2,)
+
+    result = db.maintain()
+    assert 'incremental_vacuum' in result['steps']
+
+
+def test_ops_date(dbconn):
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    tid = m.create_transaction(m.op2(a, e, 10, 'USD'), datetime.datetime(2024, 1, 5))
+    m.update_transaction(tid, m.op2(a, e, 10, 'USD'), datetime.datetime(2024, 2, 5), None)
+    ts = datetime.datetime(2024, 2, 5).timestamp()
+    assert db.execute_raw('SELECT DISTINCT date FROM ops').fetchall() == [(ts,)]
+
+    plan = db.execute_raw(
+        """\
+            EXPLAIN QUERY PLAN
+            SELECT acc_id, cur_id, sum(amount) FROM ops WHERE date >= ? AND date < ? GROUP BY acc_id, cur_id
+        """,
+        [ts - 1, ts + 1],
+    )
+    assert 'COVERING INDEX idx_ops_date' in str(plan.fetchall())
+    assert m.balance(ts - 1, ts + 1) == {a: {'USD': m.Amount2(-10)}, e: {'USD': m.Amount2(0, 10)}}
+
+
+def test_multi_balance(dbconn):
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    i = make_acc('i:salary')
+    m.create_transaction(m.op2(i, a, 100, 'USD'), datetime.datetime(2024, 1, 5))
+    m.create_transaction(m.op2(a, e, 10, 'USD'), datetime.datetime(2024, 2, 5))
+    m.create_transaction(m.op2(a, e, 5, 'EUR'), datetime.datetime(2024, 3, 5))
+
+    feb = datetime.datetime(2024, 2, 1).timestamp()
+    mar = datetime.datetime(2024, 3, 1).timestamp()
+    ranges = {'current': (None, mar), 'prev': (None, feb), 'month': (feb, mar), 'all': (None, None)}
+    result = m.multi_balance(ranges)
+    assert result == {name: m.balance(start, end) for name, (start, end) in ranges.items()}
+    assert result['month'] == {a: {'USD': m.Amount2(-10)}, e: {'USD': m.Amount2(0, 10)}}
+
+    state.accounts_changed()
+    env = state.Env(datetime.date(2024, 2, 10))
+    assert env.current[a].total == {'USD': 90}
+    assert env.prev[a].total == {'USD': 100}
+    assert env.month[e].total == {'USD': 10}
+
+
+def test_account_closure(dbconn):
+    def closure():
+        return sorted(db.execute_raw('SELECT * FROM account_closure').fetchall())
+
+    e = m.account_by_name('e')['aid']
+    food = make_acc('e:food')
+    cafe = make_acc('e:food:cafe')
+    tea = make_acc('e:food:cafe:tea')
+    home = make_acc('e:home')
+    assert m.account_subtree(food) == [food, cafe, tea]
+
+    acc = m.account_by_id(cafe)
+    m.update_account(cafe, home, acc['name'], acc['type'], acc['desc'], False, None)
+    assert m.account_subtree(home) == [home, cafe, tea]
+    assert m.account_subtree(food) == [food]
+
+    m.delete_account(home, e)
+    assert set(m.account_subtree(e)) == {e, food, cafe, tea}
+    q = """\
+        SELECT depth FROM account_closure
+        WHERE ancestor = (SELECT id FROM accounts WHERE aid = ?)
+              AND descendant = (SELECT id FROM accounts WHERE aid = ?)
+    """
+    assert db.execute_raw(q, [e, tea]).fetchone() == (2,)
+
+    actual = closure()
+    m.rebuild_account_closure()
+    assert actual == closure()
+
+
+def test_subtree_transactions(dbconn):
+    a = make_acc('a:cash')
+    food = make_acc('e:food')
+    cafe = make_acc('e:food:cafe')
+    m.create_transaction(m.op2(a, food, 10, 'USD'), datetime.datetime(2024, 1, 1))
+    m.create_transaction(m.op2(a, cafe, 5, 'USD'), datetime.datetime(2024, 1, 2))
+    m.create_transaction(m.op2(food, cafe, 1, 'USD'), datetime.datetime(2024, 1, 3))
+
+    assert len(m.account_transactions(aid=food)) == 2
+    result = m.account_transactions(aid=food, subtree=True, running=True)
+    assert [(it['split'], it.get('amount'), it['balance']) for it in result] == [
+        (True, None, {'USD': 15.0}),
+        (False, 5.0, {'USD': 15.0}),
+        (False, 10.0, {'USD': 10.0}),
+    ]
+
+    assert m.subtree_balance(aid=food) == {food: {'USD': m.Amount2(-1, 16)}}
+    assert m.subtree_balance()[m.account_by_name('e')['aid']] == {'USD': m.Amount2(-1, 16)}
+
+
+def test_transactions_cache(dbconn):
+    state.accounts_changed()
+    a = make_acc('a:cash')
+    b = make_acc('a:card')
+    food = make_acc('e:food')
+    e = m.account_by_name('e')['aid']
+    tid = m.create_transaction(m.op2(a, food, 10, 'USD'), datetime.datetime(2024, 1, 1))
+    m.create_transaction(m.op2(b, food, 5, 'USD'), datetime.datetime(2024, 1, 2))
+    state.accounts_changed()
+
+    ta, tb, te = (
+        state.account_transactions(a),
+        state.account_transactions(b),
+        state.account_transactions(e, False, True),
+    )
+    assert state.account_transactions(a) is ta
+    state.transactions_changed({a})
+    assert state.account_transactions(a) is not ta
+    assert state.account_transactions(b) is tb
+    assert state.account_transactions(e, False, True) is te
+
+    # Writes move the change journal version, caches miss even without invalidation
+    aids = m.update_transaction(tid, m.op2(a, b, 10, 'USD'), datetime.datetime(2024, 1, 1), None)
+    assert aids == {a, b, food}
+    assert len(state.account_transactions(b)) == 2
+    assert len(state.account_transactions(e, False, True)) == 1
+
+    series = state.balance_series(b, 'day', datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 3))
+    assert series['values'] == {'USD': [10.0, 5.0]}
+    assert m.delete_transaction(tid) == {a, b}
+    series = state.balance_series(b, 'day', datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 3))
+    assert series['values'] == {'USD': [0, -5.0]}
+
+
+def test_balance_series(dbconn):
+    a = make_acc('a:cash')
+    card = make_acc('a:cash:card')
+    e = m.account_by_name('e')['aid']
+    dt = datetime.datetime
+    m.create_transaction(m.op2(e, a, 100, 'USD'), dt(2023, 12, 30))
+    m.create_transaction(m.op2(a, e, 10, 'USD'), dt(2024, 1, 2, 10))
+    m.create_transaction(m.op2(card, e, 5, 'GBP'), dt(2024, 1, 4))
+    m.create_transaction(m.op2(a, e, 1, 'USD'), dt(2024, 2, 1))
+
+    aid = m.account_by_name('a')['aid']
+    result = m.balance_series(aid, 'day', dt(2024, 1, 1), dt(2024, 1, 6))
+    assert result == {
+        'step': 'day',
+        'periods': ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04', '2024-01-05'],
+        'values': {'GBP': [0, 0, 0, -5.0, -5.0], 'USD': [100.0, 90.0, 90.0, 90.0, 90.0]},
+    }
+
+    result = m.balance_series(aid, 'week', dt(2024, 1, 3), dt(2024, 1, 10))
+    assert result['periods'] == ['2024-01-01', '2024-01-08']
+    assert result['values']['USD'] == [90.0, 90.0]
+
+    result = m.balance_series(card, 'month', dt(2023, 12, 15), dt(2024, 3, 1))
+    assert result == {'step': 'month', 'periods': ['2023-12', '2024-01', '2024-02'], 'values': {'GBP': [0, -5.0, -5.0]}}
+
+
+def test_ledgers(dbconn, tmp_path, mocker):
+    state.accounts_changed()
+    cash = make_acc('a:cash')
+    amap = state.account_map()
+    assert cash in amap
+
+    with db.use(str(tmp_path / 'biz.sqlite')):
+        m.create_tables()
+        m.create_initial_accounts()
+        assert db.backup_dir() == str(tmp_path / 'backups' / 'biz')
+        other = state.account_map()
+        assert cash not in other
+        state.accounts_changed()
+        assert state.account_map() is not other
+
+    assert state.account_map() is amap
+    assert m.account_by_id(cash)
+
+    from wadwise import web
+
+    mocker.patch('wadwise.web.ledgers_dir', str(tmp_path))
+    client = web.app.test_client()
+    # Requests never create ledgers
+    assert client.get('/api/changes?since=0', headers={web.LEDGER_HEADER: 'nope'}).status_code == 404
+    assert client.get('/l/nope/api/changes?since=0').status_code == 404
+    assert not (tmp_path / 'nope.sqlite').exists()
+
+    web.create_ledger('shop')
+    assert client.get('/l/shop/api/changes?since=0').json['result']['reset']
+    # Pages link and fetch within their ledger
+    mocker.patch('wadwise.web.DEV', True)
+    page = client.get('/l/shop/settings/').text
+    assert '"/l/shop/api/balance"' in page and '"/l/shop/account"' in page
+    with pytest.raises(ValueError):
+        web.create_ledger('shop')
+
+    def streamed(environ, start_response):
+        start_response('200 OK', [])
+        yield db.db_path().encode()
+
+    body = web.LedgerMiddleware(streamed)({'PATH_INFO': '/l/shop/'}, lambda *args: None)
+    assert list(body) == [str(tmp_path / 'shop.sqlite').encode()]
+    body.close()
+    assert db.db_path() == db.DB
+
+    # Request threads share pooled connections
+    db.close_connections()
+    connect = mocker.spy(db, '_connect')
+    threads = [threading.Thread(target=client.get, args=('/l/shop/api/changes?since=0',)) for _ in range(3)]
+    for it in threads:
+        it.start()
+        it.join()
+    assert connect.call_count == 1
+    assert len(db._pools[str(tmp_path / 'shop.sqlite')]) == 1
+
+    for it in range(db.MAX_THREAD_CONNECTIONS + 2):
+        with db.use(str(tmp_path / f'l{it}.sqlite')):
+            db.execute_raw('SELECT 1')
+    assert len(db._local.conns) == db.MAX_THREAD_CONNECTIONS
+
+
+def test_changes(dbconn):
+    result = m.changes_since(0)
+    assert result['reset']
+    since = result['version']
+
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    tid = m.create_transaction(m.op2(a, e, 10, 'USD'), datetime.datetime(2024, 1, 1))
+    m.set_param('foo', 'bar')
+    result = m.changes_since(since)
+    assert not result['reset']
+    assert result['accounts'][a]['name'] == 'cash'
+    tx = result['transactions'][tid]
+    assert tx['ops'] == [(a, -10.0, 'USD', 1), (e, 10.0, 'USD', 1)]
+    # No account to summarize from, clients get raw ops only
+    assert tx['split'] and 'src' not in tx and 'amount' not in tx
+    assert result['params'] == {'foo': 'bar'}
+    since = result['version']
+
+    m.delete_account(e, m.account_by_name('e')['aid'])
+    tid2 = m.create_transaction(m.op2(a, m.account_by_name('e')['aid'], 5, 'USD'))
+    m.delete_transaction(tid2)
+    result = m.changes_since(since)
+    assert result['accounts'] == {e: None}
+    assert result['transactions'].keys() == {tid, tid2}
+    assert result['transactions'][tid2] is None
+    assert result['params'] == {}
+
+    assert m.changes_since(result['version'])['version'] == result['version']
+
+    count = lambda q: db.execute_raw(f'SELECT count(*) FROM (SELECT {q} FROM changes)').fetchone()[0]
+    total, distinct = count('*'), count('DISTINCT kind, key')
+    assert m.compact_changes() == total - distinct
+    assert count('*') == distinct
+    assert m.changes_since(since)['transactions'].keys() == {tid, tid2}
+
+    m.compact_changes(-1)
+    assert db.execute_raw('SELECT kind FROM changes').fetchall() == [('*',)]
+    assert m.changes_since(since)['reset']
+    assert not m.changes_since(result['version'])['reset']
+
+
+def test_json_backends(dbconn):
+    from wadwise import jsonlib, web
+
+    if 'orjson' not in jsonlib.backends:
+        pytest.skip('orjson is not installed')
+
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    m.create_transaction(m.op2(a, e, 10, 'USD'), datetime.datetime(2024, 1, 1), 'Lunch', meta={'x': [1]})
+    data = {
+        'transactions': m.account_transactions(aids=[a], running=True),
+        'accounts': m.account_list(),
+        'amount': m.Amount2(1, 2),
+        'keys': {1: 'one'},
+    }
+
+    prev = jsonlib.backend
+    try:
+        result = {}
+        for it in jsonlib.backends:
+            jsonlib.set_backend(it)
+            result[it] = web.app.json.dumps(data)
+            assert jsonlib.loads(jsonlib.dumps([1, 'a'])) == [1, 'a']
+    finally:
+        jsonlib.set_backend(prev)
+
+    assert jsonlib.loads(result['orjson']) == jsonlib.loads(result['json'])
+    assert '": ' not in result['json'] and '}, {' not in result['json']
+    assert jsonlib.loads(result['orjson'])['transactions'][0]['date'] == 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+
+def test_shadow_verify(dbconn, caplog):
+    from wadwise import utils, verify
+
+    state.accounts_changed()
+    a = make_acc('a:cash')
+    e = make_acc('e:food')
+    m.create_transaction(m.op2(a, e, 10, 'USD'))
+    month = utils.month_start(datetime.date.today())
+
+    verify.stats.clear()
+    verify.enable(1)
+    try:
+        state.month_balances(month)
+        state.account_transactions(a)
+        state.month_balances(month)
+        state.account_transactions(a)
+        verify.wait()
+        assert verify.stats == {'ok': 2}
+
+        # Write without invalidation leaves balances stale, transaction lists follow the journal
+        m.create_transaction(m.op2(a, e, 5, 'USD'))
+        state.month_balances(month)
+        state.account_transactions(a)
+        state.account_transactions(a)
+        verify.wait()
+        assert verify.stats == {'ok': 3, 'mismatch': 1}
+        assert f'current {a} USD' in caplog.text
+    finally:
+        verify.enable(0)
+        state.transactions_changed()
+
+    state.month_balances(month)
+    verify.wait()
+    assert verify.stats['ok'] == 3
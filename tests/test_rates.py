@@ -0,0 +1,54 @@
+import io
+
+from wadwise import model as m
+from wadwise import rates, state
+
+from .test_model import dbconn, from_ts, make_acc
+
+_used = dbconn
+
+
+def test_rate_table():
+    table = rates.RateTable([('EUR', 10, 1.1), ('EUR', 20, 1.2), ('USD', 0, 1.0)])
+    assert table.rate('EUR', 5) is None
+    assert table.rate('EUR', 10) == 1.1
+    assert table.rate('EUR', 19) == 1.1
+    assert table.rate('EUR', 100) == 1.2
+    assert table.rate('GBP', 100) is None
+    assert table.cross('EUR', 'USD', 15) == 1.1
+    assert table.cross('USD', 'EUR', 25) == 1 / 1.2
+    assert table.cross('GBP', 'GBP', 25) == 1
+    assert table.cross('GBP', 'USD', 25) is None
+
+
+def test_convert(dbconn):
+    a = make_acc('a:cash')
+    b = make_acc('a:bank')
+    e = make_acc('e:food')
+    m.create_transaction(m.op2(e, a, 100, 'USD'), from_ts(10))
+    m.create_transaction(m.op2(e, b, 10, 'EUR'), from_ts(10))
+    m.create_transaction(m.op2(e, b, 1, 'JPY'), from_ts(10))
+
+    table = rates.RateTable([('EUR', 0, 2.0), ('USD', 0, 1.0)])
+    result = rates.convert(m.balance(), m.account_list(), table, 'USD', 100)
+    root = m.account_by_name('a')['aid']
+    assert result.values[a] == 100
+    assert result.values[b] == 20
+    assert result.values[root] == 120
+    assert result.values[e] == -120
+    assert result.missing == {'JPY'}
+
+
+def test_load_rates(dbconn):
+    src = 'cur,date,rate\neur,2024-01-01,1.1\nEUR,2024-02-01,1.2\n'
+    assert rates.load_csv(io.StringIO(src), 'USD') == 3
+    assert rates.load_csv(io.StringIO(src)) == 2
+    assert [it[0] for it in m.get_rates()] == ['EUR', 'EUR', 'USD']
+
+    ts = from_ts(0).replace(year=2024, month=1, day=15).timestamp()
+    assert state.rate_table().cross('EUR', 'USD', ts) == 1.1
+    assert state.rate_table() is state.rate_table()
+
+    # Nothing invalidates state caches here, same as with `load-rates` run by another process
+    rates.load_csv(io.StringIO('cur,date,rate\nEUR,2024-01-01,1.5\n'))
+    assert state.rate_table().cross('EUR', 'USD', ts) == 1.5
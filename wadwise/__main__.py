@@ -1,5 +1,8 @@
 # type: ignore
+import dataclasses
 import json
+import os
+import sys
 from datetime import datetime
 
 import click
@@ -18,12 +21,178 @@ def import_gnucash(fname):
     gnucash.import_data(fname)
 
 
+@cli.command('create-ledger')
+@click.argument('name')
+@click.option('--ledgers', required=True, default=lambda: os.environ.get('WADWISE_LEDGERS'), help='Ledgers directory')
+def create_ledger(name, ledgers):
+    from wadwise import web
+
+    os.makedirs(ledgers, exist_ok=True)
+    web.ledgers_dir = ledgers
+    try:
+        print(web.create_ledger(name))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@cli.command('load-rates')
+@click.argument('fname', type=click.File())
+@click.option('--ref', help='Reference currency of rates, stored with rate 1')
+def load_rates(fname, ref):
+    from wadwise import rates
+
+    print(rates.load_csv(fname, ref), 'rates loaded')
+
+
+@cli.command('export-gnucash')
+@click.argument('fname')
+def export_gnucash(fname):
+    from wadwise import gnucash, state
+
+    gnucash.export_data(fname, state.get_cur_list()[0])
+
+
+@cli.command('close-year')
+@click.argument('year', type=int)
+def close_year(year):
+    from wadwise import model as m
+
+    print(m.close_year(year), 'transactions archived')
+
+
+@cli.command('backup')
+def backup():
+    from wadwise import db
+
+    print(db.backup())
+
+
+@cli.command('maintain')
+@click.option('--vacuum', is_flag=True, help='Full VACUUM instead of incremental, enables auto_vacuum on old databases')
+def maintain(vacuum):
+    from wadwise import db
+    from wadwise import model as m
+
+    print(f'changes\t{m.compact_changes()} compacted')
+    result = db.maintain(vacuum)
+    before, after = result['before'], result['after']
+    for key in before:
+        print(f'{key}\t{before[key]}\t{after[key]}')
+    for name, duration in result['steps'].items():
+        print(f'{name}\t{duration:.3f}s')
+
+
+@cli.command('audit')
+def audit():
+    from wadwise import audit
+
+    issues = audit.audit()
+    for it in issues:
+        print(*('' if v is None else v for v in it.values()), sep='\t')
+    if issues:
+        sys.exit(1)
+
+
+@cli.command('loadtest')
+@click.option('--url', help='Running server to drive, by default the app is served in-process on a synthetic ledger')
+@click.option('-c', '--concurrency', type=int, default=8)
+@click.option('-d', '--duration', type=float, default=10, help='Seconds')
+@click.option('--mix', help='name=weight,... (default: account_view=60,balance=20,transaction_save=15,import=5)')
+@click.option('--transactions', type=int, default=5000, help='Size of synthetic ledger')
+@click.option('--seed', type=int, default=0)
+@click.option('--json', 'as_json', is_flag=True)
+def loadtest(url, concurrency, duration, mix, transactions, seed, as_json):
+    from wadwise import loadtest
+
+    mix = loadtest.parse_mix(mix) if mix else loadtest.DEFAULT_MIX
+    if url:
+        result = loadtest.run(url, concurrency, duration, mix, seed)
+    else:
+        result = loadtest.run_local(concurrency, duration, mix, transactions, seed)
+
+    if as_json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print('action', 'count', 'errors', 'p50', 'p95', 'p99', sep='\t')
+    for name, it in result['actions'].items():
+        print(name, it['count'], it['errors'], *(f'{it[p] * 1000:.1f}ms' for p in ('p50', 'p95', 'p99')), sep='\t')
+    print(f'{result["requests"]} requests in {result["duration"]:.1f}s, {result["throughput"]:.1f} req/s')
+    if result['busy'] is not None:
+        print(f'SQLITE_BUSY errors: {result["busy"]}')
+
+
+@cli.command('bench-json')
+@click.option('--transactions', type=int, default=5000, help='Size of synthetic ledger')
+@click.option('-r', '--rounds', type=int, default=5)
+@click.option('--seed', type=int, default=0)
+@click.option('--json', 'as_json', is_flag=True)
+def bench_json(transactions, rounds, seed, as_json):
+    from wadwise import jsonbench
+
+    result = jsonbench.run(transactions, rounds, seed)
+    if as_json:
+        print(json.dumps(result, indent=2))
+        return
+
+    backends = list(next(iter(result.values()))['timings'])
+    print('payload', 'size', *backends, sep='\t')
+    for name, it in result.items():
+        print(name, it['size'], *(f'{it["timings"][b] * 1000:.1f}ms' for b in backends), sep='\t')
+
+
 @cli.command('report')
-def report():
+@click.option('--by', type=click.Choice(['week', 'month', 'quarter', 'year']))
+@click.option('--from', 'start', type=click.DateTime(['%Y-%m-%d', '%Y-%m']))
+@click.option('--to', 'end', type=click.DateTime(['%Y-%m-%d', '%Y-%m']))
+@click.option('--account')
+def report(by, start, end, account):
     from wadwise import model as m
+    from wadwise import report, state
+
+    if not by:
+        result = m.balance()
+        print(json.dumps(result, indent=2, ensure_ascii=False, default=dataclasses.asdict))
+        return
+
+    aid = None
+    if account:
+        acc = m.account_by_name(account)
+        assert acc, f'{account} not found'
+        aid = acc['aid']
+
+    data = report.report(by, start, end, aid)
+    amap = state.account_map()
+    print('account', 'cur', *data['periods'], sep='\t')
+    for aid, totals in sorted(data['accounts'].items(), key=lambda it: amap[it[0]].full_name):
+        curs = sorted(set(cur for t in totals for cur, v in t.items() if v))
+        for cur in curs:
+            print(amap[aid].full_name, cur, *(f'{t.get(cur, 0):.2f}' for t in totals), sep='\t')
+
+
+@cli.command('export')
+@click.option('-f', '--format', 'fmt', type=click.Choice(['csv', 'jsonl', 'ledger']), default='csv')
+@click.option('-o', '--output', type=click.File('w'), default='-')
+@click.option('--from', 'start', type=click.DateTime(['%Y-%m-%d', '%Y-%m']))
+@click.option('--to', 'end', type=click.DateTime(['%Y-%m-%d', '%Y-%m']))
+@click.option('--account', multiple=True, help='Full account name, includes sub-accounts')
+def export(fmt, output, start, end, account):
+    from wadwise import export, report
+    from wadwise import model as m
+
+    amap = m.account_list()
+    aids = None
+    if account:
+        aids = set()
+        for name in account:
+            acc = m.account_by_name(name)
+            assert acc, f'{name} not found'
+            aids.add(acc['aid'])
+            aids.update(report.subtree(amap, acc['aid']))
 
-    result = m.balance()
-    print(json.dumps(result, indent=2, ensure_ascii=False))
+    data = m.iter_transactions(start and start.timestamp(), end and end.timestamp(), aids)
+    count = export.writers[fmt](output, data, export.account_names(amap))
+    print(count, 'transactions exported', file=sys.stderr)
 
 
 @cli.command('list-accounts')
@@ -31,8 +200,8 @@ def list_accounts():
     from wadwise import model as m
 
     amap = m.account_list()
-    for it in sorted(amap.values(), key=lambda x: x['full_name']):
-        print(it['full_name'])
+    for it in sorted(amap.values(), key=lambda x: x.full_name):
+        print(it.full_name)
 
 
 @cli.command('transactions')
@@ -54,7 +223,7 @@ def transactions(account, month):
                 return it[1]
 
     def get_dest(ops):
-        return ' / '.join(amap[it[0]]['full_name'] for it in ops if it[0] != acc['aid'])
+        return ' / '.join(amap[it[0]].full_name for it in ops if it[0] != acc['aid'])
 
     result = m.account_transactions(
         aid=acc['aid'], start_date=utils.month_start(dt), end_date=utils.next_month_start(dt)
@@ -0,0 +1,81 @@
+from typing import Literal, Optional, TypedDict
+
+from wadwise import db
+
+Check = Literal['unbalanced', 'dangling_account', 'dangling_parent', 'orphan_op', 'empty_transaction', 'bad_meta']
+
+
+class Issue(TypedDict):
+    check: Check
+    tid: Optional[str]
+    aid: Optional[str]
+    cur: Optional[str]
+    amount: Optional[float]
+
+
+# Every check is a set-based scan, all of them are combined into one statement
+AUDIT_SQL = """\
+    SELECT 'unbalanced', t.tid, NULL, c.cur, s.amount / 100.0
+    FROM (
+        -- Currency exchanges legitimately don't sum to zero per currency
+        SELECT tx_id, min(cur_id) AS cur_id, sum(amount) AS amount
+        FROM ops
+        GROUP BY tx_id
+        HAVING count(DISTINCT cur_id) = 1 AND sum(amount) != 0
+    ) s
+    LEFT JOIN transactions t ON t.id = s.tx_id
+    LEFT JOIN currencies c ON c.id = s.cur_id
+
+    UNION ALL
+    SELECT 'dangling_account', t.tid, NULL, c.cur, o.amount / 100.0
+    FROM ops o
+    LEFT JOIN transactions t ON t.id = o.tx_id
+    LEFT JOIN currencies c ON c.id = o.cur_id
+    WHERE NOT EXISTS (SELECT 1 FROM accounts a WHERE a.id = o.acc_id)
+
+    UNION ALL
+    SELECT 'dangling_parent', NULL, a.aid, NULL, NULL
+    FROM accounts a
+    WHERE a.parent IS NOT NULL AND NOT EXISTS (SELECT 1 FROM accounts p WHERE p.aid = a.parent)
+
+    UNION ALL
+    SELECT 'orphan_op', NULL, a.aid, c.cur, o.amount / 100.0
+    FROM ops o
+    LEFT JOIN accounts a ON a.id = o.acc_id
+    LEFT JOIN currencies c ON c.id = o.cur_id
+    WHERE NOT EXISTS (SELECT 1 FROM transactions t WHERE t.id = o.tx_id)
+
+    UNION ALL
+    SELECT 'empty_transaction', t.tid, NULL, NULL, NULL
+    FROM transactions t
+    WHERE NOT EXISTS (SELECT 1 FROM ops o WHERE o.tx_id = t.id)
+
+    UNION ALL
+    SELECT 'bad_meta', t.tid, NULL, NULL, NULL
+    FROM transactions t
+    WHERE t.meta IS NOT NULL AND NOT json_valid(t.meta)
+
+    UNION ALL
+    SELECT 'bad_meta', t.tid, m.value, NULL, NULL
+    FROM transactions t, json_each(t.meta) m
+    WHERE t.meta IS NOT NULL AND json_valid(t.meta)
+      AND m.key IN ('src', 'dest', 'via')
+      AND NOT EXISTS (
+          SELECT 1 FROM ops o INNER JOIN accounts a ON a.id = o.acc_id
+          WHERE o.tx_id = t.id AND a.aid = m.value
+      )
+"""
+
+
+def audit() -> list[Issue]:
+    """Checks ledger consistency
+
+    * unbalanced: ops of a single-currency transaction don't sum to zero
+    * dangling_account: op refers to a missing account (aid is unknown then)
+    * dangling_parent: account refers to a missing parent
+    * orphan_op: op refers to a missing transaction
+    * empty_transaction: transaction has no ops
+    * bad_meta: meta is not valid JSON or its src/dest/via are not in transaction ops
+    """
+    fields = Issue.__annotations__
+    return [dict(zip(fields, row)) for row in db.execute_raw(AUDIT_SQL)]  # type: ignore[misc]
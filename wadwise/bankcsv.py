@@ -0,0 +1,138 @@
+import csv
+import json
+from collections.abc import Collection
+from datetime import datetime
+from itertools import islice
+from typing import IO, Iterable, Iterator, Literal, NotRequired, TypedDict, TypeVar
+
+from wadwise import model as m
+
+T = TypeVar('T')
+
+State = Literal['imported'] | Literal['seen']
+
+CHUNK_SIZE = 500
+
+
+class TransactionData(TypedDict):
+    date: datetime
+    type: str
+    cur: str
+    key: str
+    txkey: str
+    amount: float
+    category: str
+    name: str
+    state: State | None
+    dest: NotRequired[str]
+
+
+class Profile(TypedDict):
+    name: str
+    # field -> csv column, fields: date, time, amount | debit + credit, cur, name, category, type
+    columns: dict[str, str]
+    date_fmt: str
+    cur: str
+    sign: int
+
+
+MONZO: Profile = {
+    'name': 'monzo',
+    'columns': {
+        'date': 'Date',
+        'time': 'Time',
+        'amount': 'Amount',
+        'name': 'Name',
+        'category': 'Category',
+        'type': 'Type',
+    },
+    'date_fmt': '%d/%m/%Y %H:%M:%S',
+    'cur': 'GBP',
+    'sign': 1,
+}
+
+
+def parse_amount(value: str) -> float:
+    value = value.strip().replace(',', '')
+    return float(value) if value else 0.0
+
+
+def parse(data_stream: IO[str], profile: Profile) -> Iterator[TransactionData]:
+    cols = profile['columns']
+    fmt = profile['date_fmt']
+    sign = profile['sign']
+
+    def get(row: dict[str, str], name: str) -> str:
+        col = cols.get(name)
+        return (row.get(col) or '').strip() if col else ''
+
+    for row in csv.DictReader(data_stream):
+        dt_str = get(row, 'date')
+        if not dt_str:
+            continue
+        if 'time' in cols:
+            dt_str += ' ' + get(row, 'time')
+        dt = datetime.strptime(dt_str, fmt)
+
+        if 'amount' in cols:
+            amount = parse_amount(get(row, 'amount'))
+        else:
+            amount = parse_amount(get(row, 'credit')) - parse_amount(get(row, 'debit'))
+        amount *= sign
+
+        cur = get(row, 'cur') or profile['cur']
+        typ = get(row, 'type')
+        name = get(row, 'name')
+        yield {
+            'date': dt,
+            'type': typ,
+            'cur': cur,
+            'key': typ + ':' + name,
+            'txkey': m.seen_tx_key(dt, amount, cur),
+            'amount': amount,
+            'category': get(row, 'category'),
+            'name': name,
+            'state': None,
+        }
+
+
+def chunked(it: Iterable[T], size: int) -> Iterator[list[T]]:
+    it = iter(it)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def mark_known(
+    data: Iterable[TransactionData], aid: str, aids: Collection[str], size: int = CHUNK_SIZE
+) -> Iterator[TransactionData]:
+    """Sets state of already imported or seen transactions, one lookup per chunk"""
+    for chunk in chunked(data, size):
+        keys = [it['txkey'] for it in chunk]
+        imported = m.imported_transactions(aids, keys)
+        seen = m.seen_transactions(aid, keys=keys)
+        for it in chunk:
+            if it['txkey'] in imported:
+                it['state'] = 'imported'
+            elif it['txkey'] in seen:
+                it['state'] = 'seen'
+        yield from chunk
+
+
+def suggest_dest(data: list[TransactionData], aid: str) -> None:
+    """Pre-fills destination of new rows from payee index, one lookup for all rows"""
+    rows = [(it, m.payee_terms(it['name'], it['category'])) for it in data if not it['state']]
+    found = m.payee_suggestions(aid, (term for _, terms in rows for term in terms))
+    for it, terms in rows:
+        for term in terms:
+            if term in found:
+                it['dest'] = found[term][0][0]
+                break
+
+
+def get_profiles() -> dict[str, Profile]:
+    profiles: list[Profile] = json.loads(m.get_param('import.profiles') or '[]') or []
+    return {MONZO['name']: MONZO} | {it['name']: it for it in profiles}
+
+
+def set_profiles(profiles: list[Profile]) -> None:
+    m.set_param('import.profiles', json.dumps(profiles))
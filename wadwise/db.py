@@ -1,11 +1,15 @@
 import base64
 import contextlib
-import functools
+import contextvars
+import gzip
 import os
+import shutil
 import sqlite3
 import threading
 import time
-from typing import Any, Iterator, Literal, Optional, TypeVar, Union, cast, overload
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Iterable, Iterator, Literal, Optional, TypedDict, TypeVar, Union, cast, overload
 
 from sqlbind_t import SET, VALUES, WHERE, AnySQL, sqlf, text
 from sqlbind_t.sqlite import Dialect
@@ -19,6 +23,23 @@ DictResult = dict[str, Any]
 DB = 'data.sqlite'
 dialect = Dialect()
 
+# Database of the ledger selected for the current request or job, `DB` when unset
+current_db: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('current_db', default=None)
+
+
+def db_path() -> str:
+    return current_db.get() or DB
+
+
+@contextlib.contextmanager
+def use(path: str) -> Iterator[None]:
+    """Routes all queries of the current context to the `path` database"""
+    token = current_db.set(path)
+    try:
+        yield
+    finally:
+        current_db.reset(token)
+
 
 @contextlib.contextmanager
 def transaction() -> Iterator[None]:
@@ -36,18 +57,106 @@ def transaction() -> Iterator[None]:
         raise
 
 
-@functools.lru_cache(None)
-def _get_connection(tid: int, db: Optional[str] = None) -> sqlite3.Connection:
-    conn = sqlite3.connect(db or DB)
+# Per thread, the least recently used ledger connection is closed above this
+MAX_THREAD_CONNECTIONS = 4
+# Idle connections kept per ledger for `pooled` contexts, pools of the least recently used ledgers are closed
+POOL_SIZE = 4
+MAX_POOLS = 8
+
+_local = threading.local()
+_pools: OrderedDict[str, list[sqlite3.Connection]] = OrderedDict()
+_pools_lock = threading.Lock()
+
+
+def _connect(db: str) -> sqlite3.Connection:
+    # Pooled connections move between threads, one thread uses them at a time
+    conn = sqlite3.connect(db, check_same_thread=False)
     conn.isolation_level = None
+    # Only takes effect for a new database, existing ones are converted by `maintain(vacuum=True)`
+    conn.execute('pragma auto_vacuum=incremental')
     conn.execute('pragma journal_mode=wal')
     conn.execute('pragma cache_size=-100000')
     conn.execute('pragma busy_timeout=10000')
     return conn
 
 
+def _acquire(path: str) -> sqlite3.Connection:
+    with _pools_lock:
+        idle = _pools.get(path)
+        if idle:
+            _pools.move_to_end(path)
+            return idle.pop()
+    return _connect(path)
+
+
+def _release(path: str, conn: sqlite3.Connection) -> None:
+    if conn.in_transaction:  # pragma: no cover
+        conn.rollback()
+    closing = [conn]
+    with _pools_lock:
+        idle = _pools.setdefault(path, [])
+        _pools.move_to_end(path)
+        if len(idle) < POOL_SIZE:
+            idle.append(conn)
+            closing.clear()
+        while len(_pools) > MAX_POOLS:
+            closing.extend(_pools.popitem(last=False)[1])
+    for it in closing:
+        it.close()
+
+
+@contextlib.contextmanager
+def pooled() -> Iterator[None]:
+    """Takes connections from shared per ledger pools for the current thread until exit
+
+    Web requests run in short-lived threads, pooled connections keep their
+    page cache between requests.
+    """
+    prev = _local.__dict__.get('leased')
+    leased: dict[str, sqlite3.Connection] = {}
+    _local.leased = leased
+    try:
+        yield
+    finally:
+        _local.leased = prev
+        for path, conn in leased.items():
+            _release(path, conn)
+
+
 def get_connection(db: Optional[str] = None) -> sqlite3.Connection:
-    return _get_connection(threading.get_ident(), db)
+    """Connection to `db` or the current ledger
+
+    Inside `pooled` it's leased from the ledger pool, otherwise it's owned by
+    the current thread and lives as long as the thread.
+    """
+    path = db or db_path()
+    leased: Optional[dict[str, sqlite3.Connection]] = _local.__dict__.get('leased')
+    if leased is not None:
+        conn = leased.get(path)
+        if conn is None:
+            conn = leased[path] = _acquire(path)
+        return conn
+
+    conns: OrderedDict[str, sqlite3.Connection] = _local.__dict__.setdefault('conns', OrderedDict())
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = _connect(path)
+        while len(conns) > MAX_THREAD_CONNECTIONS:
+            conns.popitem(last=False)[1].close()
+    else:
+        conns.move_to_end(path)
+    return conn
+
+
+def close_connections() -> None:
+    """Closes connections of the current thread and idle pooled ones"""
+    closing = list(_local.__dict__.pop('conns', {}).values())
+    with _pools_lock:
+        for idle in _pools.values():
+            closing.extend(idle)
+        _pools.clear()
+    for it in closing:
+        it.close()
 
 
 def execute_raw(sql: str, params: Optional[Union[dict[str, Any], list[Any]]] = None) -> sqlite3.Cursor:
@@ -55,6 +164,11 @@ def execute_raw(sql: str, params: Optional[Union[dict[str, Any], list[Any]]] = N
     return conn.execute(sql, params or ())
 
 
+def execute_raw_many(sql: str, params: Iterable[Any]) -> sqlite3.Cursor:
+    conn = get_connection()
+    return conn.executemany(sql, params)
+
+
 def insert(table: str, **params: Any) -> 'QueryList[TupleResult]':
     return execute(sqlf(f'@INSERT INTO {text(table)} {VALUES(**params)}'))
 
@@ -122,21 +236,155 @@ def execute(query: AnySQL, as_dict: bool = False) -> Union[QueryList[TupleResult
     return result
 
 
+def iterate(query: AnySQL) -> Iterator[TupleResult]:
+    """Lazily fetches query rows from a cursor without materializing the result"""
+    qstr, params = dialect.render(query)
+    yield from execute_raw(qstr, params)
+
+
 def execute_d(query: AnySQL) -> QueryList[DictResult]:
     r = execute(query, True)
     return r
 
 
-def backup() -> str:
+BACKUP_PREFIX = 'wadwise-backup-'
+BACKUP_KEEP = 7
+
+try:
+    import zstandard  # type: ignore[import-not-found,unused-ignore]
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+BackupProgress = Callable[[int, int, int], object]
+
+
+def backup_dir() -> str:
+    path = db_path()
+    result = os.path.join(os.path.dirname(os.path.abspath(path)), 'backups')
+    if path != DB:
+        # Ledgers share a directory, each one keeps its own backups
+        result = os.path.join(result, os.path.splitext(os.path.basename(path))[0])
+    return result
+
+
+def backup_list() -> list[str]:
+    """Backup file names, newest first"""
+    try:
+        names = os.listdir(backup_dir())
+    except FileNotFoundError:
+        return []
+    return sorted((it for it in names if it.startswith(BACKUP_PREFIX)), reverse=True)
+
+
+def _compress(src: str, dst: str) -> None:
+    with open(src, 'rb') as fin:
+        if dst.endswith('.zst'):
+            with zstandard.ZstdCompressor().stream_writer(open(dst, 'wb')) as zout:
+                shutil.copyfileobj(fin, zout, 1 << 20)
+        else:
+            with gzip.open(dst, 'wb') as gout:
+                shutil.copyfileobj(fin, gout, 1 << 20)
+
+
+def backup(
+    progress: Optional[BackupProgress] = None, pages: int = 256, sleep: float = 0.005, keep: int = BACKUP_KEEP
+) -> str:
+    """Compressed online backup of the database
+
+    Database is copied in steps of `pages` with `sleep` seconds between them,
+    so writers are not blocked for the whole copy. Only `keep` newest backups are retained.
+    """
+    dest = backup_dir()
+    os.makedirs(dest, exist_ok=True)
+    # Microseconds, so backups in the same second don't overwrite each other
+    name = BACKUP_PREFIX + datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    tmp = os.path.join(dest, f'.{name}.sqlite')
+    fname = os.path.join(dest, name + ('.sqlite.zst' if zstandard else '.sqlite.gz'))
+
     src = get_connection()
-    fname = os.path.join(os.path.dirname(DB), 'wadwise-backup.sqlite')
-    dst = _get_connection.__wrapped__(None, fname)
-    with dst:
-        src.backup(dst)
-    dst.close()
+    try:
+        with contextlib.closing(sqlite3.connect(tmp)) as dst:
+            src.backup(dst, pages=pages, sleep=sleep, progress=progress)
+        _compress(tmp, fname)
+    finally:
+        # Don't hide the original error when the copy never got created
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+
+    for it in backup_list()[keep:]:
+        os.remove(os.path.join(dest, it))
     return fname
 
 
+class DbSize(TypedDict):
+    db: int
+    wal: int
+    pages: int
+    free_pages: int
+
+
+class MaintainReport(TypedDict):
+    before: DbSize
+    after: DbSize
+    steps: dict[str, float]
+
+
+def _file_size(fname: str) -> int:
+    try:
+        return os.path.getsize(fname)
+    except FileNotFoundError:
+        return 0
+
+
+def db_size() -> DbSize:
+    path = db_path()
+    return {
+        'db': _file_size(path),
+        'wal': _file_size(path + '-wal'),
+        'pages': execute_raw('pragma page_count').fetchone()[0],
+        'free_pages': execute_raw('pragma freelist_count').fetchone()[0],
+    }
+
+
+def maintain(vacuum: bool = False) -> MaintainReport:
+    """Refreshes planner statistics, returns free pages and truncates WAL
+
+    Free pages are released with incremental vacuum. A database created before
+    auto_vacuum was enabled needs a full `vacuum` once to switch the mode.
+    """
+    before = db_size()
+    steps: dict[str, float] = {}
+
+    def step(name: str, sql: str) -> None:
+        start = time.perf_counter()
+        execute_raw(sql).fetchall()
+        steps[name] = time.perf_counter() - start
+
+    step('analyze', 'ANALYZE')
+    step('optimize', 'pragma optimize')
+    if vacuum:
+        execute_raw('pragma auto_vacuum=incremental')
+        step('vacuum', 'VACUUM')
+    else:
+        step('incremental_vacuum', 'pragma incremental_vacuum')
+    step('wal_checkpoint', 'pragma wal_checkpoint(TRUNCATE)')
+
+    return {'before': before, 'after': db_size(), 'steps': steps}
+
+
+def archive_name() -> str:
+    base, ext = os.path.splitext(db_path())
+    return f'{base}-archive{ext}'
+
+
+def attach_archive() -> None:
+    """Attaches archive database as `archive` schema to the current connection"""
+    conn = get_connection()
+    if any(it[1] == 'archive' for it in conn.execute('pragma database_list')):
+        return
+    conn.execute('ATTACH DATABASE ? AS archive', (archive_name(),))
+
+
 def get_version() -> int:
     return execute(text('pragma user_version')).scalar()  # type: ignore[no-any-return]
 
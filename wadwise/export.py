@@ -0,0 +1,59 @@
+import csv
+import json
+from datetime import datetime
+from typing import IO, Callable, Iterable
+
+from wadwise import model as m
+
+Names = dict[str, str]
+Writer = Callable[[IO[str], Iterable[m.ExportTransaction], Names], int]
+
+
+def account_names(amap: m.AccountMap) -> Names:
+    return {aid: it.full_name for aid, it in amap.items() if it.aid}
+
+
+def fmt_date(ts: int) -> str:
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def write_csv(out: IO[str], data: Iterable[m.ExportTransaction], names: Names) -> int:
+    writer = csv.writer(out)
+    writer.writerow(['tid', 'date', 'desc', 'account', 'amount', 'cur'])
+    count = 0
+    for tr in data:
+        date = fmt_date(tr.date)
+        writer.writerows([tr.tid, date, tr.desc or '', names[aid], f'{amount:.2f}', cur] for aid, amount, cur in tr.ops)
+        count += 1
+    return count
+
+
+def write_jsonl(out: IO[str], data: Iterable[m.ExportTransaction], names: Names) -> int:
+    count = 0
+    for tr in data:
+        ops = [{'account': names[aid], 'amount': amount, 'cur': cur} for aid, amount, cur in tr.ops]
+        out.write(
+            json.dumps({'tid': tr.tid, 'date': fmt_date(tr.date), 'desc': tr.desc, 'ops': ops}, ensure_ascii=False)
+        )
+        out.write('\n')
+        count += 1
+    return count
+
+
+def write_ledger(out: IO[str], data: Iterable[m.ExportTransaction], names: Names) -> int:
+    count = 0
+    for tr in data:
+        if count:
+            out.write('\n')
+        out.write(f'{datetime.fromtimestamp(tr.date):%Y/%m/%d} {tr.desc or ""}'.rstrip() + '\n')
+        for aid, amount, cur in tr.ops:
+            out.write(f'    {names[aid]}  {amount:.2f} {cur}\n')
+        count += 1
+    return count
+
+
+writers: dict[str, Writer] = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'ledger': write_ledger,
+}
@@ -1,11 +1,18 @@
 # type: ignore
-from base64 import urlsafe_b64encode
-from binascii import unhexlify
+import gzip
+import hashlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from binascii import hexlify, unhexlify
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import XMLGenerator
 
 from covador import item, make_schema, opt
+from sqlbind_t import text
 
+from wadwise import db, rates
 from wadwise import model as m
 
 
@@ -33,6 +40,17 @@ def b64id(value):
     return urlsafe_b64encode(unhexlify(value)).decode().rstrip('=')
 
 
+def guid(value):
+    """Reverse of b64id, ids not coming from GnuCash are hashed into a guid"""
+    try:
+        raw = urlsafe_b64decode(value + '=' * (-len(value) % 4))
+    except (BinasciiError, ValueError):
+        raw = b''
+    if len(raw) == 16:
+        return hexlify(raw).decode()
+    return hashlib.md5(value.encode()).hexdigest()
+
+
 def date_t(value):
     return datetime.strptime(value, '%Y-%m-%d %H:%M:%S %z')
 
@@ -45,6 +63,8 @@ gnucash_ns = {
     'split': 'http://www.gnucash.org/XML/split',
     'ts': 'http://www.gnucash.org/XML/ts',
     'slot': 'http://www.gnucash.org/XML/slot',
+    'book': 'http://www.gnucash.org/XML/book',
+    'cd': 'http://www.gnucash.org/XML/cd',
 }
 
 
@@ -75,7 +95,7 @@ transaction_t = gnc_schema(
     tid=item(xml_text, src='trn:id') | b64id,
     cur=item(xml_text, src='trn:currency/cmdty:id'),
     date=item(xml_text, src='trn:date-posted/ts:date') | date_t,
-    desc=item(xml_text, src='trn:description'),
+    desc=opt(xml_text, src='trn:description'),
     ops=item(op_t, multi=True, src='trn:splits/trn:split'),
 )
 
@@ -85,22 +105,43 @@ gnc_data = gnc_schema(
 )
 
 
-def import_data(fname):
-    root = ET.parse(fname)
+acc_types = {
+    'INCOME': m.AccType.INCOME,
+    'ASSET': m.AccType.ASSET,
+    'BANK': m.AccType.ASSET,
+    'CREDIT': m.AccType.ASSET,
+    'EXPENSE': m.AccType.EXPENSE,
+    'EQUITY': m.AccType.EQUITY,
+    'LIABILITY': m.AccType.LIABILITY,
+}
+
+gnc_types = {}
+for _k, _v in acc_types.items():
+    gnc_types.setdefault(_v, _k)
+
+
+@contextmanager
+def open_data(fname):
+    """Plain or gzipped book, files opened by path are closed on exit"""
+    with ExitStack() as stack:
+        f = stack.enter_context(open(fname, 'rb')) if isinstance(fname, str) else fname
+        head = f.read(2)
+        f.seek(0)
+        if head == b'\x1f\x8b':
+            f = stack.enter_context(gzip.GzipFile(fileobj=f))
+        yield f
+
+
+CHUNK_SIZE = 500
+
+
+def import_data(fname, job=None):
+    with open_data(fname) as f:
+        root = ET.parse(f)
     data = gnc_data(root)
     m.drop_tables()
     m.create_tables()
 
-    acc_types = {
-        'INCOME': m.AccType.INCOME,
-        'ASSET': m.AccType.ASSET,
-        'BANK': m.AccType.ASSET,
-        'CREDIT': m.AccType.ASSET,
-        'EXPENSE': m.AccType.EXPENSE,
-        'EQUITY': m.AccType.EQUITY,
-        'LIABILITY': m.AccType.LIABILITY,
-    }
-
     accs = {}
     parents = {}
     for it in data['accounts']:
@@ -133,6 +174,179 @@ def import_data(fname):
     parents[None] = parents.pop(root)
     make_children_acc(None)
 
-    for trn in data['transactions']:
-        ops = [m.op(accs[op['account']]['aid'], op['amount'], accs[op['account']]['cur']) for op in trn['ops']]
-        m.create_transaction(ops, int(trn['date'].timestamp()), trn['desc'])
+    transactions = data['transactions']
+    if job:
+        job.progress(0, len(transactions))
+    for start in range(0, len(transactions), CHUNK_SIZE):
+        with m.transaction():
+            for idx, trn in enumerate(transactions[start : start + CHUNK_SIZE], start):
+                try:
+                    ops = [
+                        m.op(accs[op['account']]['aid'], op['amount'], accs[op['account']]['cur']) for op in trn['ops']
+                    ]
+                except KeyError as e:
+                    if not job:
+                        raise
+                    job.row_error(idx, f'Unknown account {e}')
+                    continue
+                m.create_transaction(ops, trn['date'], trn['desc'])
+        if job:
+            job.progress(min(start + CHUNK_SIZE, len(transactions)))
+
+
+class XmlWriter:
+    def __init__(self, out):
+        self.gen = XMLGenerator(out, 'utf-8', short_empty_elements=True)
+
+    @contextmanager
+    def tag(self, name, attrs=None):
+        self.gen.startElement(name, attrs or {})
+        yield
+        self.gen.endElement(name)
+        self.gen.ignorableWhitespace('\n')
+
+    def elem(self, name, text, attrs=None):
+        self.gen.startElement(name, attrs or {})
+        self.gen.characters(str(text))
+        self.gen.endElement(name)
+
+    def commodity(self, name, cur):
+        with self.tag(name):
+            self.elem('cmdty:space', 'CURRENCY')
+            self.elem('cmdty:id', cur)
+
+
+def gnc_amount(cents):
+    return f'{cents}/100'
+
+
+def gnc_date(ts):
+    return datetime.fromtimestamp(ts).astimezone().strftime('%Y-%m-%d %H:%M:%S %z')
+
+
+def split_values(tcur, ops, rate=None):
+    """Values of splits in transaction currency
+
+    A foreign currency split is valued by its own quantity at a price per
+    currency: the exchange price implied by unbalanced transaction currency
+    splits, otherwise `rate(cur)` or 1. The last foreign split takes the
+    rounding leftover.
+    """
+    home = sum(amount for _, amount, cur in ops if cur == tcur)
+    foreign = sum(amount for _, amount, cur in ops if cur != tcur)
+    prices = {}
+    values = []
+    for _, amount, cur in ops:
+        if cur == tcur:
+            values.append(amount)
+            continue
+        if cur not in prices:
+            prices[cur] = -home / foreign if home and foreign else (rate and rate(cur)) or 1.0
+        values.append(round(amount * prices[cur]))
+
+    foreign_idx = [idx for idx, (_, _, cur) in enumerate(ops) if cur != tcur]
+    residual = sum(values)
+    if foreign_idx and abs(residual) * 2 <= len(foreign_idx):
+        values[foreign_idx[-1]] -= residual
+    return values
+
+
+def export_data(fname, default_cur='USD'):
+    """Writes GnuCash XML book incrementally, transactions are streamed from a cursor"""
+    amap = m.account_list()
+    accounts = [it for it in amap.values() if it.aid]
+
+    usage = {}
+    q = """\
+        SELECT a.aid, c.cur, cnt
+        FROM (SELECT acc_id, cur_id, count(1) AS cnt FROM ops GROUP BY acc_id, cur_id) o
+        INNER JOIN accounts a ON a.id = o.acc_id
+        INNER JOIN currencies c ON c.id = o.cur_id
+    """
+    for aid, cur, cnt in db.execute(text(q)):
+        usage.setdefault(aid, []).append((cnt, cur))
+
+    # GnuCash accounts hold a single commodity, extra currencies go into
+    # child accounts named by the currency, as import_data expects.
+    acc_cur = {}
+    gnc_acc = {}
+    extra = []
+    for it in accounts:
+        curs = sorted(usage.get(it.aid, []), reverse=True)
+        acc_cur[it.aid] = main = curs[0][1] if curs else default_cur
+        gnc_acc[it.aid, main] = guid(it.aid)
+        for _, cur in curs[1:]:
+            gnc_acc[it.aid, cur] = hashlib.md5(f'{it.aid}:{cur}'.encode()).hexdigest()
+            extra.append((it, cur))
+
+    currencies = sorted(set(cur for _, cur in gnc_acc) | {default_cur})
+    table = rates.RateTable(m.get_rates())
+    tr_count = db.execute(text('SELECT count(1) FROM transactions')).scalar(0)
+    root_id = hashlib.md5(b'wadwise:root').hexdigest()
+
+    with gzip.open(fname, 'wb') as out:
+        w = XmlWriter(out)
+        w.gen.startDocument()
+        with w.tag('gnc-v2', {f'xmlns:{k}': v for k, v in gnucash_ns.items()}):
+            w.elem('gnc:count-data', 1, {'cd:type': 'book'})
+            with w.tag('gnc:book', {'version': '2.0.0'}):
+                w.elem('book:id', hashlib.md5(b'wadwise:book').hexdigest(), {'type': 'guid'})
+                w.elem('gnc:count-data', len(currencies), {'cd:type': 'commodity'})
+                w.elem('gnc:count-data', len(gnc_acc) + 1, {'cd:type': 'account'})
+                w.elem('gnc:count-data', tr_count, {'cd:type': 'transaction'})
+
+                for cur in currencies:
+                    with w.tag('gnc:commodity', {'version': '2.0.0'}):
+                        w.elem('cmdty:space', 'CURRENCY')
+                        w.elem('cmdty:id', cur)
+
+                with w.tag('gnc:account', {'version': '2.0.0'}):
+                    w.elem('act:name', 'Root Account')
+                    w.elem('act:id', root_id, {'type': 'guid'})
+                    w.elem('act:type', 'ROOT')
+                    w.commodity('act:commodity', default_cur)
+
+                def write_account(name, gid, typ, cur, parent, placeholder):
+                    with w.tag('gnc:account', {'version': '2.0.0'}):
+                        w.elem('act:name', name)
+                        w.elem('act:id', gid, {'type': 'guid'})
+                        w.elem('act:type', gnc_types[typ])
+                        w.commodity('act:commodity', cur)
+                        w.elem('act:commodity-scu', 100)
+                        with w.tag('act:slots'):
+                            with w.tag('slot'):
+                                w.elem('slot:key', 'placeholder')
+                                w.elem('slot:value', 'true' if placeholder else 'false', {'type': 'string'})
+                        w.elem('act:parent', parent, {'type': 'guid'})
+
+                for it in sorted(accounts, key=lambda it: len(it.parents)):
+                    parent = it.parent and gnc_acc[it.parent, acc_cur[it.parent]] or root_id
+                    gid = gnc_acc[it.aid, acc_cur[it.aid]]
+                    write_account(it.name, gid, it.type, acc_cur[it.aid], parent, it.is_placeholder)
+
+                for it, cur in extra:
+                    parent = gnc_acc[it.aid, acc_cur[it.aid]]
+                    write_account(cur, gnc_acc[it.aid, cur], it.type, cur, parent, False)
+
+                for tr in m.iter_transactions():
+                    ops = [(aid, round(amount * 100), cur) for aid, amount, cur in tr.ops]
+                    tcur = ops[0][2]
+                    values = split_values(tcur, ops, lambda cur, tcur=tcur, ts=tr.date: table.cross(cur, tcur, ts))
+                    with w.tag('gnc:transaction', {'version': '2.0.0'}):
+                        w.elem('trn:id', guid(tr.tid), {'type': 'guid'})
+                        w.commodity('trn:currency', tcur)
+                        with w.tag('trn:date-posted'):
+                            w.elem('ts:date', gnc_date(tr.date))
+                        with w.tag('trn:date-entered'):
+                            w.elem('ts:date', gnc_date(tr.date))
+                        w.elem('trn:description', tr.desc or '')
+                        with w.tag('trn:splits'):
+                            for idx, ((aid, amount, cur), value) in enumerate(zip(ops, values)):
+                                with w.tag('trn:split'):
+                                    split_id = hashlib.md5(f'{tr.tid}:{idx}'.encode()).hexdigest()
+                                    w.elem('split:id', split_id, {'type': 'guid'})
+                                    w.elem('split:reconciled-state', 'n')
+                                    w.elem('split:value', gnc_amount(value))
+                                    w.elem('split:quantity', gnc_amount(amount))
+                                    w.elem('split:account', gnc_acc[aid, cur], {'type': 'guid'})
+        w.gen.endDocument()
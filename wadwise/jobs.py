@@ -0,0 +1,121 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Concatenate, Literal, Optional, ParamSpec, TypedDict
+
+P = ParamSpec('P')
+
+log = logging.getLogger(__name__)
+
+Status = Literal['pending', 'running', 'done', 'failed']
+
+MAX_JOBS = 50
+
+# Single worker: SQLite has one writer anyway and jobs are executed in submit order
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='wadwise-job')
+jobs: dict[str, 'Job'] = {}
+lock = threading.Lock()
+
+
+class RowError(TypedDict):
+    row: int
+    error: str
+
+
+class JobState(TypedDict):
+    id: str
+    name: str
+    status: Status
+    total: int
+    done: int
+    errors: list[RowError]
+    error: Optional[str]
+
+
+class Job:
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status: Status = 'pending'
+        self.total = 0
+        self.done = 0
+        self.errors: list[RowError] = []
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.version = 0
+        self.changed = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def _touch(self) -> None:
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    def progress(self, done: int, total: Optional[int] = None) -> None:
+        self.done = done
+        if total is not None:
+            self.total = total
+        self._touch()
+
+    def row_error(self, row: int, error: str) -> None:
+        self.errors.append({'row': row, 'error': error})
+        self._touch()
+
+    def set_status(self, status: Status, error: Optional[str] = None) -> None:
+        self.status = status
+        self.error = error
+        self._touch()
+
+    def wait_change(self, version: int, timeout: Optional[float] = None) -> int:
+        """Blocks until job state differs from the given version, returns current version"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        with self.changed:
+            return self.changed.wait_for(lambda: self.finished, timeout)
+
+    def state(self) -> JobState:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'errors': list(self.errors),
+            'error': self.error,
+        }
+
+
+def _run(job: Job, fn: Callable[..., Any], args: tuple[Any, ...], kwargs: dict[str, Any]) -> None:
+    job.set_status('running')
+    try:
+        fn(job, *args, **kwargs)
+    except Exception as e:
+        log.exception('Job %s (%s) failed', job.id, job.name)
+        job.set_status('failed', str(e))
+    else:
+        job.set_status('done')
+
+
+def submit(name: str, fn: Callable[Concatenate[Job, P], Any], *args: P.args, **kwargs: P.kwargs) -> Job:
+    job = Job(name)
+    with lock:
+        jobs[job.id] = job
+        finished = [it.id for it in jobs.values() if it.finished]
+        for jid in finished[: max(0, len(jobs) - MAX_JOBS)]:
+            del jobs[jid]
+    # Job runs in a copy of the caller context to keep working on the same ledger
+    executor.submit(contextvars.copy_context().run, _run, job, fn, args, kwargs)
+    return job
+
+
+def get(jid: str) -> Optional[Job]:
+    return jobs.get(jid)
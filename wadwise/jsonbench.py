@@ -0,0 +1,69 @@
+"""JSON codec benchmark
+
+Times encoding of the biggest payloads (transaction lists, account map)
+and decoding of JSON columns with every available jsonlib backend on a
+synthetic ledger.
+"""
+
+import functools
+import os
+import tempfile
+import time
+from typing import Callable, TypedDict
+
+from wadwise import db, jsonlib, state
+from wadwise import model as m
+from wadwise.loadtest import make_ledger
+
+
+class CodecStats(TypedDict):
+    size: int  # encoded bytes for dumps, rows for loads
+    timings: dict[str, float]
+
+
+def best_time(fn: Callable[[], object], rounds: int) -> float:
+    result = []
+    for _ in range(rounds):
+        t = time.perf_counter()
+        fn()
+        result.append(time.perf_counter() - t)
+    return min(result)
+
+
+def run(transactions: int = 5000, rounds: int = 5, seed: int = 0) -> dict[str, CodecStats]:
+    """Best of `rounds` timings per backend on a synthetic ledger in a temporary directory"""
+    from wadwise import web
+
+    prev_backend = jsonlib.backend
+    result: dict[str, CodecStats] = {}
+    with tempfile.TemporaryDirectory() as tmp, db.use(os.path.join(tmp, 'bench.sqlite')):
+        aids = make_ledger(transactions=transactions, seed=seed)
+        # Same shapes as account view and page data
+        payloads = {
+            'transactions': m.account_transactions(),
+            'running': m.account_transactions(aids=aids[:1], running=True),
+            'accounts': state.account_map(),
+        }
+        try:
+            for name, data in payloads.items():
+                stats: CodecStats = {'size': len(web.app.json.dumps(data).encode()), 'timings': {}}
+                for it in jsonlib.backends:
+                    jsonlib.set_backend(it)
+                    stats['timings'][it] = best_time(functools.partial(web.app.json.dumps, data), rounds)
+                result[f'dumps {name}'] = stats
+
+            # Ops, meta and balance columns are parsed for every transaction row
+            reads: dict[str, Callable[[], object]] = {
+                'transactions': lambda: m.account_transactions(),
+                'running': lambda: m.account_transactions(aids=aids[:1], running=True),
+            }
+            for name, fn in reads.items():
+                stats = {'size': len(payloads[name]), 'timings': {}}
+                for it in jsonlib.backends:
+                    jsonlib.set_backend(it)
+                    stats['timings'][it] = best_time(fn, rounds)
+                result[f'loads {name}'] = stats
+        finally:
+            jsonlib.set_backend(prev_backend)
+
+    return result
@@ -0,0 +1,52 @@
+"""JSON codec for hot paths: page payloads, API responses and JSON columns
+
+orjson is used when installed, stdlib json otherwise. Output is always
+compact. Types the codec doesn't handle natively (dates, dataclasses,
+named tuples) go through `default`, so both backends produce the same data.
+"""
+
+import json
+from typing import Any, Callable, Optional
+
+try:
+    import orjson  # type: ignore[import-not-found,unused-ignore]
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment,unused-ignore]
+
+Default = Callable[[Any], Any]
+
+backends = ('json', 'orjson') if orjson else ('json',)
+backend = backends[-1]
+
+
+def set_backend(name: str) -> None:
+    global backend
+    assert name in backends, f'{name} is not available'
+    backend = name
+
+
+def loads(data: str | bytes) -> Any:
+    if backend == 'orjson':
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _tuple_default(default: Optional[Default]) -> Default:
+    def inner(o: Any) -> Any:
+        # orjson serializes plain tuples but not their subclasses
+        if isinstance(o, tuple):
+            return list(o)
+        if default:
+            return default(o)
+        raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+    return inner
+
+
+def dumps(obj: Any, default: Optional[Default] = None, sort_keys: bool = False) -> str:
+    if backend == 'orjson':
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_tuple_default(default), option=option).decode()
+    return json.dumps(obj, default=default, sort_keys=sort_keys, separators=(',', ':'))
@@ -0,0 +1,276 @@
+"""Concurrent load generator for the web app
+
+Workers drive a weighted mix of page views, API calls and writes for a
+fixed duration and every request is sampled. Without an explicit url the
+app is served in-process on a synthetic ledger, then SQLITE_BUSY errors of
+requests and jobs are counted as well.
+"""
+
+import json
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+from typing import Any, Callable, NamedTuple, Optional, TypedDict
+
+from wadwise import db, jobs
+from wadwise import model as m
+
+DEFAULT_MIX = {'account_view': 60, 'balance': 20, 'transaction_save': 15, 'import': 5}
+IMPORT_ROWS = 20
+
+
+class Sample(NamedTuple):
+    action: str
+    latency: float
+    status: int
+
+
+class ActionStats(TypedDict):
+    count: int
+    errors: int
+    p50: float
+    p95: float
+    p99: float
+
+
+class LoadReport(TypedDict):
+    duration: float
+    concurrency: int
+    requests: int
+    throughput: float
+    busy: Optional[int]
+    actions: dict[str, ActionStats]
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args: Any, **kwargs: Any) -> None:
+        return None
+
+
+class Client:
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self.opener = urllib.request.build_opener(NoRedirect)
+
+    def request(self, path: str, form: Optional[dict[str, str]] = None) -> int:
+        data = urllib.parse.urlencode(form).encode() if form else None
+        try:
+            with self.opener.open(self.url + path, data, timeout=60) as resp:
+                resp.read()
+                return resp.status  # type: ignore[no-any-return]
+        except urllib.error.HTTPError as e:
+            # Writes answer with a redirect which is a success here
+            return e.code
+        except OSError:
+            return 0
+
+    def json(self, path: str) -> Any:
+        with self.opener.open(self.url + path, timeout=60) as resp:
+            return json.load(resp)
+
+
+def make_ledger(accounts: int = 20, transactions: int = 5000, seed: int = 0) -> list[str]:
+    """Fills an empty database with random accounts and transactions over the last two years"""
+    rnd = random.Random(seed)
+    m.create_tables()
+    m.create_initial_accounts()
+    with db.transaction():
+        aids = [m.create_account(m.AccType.ASSET, f'Account {i}', m.AccType.ASSET) for i in range(accounts // 4 or 1)]
+        aids += [m.create_account(m.AccType.EXPENSE, f'Expense {i}', m.AccType.EXPENSE) for i in range(accounts)]
+
+    now = datetime.now()
+    for chunk in range(0, transactions, 1000):
+        with db.transaction():
+            for _ in range(min(1000, transactions - chunk)):
+                src, dest = rnd.sample(aids, 2)
+                date = now - timedelta(seconds=rnd.randrange(2 * 365 * 86400))
+                m.create_transaction(m.op2(src, dest, rnd.randrange(100, 10000) / 100, 'USD'), date)
+    return aids
+
+
+def account_view(client: Client, rnd: random.Random, aids: list[str]) -> int:
+    return client.request('/account?' + urllib.parse.urlencode({'aid': rnd.choice(aids)}))
+
+
+def balance(client: Client, rnd: random.Random, aids: list[str]) -> int:
+    date = datetime.now() - timedelta(days=rnd.randrange(365))
+    return client.request(
+        '/api/balance?' + urllib.parse.urlencode({'aid': rnd.choice(aids), 'date': f'{date:%Y-%m-%d}'})
+    )
+
+
+def transaction_save(client: Client, rnd: random.Random, aids: list[str]) -> int:
+    src, dest = rnd.sample(aids, 2)
+    now = datetime.now()
+    form = {
+        'ops': json.dumps({'simple': [src, dest, rnd.randrange(100, 10000) / 100, 'USD']}),
+        'desc': 'Load test',
+        'date': f'{now:%Y-%m-%d}',
+        'date_time': f'{now:%H:%M:%S}',
+    }
+    return client.request('/transaction/edit?' + urllib.parse.urlencode({'dest': dest}), form)
+
+
+def import_transactions(client: Client, rnd: random.Random, aids: list[str]) -> int:
+    src = rnd.choice(aids)
+    now = time.time()
+    rows = [
+        {
+            'date': now - rnd.randrange(30 * 86400),
+            'amount': -rnd.randrange(100, 10000) / 100,
+            'cur': 'USD',
+            'dest': rnd.choice([it for it in aids if it != src]),
+            'name': 'Load test',
+            'desc': None,
+            'state': None,
+            'txkey': os.urandom(8).hex(),
+        }
+        for _ in range(IMPORT_ROWS)
+    ]
+    return client.request('/import/transactions', {'src': src, 'transactions': json.dumps(rows)})
+
+
+actions: dict[str, Callable[[Client, random.Random, list[str]], int]] = {
+    'account_view': account_view,
+    'balance': balance,
+    'transaction_save': transaction_save,
+    'import': import_transactions,
+}
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def summarize(samples: list[Sample], duration: float, concurrency: int, busy: Optional[int]) -> LoadReport:
+    by_action: dict[str, list[Sample]] = {}
+    for it in samples:
+        by_action.setdefault(it.action, []).append(it)
+
+    stats: dict[str, ActionStats] = {}
+    for name, items in sorted(by_action.items()):
+        latency = sorted(it.latency for it in items)
+        stats[name] = {
+            'count': len(items),
+            'errors': sum(1 for it in items if not 200 <= it.status < 400),
+            'p50': percentile(latency, 50),
+            'p95': percentile(latency, 95),
+            'p99': percentile(latency, 99),
+        }
+
+    return {
+        'duration': duration,
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'throughput': len(samples) / duration if duration else 0.0,
+        'busy': busy,
+        'actions': stats,
+    }
+
+
+def drive(
+    url: str, concurrency: int, duration: float, mix: dict[str, int], seed: int = 0
+) -> tuple[list[Sample], float]:
+    """Runs workers against a server, returns samples and actual duration"""
+    client = Client(url)
+    aids = list(client.json('/api/report?by=year')['result']['accounts'])
+    assert len(aids) > 1, 'ledger needs at least two accounts with transactions'
+
+    names = list(mix)
+    weights = [mix[it] for it in names]
+    samples: list[Sample] = []
+    start = time.monotonic()
+    deadline = start + duration
+
+    def worker(n: int) -> None:
+        rnd = random.Random(seed + n)
+        wclient = Client(url)
+        while time.monotonic() < deadline:
+            (name,) = rnd.choices(names, weights)
+            t = time.perf_counter()
+            status = actions[name](wclient, rnd, aids)
+            samples.append(Sample(name, time.perf_counter() - t, status))
+
+    threads = [threading.Thread(target=worker, args=(i,), name=f'wadwise-load-{i}') for i in range(concurrency)]
+    for it in threads:
+        it.start()
+    for it in threads:
+        it.join()
+    return samples, time.monotonic() - start
+
+
+def is_busy(error: object) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+def run_local(
+    concurrency: int, duration: float, mix: dict[str, int], transactions: int = 5000, seed: int = 0
+) -> LoadReport:
+    """Serves the app in-process on a synthetic ledger in a temporary directory and drives it"""
+    from flask import got_request_exception
+    from werkzeug.serving import make_server
+
+    from wadwise import web
+
+    busy = 0
+    lock = threading.Lock()
+
+    def on_exception(sender: object, exception: Exception, **extra: object) -> None:
+        nonlocal busy
+        if is_busy(exception):
+            with lock:
+                busy += 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Server threads don't see context of this one, switch the default database
+        prev_db, db.DB = db.DB, os.path.join(tmp, 'load.sqlite')
+        try:
+            make_ledger(transactions=transactions, seed=seed)
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            server = make_server('127.0.0.1', 0, web.app, threaded=True)
+            thread = threading.Thread(target=server.serve_forever, name='wadwise-load-server', daemon=True)
+            thread.start()
+            got_request_exception.connect(on_exception, web.app)
+            known_jobs = set(jobs.jobs)
+            try:
+                samples, elapsed = drive(f'http://127.0.0.1:{server.server_port}', concurrency, duration, mix, seed)
+                for it in list(jobs.jobs.values()):
+                    if it.id not in known_jobs:
+                        it.wait()
+                        busy += it.error is not None and ('locked' in it.error or 'busy' in it.error)
+            finally:
+                got_request_exception.disconnect(on_exception, web.app)
+                server.shutdown()
+        finally:
+            db.DB = prev_db
+
+    return summarize(samples, elapsed, concurrency, busy)
+
+
+def run(url: str, concurrency: int, duration: float, mix: dict[str, int], seed: int = 0) -> LoadReport:
+    """Drives an already running server, SQLITE_BUSY errors are not visible then"""
+    samples, elapsed = drive(url, concurrency, duration, mix, seed)
+    return summarize(samples, elapsed, concurrency, None)
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    """Parses `name=weight,...` mix specification"""
+    result = {}
+    for it in value.split(','):
+        name, _, weight = it.partition('=')
+        name = name.strip()
+        if name not in actions:
+            raise ValueError(f'Unknown action {name}, expected one of {", ".join(actions)}')
+        result[name] = int(weight or 1)
+    return result
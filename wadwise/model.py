@@ -1,21 +1,30 @@
 import json
+import logging
 import operator
-from collections.abc import Collection
+import re
+import sys
+from collections import Counter
+from collections.abc import Collection, Sequence
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Any, Iterable, Literal, Optional, TypedDict, Union, overload
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Any, Iterable, Iterator, Literal, NamedTuple, NotRequired, Optional, TypedDict, Union, cast, overload
 
-from sqlbind_t import VALUES, WHERE, E, in_range, not_none, sqlf, text
+from sqlbind_t import AND, VALUES, WHERE, E, in_range, join_fragments, sqlf, text
 
+from wadwise import jsonlib
 from wadwise.db import (
     QueryList,
+    attach_archive,
     delete,
     execute,
     execute_d,
     execute_raw,
+    execute_raw_many,
     gen_id,
     get_version,
     insert,
+    iterate,
     replace,
     select,
     set_version,
@@ -23,6 +32,8 @@ from wadwise.db import (
     update,
 )
 
+log = logging.getLogger(__name__)
+
 
 class Operation(TypedDict):
     aid: str
@@ -37,6 +48,7 @@ class TransactionRaw(TypedDict):
     desc: str
     ops: str
     meta: str | None
+    balance: NotRequired[str | None]
 
 
 class Transaction(TypedDict):
@@ -47,6 +59,7 @@ class Transaction(TypedDict):
     split: Literal[True]
     dest: str
     meta: Any | None
+    balance: NotRequired[dict[str, float]]
 
 
 class Transaction2(Transaction):
@@ -69,13 +82,6 @@ class Account(AccountB):
     aid: str
 
 
-class AccountExt(Account):
-    parents: tuple[str, ...]
-    is_sheet: bool
-    children: list[str]
-    full_name: str
-
-
 @dataclass(frozen=True)
 class Amount2:
     credit: float = 0
@@ -97,6 +103,85 @@ BState2 = dict[str, Amount2]
 Balance = dict[str, BState2]
 
 
+class AccountExt:
+    """Account map entry
+
+    Slots instead of a dict per account, names are interned, `parents` and
+    `full_name` are derived from the parent record on access.
+    """
+
+    __slots__ = ('aid', 'type', 'name', 'desc', 'parent', 'is_placeholder', 'is_hidden', 'children', 'up', '_full_name')
+
+    aid: str
+    type: str
+    name: str
+    desc: Optional[str]
+    parent: Optional[str]
+    is_placeholder: bool
+    is_hidden: bool | None
+    children: tuple[str, ...]
+    up: Optional['AccountExt']
+    _full_name: Optional[str]
+
+    def __init__(
+        self,
+        aid: str,
+        type: str,
+        name: str,
+        desc: Optional[str] = None,
+        parent: Optional[str] = None,
+        is_placeholder: bool = False,
+        is_hidden: bool | None = None,
+    ):
+        self.aid = aid
+        self.type = sys.intern(type)
+        self.name = sys.intern(name)
+        self.desc = desc
+        self.parent = parent
+        self.is_placeholder = is_placeholder
+        self.is_hidden = is_hidden
+        self.children = ()
+        self.up = None
+        self._full_name = None
+
+    @property
+    def is_sheet(self) -> bool:
+        return self.type in sheet_accounts
+
+    @property
+    def parents(self) -> tuple[str, ...]:
+        result = []
+        it = self.up
+        while it:
+            result.append(it.aid)
+            it = it.up
+        return tuple(reversed(result))
+
+    @property
+    def full_name(self) -> str:
+        if self._full_name is None:
+            self._full_name = self.up.full_name + ':' + self.name if self.up else self.name
+        return self._full_name
+
+    def to_json(self) -> dict[str, Any]:
+        if not self.aid:
+            # Joint pseudo-account
+            return {'name': self.name, 'full_name': self.full_name}
+        return {
+            'aid': self.aid,
+            'type': self.type,
+            'name': self.name,
+            'desc': self.desc,
+            'parent': self.parent,
+            'is_placeholder': self.is_placeholder,
+            'is_hidden': self.is_hidden,
+            'is_sheet': self.is_sheet,
+            'parents': self.parents,
+            'children': self.children,
+            'full_name': self.full_name,
+        }
+
+
 class AccountMap(dict[str, AccountExt]):
     top: list[str]
 
@@ -141,6 +226,7 @@ def create_account(
         is_placeholder=is_placeholder,
         is_hidden=is_hidden,
     )
+    _closure_insert(aid, parent)
     return aid
 
 
@@ -165,6 +251,7 @@ def update_account(
         is_placeholder=is_placeholder,
         is_hidden=is_hidden,
     )
+    _closure_move(aid, parent)
 
 
 @transaction()
@@ -177,65 +264,196 @@ def create_transaction(
     tid = gen_id()
     ts = int((date or datetime.now()).timestamp())
     insert('transactions', tid=tid, date=ts, desc=desc, meta=meta and json.dumps(meta) or None)
-    for op in ops:
-        insert('ops', tid=tid, aid=op['aid'], amount=round(op['amount'] * 100), cur=op['cur'], is_main=op['is_main'])
+    _insert_ops(tid, ts, ops)
+    _index_payee(tid)
     return tid
 
 
 @transaction()
 def update_transaction(
     tid: str, ops: Iterable[Operation], date: datetime, desc: Optional[str], meta: dict[str, Any] | None = None
-) -> None:
-    update(
-        'transactions', 'tid', tid=tid, date=int(date.timestamp()), desc=desc, meta=meta and json.dumps(meta) or None
-    )
-    delete('ops', tid=tid)
-    for op in ops:
-        insert('ops', tid=tid, aid=op['aid'], amount=round(op['amount'] * 100), cur=op['cur'])
+) -> set[str]:
+    """Replaces transaction, returns ids of accounts touched by old and new ops"""
+    ts = int(date.timestamp())
+    _index_payee(tid, -1)
+    update('transactions', 'tid', tid=tid, date=ts, desc=desc, meta=meta and json.dumps(meta) or None)
+    ops = list(ops)
+    aids = _delete_ops(tid)
+    _insert_ops(tid, ts, ops)
+    _index_payee(tid)
+    return aids | {op['aid'] for op in ops}
 
 
 @transaction()
-def delete_transaction(tid: str) -> None:
-    delete('ops', tid=tid)
+def delete_transaction(tid: str) -> set[str]:
+    """Deletes transaction, returns ids of accounts its ops touched"""
+    _index_payee(tid, -1)
+    aids = _delete_ops(tid)
     delete('transactions', tid=tid)
+    return aids
+
+
+def _insert_ops(tid: str, ts: int, ops: Iterable[Operation]) -> None:
+    """Writes ops resolving public ids into integer keys, unknown currencies are interned"""
+    ops = list(ops)
+    execute_raw_many('INSERT OR IGNORE INTO currencies (cur) VALUES (?)', [(it,) for it in {op['cur'] for op in ops}])
+    execute_raw_many(
+        """\
+            INSERT INTO ops (tx_id, n, acc_id, cur_id, amount, date, is_main)
+            VALUES (
+                (SELECT id FROM transactions WHERE tid = ?), ?,
+                (SELECT id FROM accounts WHERE aid = ?),
+                (SELECT id FROM currencies WHERE cur = ?),
+                ?, ?, ?
+            )
+        """,
+        [(tid, n, op['aid'], op['cur'], round(op['amount'] * 100), ts, op['is_main']) for n, op in enumerate(ops)],
+    )
+
+
+def _delete_ops(tid: str) -> set[str]:
+    aids = execute(
+        sqlf(f"""@\
+            SELECT DISTINCT a.aid FROM ops o INNER JOIN accounts a ON a.id = o.acc_id
+            WHERE o.tx_id = (SELECT id FROM transactions WHERE tid = {tid})
+        """)
+    ).column()
+    execute(sqlf(f'@DELETE FROM ops WHERE tx_id = (SELECT id FROM transactions WHERE tid = {tid})'))
+    return set(aids)
 
 
 def account_transactions(
-    *, start_date: datetime | None = None, end_date: datetime | None = None, aids: list[str] | None = None, **eq: object
+    *,
+    start_date: datetime | None = None,
+    end_date: datetime | None = None,
+    aids: list[str] | None = None,
+    tids: list[str] | None = None,
+    running: bool = False,
+    archived: bool = False,
+    subtree: bool = False,
+    limit: int | None = None,
+    offset: int = 0,
+    **eq: object,
 ) -> list[TransactionAny]:
-    cond = [in_range(E.t.date, start_date and start_date.timestamp(), end_date and end_date.timestamp())]
+    """Transactions touching given accounts, newest first
+
+    With `running` and `aid` each transaction gets a `balance` of the account
+    per currency after it, seeded from the balance at `start_date`.
+    With `subtree` `aid` also covers all its sub-accounts.
+    With `archived` transactions are read from the archive of closed years.
+    """
+    if archived:
+        attach_archive()
+        if not execute(text("SELECT 1 FROM archive.sqlite_master WHERE name = 'ops'")):
+            return []
+    schema = text('archive.' if archived else '')
+    start = start_date and start_date.timestamp()
+    end = end_date and end_date.timestamp()
+    cond = [in_range(E.t.date, start, end)]
+
+    page = sqlf(f'@LIMIT {limit} OFFSET {offset}') if limit is not None else text('')
+
+    acc_cond = []
+    has_aid = 'aid' in eq
+    aid: str = eq.pop('aid', None)  # type: ignore[assignment]
+    own = {aid}
+    if subtree and aid:
+        own = set(account_subtree(aid))
+        acc_cond.append(
+            sqlf(f"""@acc_id IN (
+                SELECT descendant FROM account_closure WHERE ancestor = (SELECT id FROM accounts WHERE aid = {aid})
+            )""")
+        )
+    elif has_aid:
+        acc_cond.append(sqlf(f'@acc_id = (SELECT id FROM accounts WHERE aid = {aid})'))
+    if aids is not None:
+        aids_json = json.dumps(aids)
+        acc_cond.append(
+            sqlf(f'@acc_id IN (SELECT id FROM accounts WHERE aid IN (SELECT value FROM json_each({aids_json})))')
+        )
+    if tids is not None:
+        tids_json = json.dumps(tids)
+        acc_cond.append(
+            sqlf(f"""@tx_id IN (
+                SELECT id FROM {schema}transactions WHERE tid IN (SELECT value FROM json_each({tids_json}))
+            )""")
+        )
+    if 'tid' in eq:
+        acc_cond.append(sqlf(f'@tx_id = (SELECT id FROM {schema}transactions WHERE tid = {eq.pop("tid")})'))
+    assert not eq, f'Unknown filters: {list(eq)}'
+
+    balance_cte = balance_field = balance_join = text('')
+    if running and aid:
+        seed_cond = E.date < start if start is not None else text('0')
+        balance_cte = sqlf(f"""@\
+            WITH seed AS (
+                SELECT cur_id, sum(amount) AS amount
+                FROM {schema}ops
+                {WHERE(seed_cond, *acc_cond)}
+                GROUP BY cur_id
+            ),
+            running AS (
+                SELECT tx_id, json_group_object(c.cur, balance) AS balance
+                FROM (
+                    SELECT tx_id, cur_id,
+                           (coalesce(seed.amount, 0) + sum(a.amount) OVER (PARTITION BY cur_id ORDER BY date, tx_id))
+                           / 100.0 AS balance
+                    FROM (
+                        SELECT tx_id, date, cur_id, sum(amount) AS amount
+                        FROM {schema}ops
+                        {WHERE(in_range(E.date, start, end), *acc_cond)}
+                        GROUP BY tx_id, cur_id
+                    ) a
+                    LEFT JOIN seed USING(cur_id)
+                )
+                INNER JOIN currencies c ON c.id = cur_id
+                GROUP BY tx_id
+            )
+        """)
+        balance_field = text(', running.balance AS balance')
+        balance_join = text('LEFT JOIN running ON running.tx_id = t.id')
+
     query = f"""@\
-        SELECT tid, date, desc, meta,
-               json_group_array(json_array(aid, amount/100.0, cur, is_main)) as ops
-        FROM (SELECT distinct(tid) FROM ops {WHERE(E.aid.IN(not_none / aids), **eq)})
-        INNER JOIN transactions t USING(tid)
-        INNER JOIN ops USING(tid)
+        {balance_cte}
+        SELECT t.tid, t.date, t.desc, t.meta,
+               json_group_array(json_array(a.aid, o.amount / 100.0, c.cur, o.is_main)) as ops
+               {balance_field}
+        FROM (SELECT DISTINCT tx_id FROM {schema}ops {WHERE(*acc_cond)}) f
+        INNER JOIN {schema}transactions t ON t.id = f.tx_id
+        INNER JOIN {schema}ops o ON o.tx_id = t.id
+        LEFT JOIN accounts a ON a.id = o.acc_id
+        LEFT JOIN currencies c ON c.id = o.cur_id
+        {balance_join}
         {WHERE(*cond)}
-        GROUP BY tid
-        ORDER BY date DESC
+        GROUP BY t.id
+        ORDER BY t.date DESC, t.id DESC
+        {page}
     """
     data: QueryList[TransactionRaw] = execute_d(sqlf(query))  # type: ignore[assignment]
 
-    aid: str = eq.pop('aid', None)  # type: ignore[assignment]
     by_amount = operator.itemgetter(1)
 
     result: list[TransactionAny] = []
     for it in data:
-        ops: list[tuple[str, float, str, bool]] = [tuple(op) for op in json.loads(it['ops'])]
+        ops: list[tuple[str, float, str, bool]] = [tuple(op) for op in jsonlib.loads(it['ops'])]
         curs = set(o[2] for o in ops)
         tr: TransactionAny = {
             'tid': it['tid'],
             'date': datetime.fromtimestamp(it['date']),
             'ops': sorted(ops, key=by_amount),
-            'split': len(ops) != 2 or len(curs) > 1,  # type: ignore[typeddict-item]
+            'split': len(ops) != 2 or len(curs) > 1 or all(o[0] in own for o in ops),  # type: ignore[typeddict-item]
             'dest': aid,
             'desc': it['desc'],
-            'meta': json.loads(it['meta']) if it['meta'] else None,
+            'meta': jsonlib.loads(it['meta']) if it['meta'] else None,
         }
 
+        if running:
+            balance = it.get('balance')
+            tr['balance'] = jsonlib.loads(balance) if balance else {}
+
         if not tr['split']:
-            tr['amount'] = sum(a for op_aid, a, _cur, _is_main in tr['ops'] if aid == op_aid)
-            tr['src'] = next(op_aid for op_aid, _a, _cur, _is_main in tr['ops'] if op_aid != aid)
+            tr['amount'] = sum(a for op_aid, a, _cur, _is_main in tr['ops'] if op_aid in own)
+            tr['src'] = next(op_aid for op_aid, _a, _cur, _is_main in tr['ops'] if op_aid not in own)
             tr['cur'] = list(curs)[0]
 
         result.append(tr)
@@ -243,30 +461,166 @@ def account_transactions(
     return result
 
 
+class ExportTransaction(NamedTuple):
+    tid: str
+    date: int
+    desc: str | None
+    ops: list[tuple[str, float, str]]
+
+
+def iter_transactions(
+    start: Optional[float] = None, end: Optional[float] = None, aids: Collection[str] | None = None
+) -> Iterator[ExportTransaction]:
+    """Streams all transactions ordered by date, ops are fetched row by row"""
+    cond = [in_range(E.t.date, start, end)]
+    if aids is not None:
+        aids_json = json.dumps(list(aids))
+        cond.append(
+            sqlf(f"""@t.id IN (
+                SELECT tx_id FROM ops
+                WHERE acc_id IN (SELECT id FROM accounts WHERE aid IN (SELECT value FROM json_each({aids_json})))
+            )""")
+        )
+    query = f"""@\
+        SELECT t.tid, t.date, t.desc, a.aid, o.amount / 100.0, c.cur
+        FROM transactions t
+        INNER JOIN ops o ON o.tx_id = t.id
+        INNER JOIN accounts a ON a.id = o.acc_id
+        INNER JOIN currencies c ON c.id = o.cur_id
+        {WHERE(*cond)}
+        ORDER BY t.date, t.id, o.n
+    """
+    for tid, rows in groupby(iterate(sqlf(query)), operator.itemgetter(0)):
+        first = next(rows)
+        ops = [first[3:]]
+        ops.extend(it[3:] for it in rows)
+        yield ExportTransaction(tid, first[1], first[2], ops)
+
+
 @transaction()
 def delete_account(aid: str, new_parent: Optional[str]) -> None:
     assert aid
+    children = [it['aid'] for it in select('accounts', 'aid', parent=aid)]
     update('accounts', 'parent', aid, parent=new_parent)
-    update('ops', 'aid', aid, aid=new_parent)
+    q = f"""@\
+        UPDATE ops SET acc_id = (SELECT id FROM accounts WHERE aid = {new_parent})
+        WHERE acc_id = (SELECT id FROM accounts WHERE aid = {aid})
+    """
+    execute(sqlf(q))
+    for it in children:
+        _closure_move(it, new_parent)
+    q = f"""@\
+        DELETE FROM account_closure
+        WHERE {aid} IN (SELECT aid FROM accounts WHERE id IN (ancestor, descendant))
+    """
+    execute(sqlf(q))
     delete('accounts', aid=aid)
 
 
+def _closure_insert(aid: str, parent: Optional[str]) -> None:
+    q = f"""@\
+        INSERT INTO account_closure (ancestor, descendant, depth)
+        SELECT ancestor, (SELECT id FROM accounts WHERE aid = {aid}), depth + 1
+        FROM account_closure WHERE descendant = (SELECT id FROM accounts WHERE aid = {parent})
+        UNION ALL
+        SELECT id, id, 0 FROM accounts WHERE aid = {aid}
+    """
+    execute(sqlf(q))
+
+
+def _closure_move(aid: str, parent: Optional[str]) -> None:
+    """Relinks subtree of aid under a new parent"""
+    subtree = sqlf(
+        f'@SELECT descendant FROM account_closure WHERE ancestor = (SELECT id FROM accounts WHERE aid = {aid})'
+    )
+    q = f"""@\
+        DELETE FROM account_closure
+        WHERE descendant IN ({subtree}) AND ancestor NOT IN ({subtree})
+    """
+    execute(sqlf(q))
+    q = f"""@\
+        INSERT INTO account_closure (ancestor, descendant, depth)
+        SELECT sup.ancestor, sub.descendant, sup.depth + sub.depth + 1
+        FROM account_closure sup, account_closure sub
+        WHERE sup.descendant = (SELECT id FROM accounts WHERE aid = {parent})
+              AND sub.ancestor = (SELECT id FROM accounts WHERE aid = {aid})
+    """
+    execute(sqlf(q))
+
+
+def rebuild_account_closure() -> None:
+    execute_raw('DELETE FROM account_closure')
+    execute_raw(
+        """\
+            INSERT INTO account_closure (ancestor, descendant, depth)
+            WITH RECURSIVE tree(ancestor, descendant, aid, depth) AS (
+                SELECT id, id, aid, 0 FROM accounts
+                UNION ALL
+                SELECT tree.ancestor, a.id, a.aid, tree.depth + 1
+                FROM tree INNER JOIN accounts a ON a.parent = tree.aid
+            )
+            SELECT ancestor, descendant, depth FROM tree
+        """
+    )
+
+
+def account_subtree(aid: str) -> list[str]:
+    """Account and all its descendants"""
+    q = f"""@\
+        SELECT a.aid
+        FROM account_closure c INNER JOIN accounts a ON a.id = c.descendant
+        WHERE c.ancestor = (SELECT id FROM accounts WHERE aid = {aid})
+        ORDER BY c.depth
+    """
+    return execute(sqlf(q)).column()
+
+
+def subtree_balance(start: Optional[float] = None, end: Optional[float] = None, aid: Optional[str] = None) -> Balance:
+    """Balance of every account including its sub-accounts, or of a single `aid` subtree"""
+    cond = [in_range(E.o.date, start, end)]
+    if aid:
+        cond.append(sqlf(f'@c.ancestor = (SELECT id FROM accounts WHERE aid = {aid})'))
+    query = f"""@\
+        SELECT a.aid, cu.cur, credit, debit
+        FROM (
+            SELECT c.ancestor, o.cur_id,
+                total(amount) FILTER (WHERE amount < 0) / 100.0 AS credit,
+                total(amount) FILTER (WHERE amount >= 0) / 100.0 AS debit
+            FROM account_closure c
+            INNER JOIN ops o ON o.acc_id = c.descendant
+            {WHERE(*cond)}
+            GROUP BY c.ancestor, o.cur_id
+        ) b
+        INNER JOIN accounts a ON a.id = b.ancestor
+        INNER JOIN currencies cu ON cu.id = b.cur_id
+    """
+    result: Balance = {}
+    for ancestor, cur, credit, debit in execute(sqlf(query)):
+        result.setdefault(ancestor, {})[cur] = Amount2(credit, debit)
+
+    return result
+
+
+# Public account fields, integer `id` is a storage detail
+ACCOUNT_FIELDS = 'aid, type, name, desc, parent, is_placeholder, is_hidden'
+
+
 def account_by_name(name: str) -> Optional[Account]:
     parent: Optional[Account] = None
     parts = name.split(':')
     for p in parts:
-        parent = select('accounts', '*', parent=parent and parent['aid'], name=p).first()  # type: ignore[assignment]
+        parent = select('accounts', ACCOUNT_FIELDS, parent=parent and parent['aid'], name=p).first()  # type: ignore[assignment]
         if not parent:
             return None
     return parent
 
 
 def account_by_id(aid: str) -> Optional[Account]:
-    return select('accounts', '*', aid=aid).first()  # type: ignore[return-value]
+    return select('accounts', ACCOUNT_FIELDS, aid=aid).first()  # type: ignore[return-value]
 
 
 def get_sub_accounts(parent: Optional[str]) -> QueryList[Account]:
-    return select('accounts', '*', parent=parent)  # type: ignore[return-value]
+    return select('accounts', ACCOUNT_FIELDS, parent=parent)  # type: ignore[return-value]
 
 
 @overload
@@ -286,45 +640,106 @@ def set_param(name: str, value: str) -> None:
     replace('params', name=name, value=value)
 
 
-def account_parents(aid: Optional[str], amap: AccountMap, cache: dict[str, tuple[str, ...]]) -> tuple[str, ...]:
-    if aid is None:
-        return ()
+CHANGES_KEEP_DAYS = 90
 
-    if aid in cache:
-        return cache[aid]
 
-    cur = amap[aid]
-    result = cache[aid] = account_parents(cur['parent'], amap, cache) + (aid,)
+class Changes(TypedDict):
+    version: int
+    reset: bool
+    accounts: dict[str, Optional[Account]]
+    transactions: dict[str, Optional[TransactionAny]]
+    params: dict[str, Optional[str]]
+
+
+def changes_version() -> int:
+    """Latest change journal version, it moves with every write to accounts, transactions and params"""
+    return execute(text('SELECT coalesce(max(version), 0) FROM changes')).scalar()  # type: ignore[no-any-return]
+
+
+def changes_since(since: int) -> Changes:
+    """Current state of entities changed after journal `since` version
+
+    Deleted entities map to None. With `reset` the journal doesn't reach back
+    to `since` and the client has to reload everything instead. Transactions
+    are always split, there is no account to take src/amount from.
+    """
+    version = changes_version()
+    rows = execute(sqlf(f'@SELECT DISTINCT kind, key FROM changes WHERE version > {since} AND version <= {version}'))
+    result: Changes = {'version': version, 'reset': False, 'accounts': {}, 'transactions': {}, 'params': {}}
+    keys: dict[str, list[str]] = {}
+    for kind, key in rows:
+        keys.setdefault(kind, []).append(key)
+
+    if '*' in keys:
+        result['reset'] = True
+        return result
+
+    if aids := keys.get('account'):
+        result['accounts'] = dict.fromkeys(aids)
+        aids_json = json.dumps(aids)
+        q = f'@SELECT {text(ACCOUNT_FIELDS)} FROM accounts WHERE aid IN (SELECT value FROM json_each({aids_json}))'
+        for it in execute_d(sqlf(q)):
+            result['accounts'][it['aid']] = it  # type: ignore[assignment]
+
+    if tids := keys.get('transaction'):
+        result['transactions'] = dict.fromkeys(tids)
+        for tx in account_transactions(tids=tids):
+            if not tx['split']:
+                # Listed without an account, src and amount would be taken from an arbitrary side
+                tx = cast(Transaction, {k: v for k, v in tx.items() if k not in ('src', 'amount', 'cur')})
+                tx['split'] = True
+            result['transactions'][tx['tid']] = tx
+
+    if names := keys.get('param'):
+        result['params'] = dict.fromkeys(names)
+        names_json = json.dumps(names)
+        q = f'@SELECT name, value FROM params WHERE name IN (SELECT value FROM json_each({names_json}))'
+        result['params'].update(execute(sqlf(q)))
+
     return result
 
 
+@transaction()
+def compact_changes(keep_days: int = CHANGES_KEEP_DAYS) -> int:
+    """Drops journal rows superseded by newer ones for the same entity and rows older than `keep_days`
+
+    Old rows are replaced with a single reset marker at the last dropped
+    version. Returns number of dropped rows.
+    """
+    dropped = execute_raw("""\
+        DELETE FROM changes
+        WHERE version < (SELECT max(version) FROM changes c WHERE c.kind = changes.kind AND c.key IS changes.key)
+    """).rowcount
+
+    cutoff = int(datetime.now().timestamp()) - keep_days * 86400
+    last = execute(sqlf(f'@SELECT max(version) FROM changes WHERE date < {cutoff}')).scalar()
+    if last is not None:
+        dropped += execute(sqlf(f'@DELETE FROM changes WHERE version <= {last}')).rowcount - 1
+        execute(sqlf(f"@INSERT INTO changes (version, kind, date) VALUES ({last}, '*', {cutoff})"))
+    return dropped
+
+
 def account_list() -> AccountMap:
-    all_accounts: QueryList[AccountExt] = execute_d(text('SELECT * FROM accounts'))  # type: ignore[assignment]
-    amap = AccountMap({it['aid']: it for it in all_accounts})
-    amap[None] = {}  # type: ignore[typeddict-item,index]
+    amap = AccountMap(
+        (row[0], AccountExt(*row)) for row in execute_raw(f'SELECT {ACCOUNT_FIELDS} FROM accounts ORDER BY name')
+    )
 
-    cache: dict[str, tuple[str, ...]] = {}
-    for it in amap.values():
-        if not it.get('aid'):
-            continue
-        it['is_sheet'] = it['type'] in sheet_accounts
-        it['parents'] = account_parents(it['parent'], amap, cache)
-        it.setdefault('children', [])
-        amap[it['parent']].setdefault('children', []).append(it['aid'])  # type: ignore[index]
-
-    sk = lambda x: amap[x]['name']
-    for v in amap.values():
-        v['children'].sort(key=sk)
-
-    amap.top = amap.pop(None)['children']  # type: ignore[call-overload]
+    # Rows are sorted by name, so are children
+    children: dict[Optional[str], list[str]] = {}
     for it in amap.values():
-        if not it.get('aid'):
-            continue
-        it['full_name'] = ':'.join([amap[p]['name'] for p in it['parents']] + [it['name']])
+        children.setdefault(it.parent, []).append(it.aid)
+        if it.parent:
+            it.up = amap[it.parent]
+
+    for aid, items in children.items():
+        if aid:
+            amap[aid].children = tuple(items)
+    amap.top = children.get(None, [])
 
     for jacc in get_joint_accounts().values():
         pacc = amap[jacc['parent']]
-        amap[pacc['aid'] + '.joint'] = {'name': pacc['name'] + ' (joint)', 'full_name': pacc['full_name'] + ' (joint)'}  # type: ignore[typeddict-item]
+        joint = amap[pacc.aid + '.joint'] = AccountExt('', pacc.type, pacc.name + ' (joint)')
+        joint._full_name = pacc.full_name + ' (joint)'
 
     return amap
 
@@ -346,13 +761,17 @@ def dop2(a1: str, a2: str, amount: float, currency: str) -> Collection[Operation
 
 def balance(start: Optional[float] = None, end: Optional[float] = None) -> Balance:
     query = f"""@\
-        SELECT aid, cur,
-            total(amount) FILTER (WHERE amount < 0) / 100.0 AS credit,
-            total(amount) FILTER (WHERE amount >= 0) / 100.0 AS debit
-        FROM transactions AS t
-        INNER JOIN ops t USING (tid)
-        {WHERE(in_range(E.t.date, start, end))}
-        GROUP BY aid, cur
+        SELECT a.aid, c.cur, credit, debit
+        FROM (
+            SELECT acc_id, cur_id,
+                total(amount) FILTER (WHERE amount < 0) / 100.0 AS credit,
+                total(amount) FILTER (WHERE amount >= 0) / 100.0 AS debit
+            FROM ops
+            {WHERE(in_range(E.date, start, end))}
+            GROUP BY acc_id, cur_id
+        ) b
+        INNER JOIN accounts a ON a.id = b.acc_id
+        INNER JOIN currencies c ON c.id = b.cur_id
     """
     data = execute_d(sqlf(query))
 
@@ -363,6 +782,157 @@ def balance(start: Optional[float] = None, end: Optional[float] = None) -> Balan
     return result
 
 
+Range = tuple[Optional[float], Optional[float]]
+
+
+def multi_balance(ranges: dict[str, Range]) -> dict[str, Balance]:
+    """Balances for several [start, end) ranges in a single scan using conditional aggregation
+
+    An account gets into a range balance only if it has ops inside the range, same as `balance`.
+    """
+    fields = []
+    for start, end in ranges.values():
+        cond = AND(text('1'), in_range(E.date, start, end))
+        fields.append(
+            sqlf(f"""@\
+                count(1) FILTER (WHERE {cond}),
+                total(amount) FILTER (WHERE {AND(E.amount < 0, cond)}) / 100.0,
+                total(amount) FILTER (WHERE {AND(E.amount >= 0, cond)}) / 100.0
+            """)
+        )
+
+    # Scan only the union of all ranges
+    starts = [it[0] for it in ranges.values()]
+    ends = [it[1] for it in ranges.values()]
+    scan = in_range(
+        E.date,
+        None if None in starts else min(starts),  # type: ignore[type-var]
+        None if None in ends else max(ends),  # type: ignore[type-var]
+    )
+
+    query = f"""@\
+        SELECT a.aid, c.cur, b.*
+        FROM (
+            SELECT {join_fragments(', ', fields)}, acc_id, cur_id
+            FROM ops
+            {WHERE(scan)}
+            GROUP BY acc_id, cur_id
+        ) b
+        INNER JOIN accounts a ON a.id = b.acc_id
+        INNER JOIN currencies c ON c.id = b.cur_id
+    """
+    names = list(ranges)
+    result: dict[str, Balance] = {it: {} for it in names}
+    for aid, cur, *values in execute(sqlf(query)):
+        values = values[:-2]
+        for idx, name in enumerate(names):
+            count, credit, debit = values[idx * 3 : idx * 3 + 3]
+            if count:
+                result[name].setdefault(aid, {})[cur] = Amount2(credit, debit)
+
+    return result
+
+
+PERIODS = {
+    'week': "date(date, 'unixepoch', 'localtime', 'weekday 0', '-6 days')",
+    'month': "strftime('%Y-%m', date, 'unixepoch', 'localtime')",
+    'quarter': "strftime('%Y-Q', date, 'unixepoch', 'localtime')"
+    " || ((strftime('%m', date, 'unixepoch', 'localtime') + 2) / 3)",
+    'year': "strftime('%Y', date, 'unixepoch', 'localtime')",
+}
+
+
+def period_balance(by: str, start: Optional[float] = None, end: Optional[float] = None) -> dict[str, Balance]:
+    """Balances bucketed by period (see PERIODS) in a single grouped scan"""
+    query = f"""@\
+        SELECT period, a.aid, c.cur, credit, debit
+        FROM (
+            SELECT {text(PERIODS[by])} AS period, acc_id, cur_id,
+                total(amount) FILTER (WHERE amount < 0) / 100.0 AS credit,
+                total(amount) FILTER (WHERE amount >= 0) / 100.0 AS debit
+            FROM ops
+            {WHERE(in_range(E.date, start, end))}
+            GROUP BY period, acc_id, cur_id
+        ) b
+        INNER JOIN accounts a ON a.id = b.acc_id
+        INNER JOIN currencies c ON c.id = b.cur_id
+        ORDER BY period
+    """
+    result: dict[str, Balance] = {}
+    for period, aid, cur, credit, debit in execute(sqlf(query)):
+        result.setdefault(period, {}).setdefault(aid, {})[cur] = Amount2(credit, debit)
+
+    return result
+
+
+SERIES_STEPS = {
+    'day': "date(date, 'unixepoch', 'localtime')",
+    'week': PERIODS['week'],
+    'month': PERIODS['month'],
+}
+
+
+class Series(TypedDict):
+    step: str
+    periods: list[str]
+    values: dict[str, list[float]]
+
+
+def series_periods(step: str, start: datetime, end: datetime) -> list[str]:
+    """Period labels matching SERIES_STEPS expressions for [start, end)"""
+    day = datetime.combine(start.date(), datetime.min.time())
+    if step == 'week':
+        day -= timedelta(days=day.weekday())
+    elif step == 'month':
+        day = day.replace(day=1)
+
+    result = []
+    while day < end:
+        if step == 'month':
+            result.append(day.strftime('%Y-%m'))
+            day = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            result.append(day.date().isoformat())
+            day += timedelta(days=7 if step == 'week' else 1)
+    return result
+
+
+def balance_series(aid: str, step: str, start: datetime, end: datetime) -> Series:
+    """Balance of `aid` subtree at the end of each step period in [start, end)
+
+    A single windowed pass: ops before `start` are folded into a seed
+    bucket and a running sum over period buckets gives balances. Periods
+    without movements repeat the previous value.
+    """
+    sts = start.timestamp()
+    query = f"""@\
+        SELECT period, c.cur, sum(amount) OVER (PARTITION BY cur_id ORDER BY period) / 100.0
+        FROM (
+            SELECT iif(date < {sts}, '', {text(SERIES_STEPS[step])}) AS period, cur_id, sum(amount) AS amount
+            FROM ops
+            WHERE acc_id IN (
+                SELECT descendant FROM account_closure WHERE ancestor = (SELECT id FROM accounts WHERE aid = {aid})
+            ) AND date < {end.timestamp()}
+            GROUP BY period, cur_id
+        ) b
+        INNER JOIN currencies c ON c.id = b.cur_id
+    """
+    balances: dict[str, dict[str, float]] = {}
+    for period, cur, value in execute(sqlf(query)):
+        balances.setdefault(cur, {})[period] = value
+
+    periods = series_periods(step, start, end)
+    values: dict[str, list[float]] = {}
+    for cur, points in sorted(balances.items()):
+        last = points.get('', 0.0)
+        column = values[cur] = []
+        for p in periods:
+            last = points.get(p, last)
+            column.append(last)
+
+    return {'step': step, 'periods': periods, 'values': values}
+
+
 def combine_balances(*balances: Balance) -> Balance:  # pragma: no cover
     result: Balance = {}
     for b in balances:
@@ -444,7 +1014,7 @@ class Joint:
 
 
 def get_joint_accounts() -> dict[str, JointAccount]:
-    accs: list[JointAccount] = json.loads(get_param('accounts.joint') or '[]') or []
+    accs: list[JointAccount] = jsonlib.loads(get_param('accounts.joint') or '[]') or []
     return {it['parent']: it for it in accs}
 
 
@@ -457,11 +1027,16 @@ def decode_account_id(aid: str) -> tuple[str, str]:
     return aid, typ
 
 
-def seen_transactions(aid: str, start: datetime | None = None, end: datetime | None = None) -> set[str]:
+def seen_transactions(
+    aid: str, start: datetime | None = None, end: datetime | None = None, keys: Collection[str] | None = None
+) -> set[str]:
+    cond = [in_range(E.date, start and start.timestamp(), end and end.timestamp())]
+    if keys is not None:
+        cond.append(sqlf(f'@key IN (SELECT value FROM json_each({json.dumps(list(keys))}))'))
     q = f"""@\
         SELECT key
         FROM seen_transactions
-        {WHERE(in_range(E.date, start and start.timestamp(), end and end.timestamp()), aid=aid)}
+        {WHERE(*cond, aid=aid)}
     """
     return set(execute(sqlf(q)).column())
 
@@ -470,12 +1045,267 @@ def seen_tx_key(dt: datetime, amount: float, currency: str) -> str:
     return f'{int(dt.timestamp())}-{amount:.2f}-{currency}'
 
 
+def parse_tx_key(key: str) -> Optional[tuple[int, int, str]]:
+    """Splits `seen_tx_key` into timestamp, amount in cents and currency"""
+    ts, _, rest = key.partition('-')
+    amount, _, cur = rest.rpartition('-')
+    try:
+        return int(ts), round(float(amount) * 100), cur
+    except ValueError:
+        return None
+
+
+def imported_transactions(aids: Collection[str], keys: Collection[str]) -> set[str]:
+    """Returns subset of keys already recorded as ops of given accounts"""
+    parsed = [(*it, key) for key in keys if (it := parse_tx_key(key))]
+    aids_json = json.dumps(list(aids))
+    q = f"""@\
+        SELECT DISTINCT k.value ->> 3
+        FROM json_each({json.dumps(parsed)}) k
+        INNER JOIN currencies c ON c.cur = k.value ->> 2
+        WHERE EXISTS (
+            SELECT 1 FROM ops o
+            WHERE o.acc_id IN (SELECT id FROM accounts WHERE aid IN (SELECT value FROM json_each({aids_json})))
+                  AND o.date = k.value ->> 0 AND o.amount = k.value ->> 1 AND o.cur_id = c.id
+        )
+    """
+    return set(execute(sqlf(q)).column())
+
+
 @transaction()
 def update_seen_transactions(aid: str, date: datetime, keys: Iterable[str]) -> None:
-    existing = seen_transactions(aid)
-    new = set(keys) - existing
-    for key in new:
-        insert('seen_transactions', aid=aid, date=date.timestamp(), key=key)
+    q = f"""@\
+        INSERT OR IGNORE INTO seen_transactions (aid, key, date)
+        SELECT {aid}, value, {date.timestamp()} FROM json_each({json.dumps(list(keys))})
+    """
+    execute(sqlf(q))
+
+
+PayeeKey = tuple[str, str, str]  # src aid, term, dest aid
+
+
+def payee_terms(name: Optional[str], category: Optional[str] = None) -> list[str]:
+    """Index terms of an import row: normalized payee name first, then category"""
+    result = []
+    if name and (norm := re.sub(r'[\W\d_]+', ' ', name.lower()).strip()):
+        result.append('n:' + norm)
+    if category:
+        result.append('c:' + category.strip().lower())
+    return result
+
+
+def _payee_upsert(counts: Counter[PayeeKey], last: dict[PayeeKey, int]) -> None:
+    execute_raw_many(
+        """\
+            INSERT INTO payee_index (src_id, term, acc_id, count, last)
+            SELECT s.id, ?, d.id, ?, ? FROM accounts s, accounts d WHERE s.aid = ? AND d.aid = ?
+            ON CONFLICT DO UPDATE SET count = count + excluded.count, last = max(last, excluded.last)
+        """,
+        [(term, cnt, last[src, term, dest], src, dest) for (src, term, dest), cnt in counts.items()],
+    )
+
+
+def _payee_history(cond: str = '', params: Sequence[Any] = ()) -> tuple[Counter[PayeeKey], dict[PayeeKey, int]]:
+    """Description terms of two-op transactions in both directions"""
+    q = f"""\
+        SELECT t.desc, t.date, a1.aid, a2.aid
+        FROM transactions t
+        INNER JOIN ops o1 ON o1.tx_id = t.id AND o1.n = 0
+        INNER JOIN ops o2 ON o2.tx_id = t.id AND o2.n = 1
+        INNER JOIN accounts a1 ON a1.id = o1.acc_id
+        INNER JOIN accounts a2 ON a2.id = o2.acc_id
+        WHERE t.desc IS NOT NULL AND NOT EXISTS (SELECT 1 FROM ops o3 WHERE o3.tx_id = t.id AND o3.n = 2) {cond}
+    """
+    counts: Counter[PayeeKey] = Counter()
+    last: dict[PayeeKey, int] = {}
+    for desc, date, a1, a2 in execute_raw(q, list(params)):
+        for term in payee_terms(desc):
+            for key in ((a1, term, a2), (a2, term, a1)):
+                counts[key] += 1
+                last[key] = max(last.get(key, 0), date)
+    return counts, last
+
+
+@transaction()
+def rebuild_payee_index() -> None:
+    """Fills payee index from descriptions of two-op transactions in both directions
+
+    Replaces the whole index, terms learned by `update_payee_index` (import
+    names and categories) are lost. Only meant for the initial fill, later
+    transactions are indexed by `create_transaction` and friends.
+    """
+    counts, last = _payee_history()
+    execute_raw('DELETE FROM payee_index')
+    _payee_upsert(counts, last)
+
+
+def _index_payee(tid: str, sign: int = 1) -> None:
+    """Adds (1) or removes (-1) description terms of transaction `tid`"""
+    counts, last = _payee_history('AND t.tid = ?', [tid])
+    if not counts:
+        return
+    if sign < 0:
+        counts = Counter({key: -cnt for key, cnt in counts.items()})
+    _payee_upsert(counts, last)
+    if sign < 0:
+        srcs = json.dumps(list({src for src, _, _ in counts}))
+        execute_raw(
+            """\
+                DELETE FROM payee_index
+                WHERE src_id IN (SELECT id FROM accounts WHERE aid IN (SELECT value FROM json_each(?))) AND count <= 0
+            """,
+            [srcs],
+        )
+
+
+def update_payee_index(src: str, rows: Iterable[tuple[Optional[str], Optional[str], str, int]]) -> None:
+    """Counts imported (name, category, dest, date) rows of `src` account
+
+    Names are indexed both ways like history is, categories only from `src`.
+    """
+    counts: Counter[PayeeKey] = Counter()
+    last: dict[PayeeKey, int] = {}
+    for name, category, dest, date in rows:
+        for term in payee_terms(name, category):
+            keys = [(src, term, dest)]
+            if term.startswith('n:'):
+                keys.append((dest, term, src))
+            for key in keys:
+                counts[key] += 1
+                last[key] = max(last.get(key, 0), date)
+    _payee_upsert(counts, last)
+
+
+def payee_suggestions(src: str, terms: Iterable[str]) -> dict[str, list[tuple[str, int]]]:
+    """Destination accounts with frequencies per term, most likely first"""
+    q = f"""@\
+        SELECT p.term, a.aid, p.count
+        FROM payee_index p INNER JOIN accounts a ON a.id = p.acc_id
+        WHERE p.src_id = (SELECT id FROM accounts WHERE aid = {src})
+              AND p.term IN (SELECT value FROM json_each({json.dumps(list(set(terms)))}))
+        ORDER BY p.term, p.count DESC, p.last DESC
+    """
+    result: dict[str, list[tuple[str, int]]] = {}
+    for term, aid, count in execute(sqlf(q)):
+        result.setdefault(term, []).append((aid, count))
+    return result
+
+
+def get_rates() -> QueryList[tuple[str, int, float]]:
+    return execute(text('SELECT cur, date, rate FROM rates ORDER BY cur, date'))
+
+
+@transaction()
+def set_rates(rows: Iterable[tuple[str, int, float]]) -> int:
+    cur = execute_raw_many('INSERT OR REPLACE INTO rates (cur, date, rate) VALUES (?, ?, ?)', rows)
+    set_param('rates.version', gen_id())
+    return cur.rowcount
+
+
+def rates_version() -> Optional[str]:
+    """Changes with every `set_rates`, also from other processes like `load-rates`"""
+    return get_param('rates.version')
+
+
+def _report_lost_ops() -> None:
+    """Keeps ops_lost table, filled by integer keys conversion, only when it isn't empty"""
+    count = execute_raw('SELECT count(1) FROM ops_lost').fetchone()[0]
+    if count:
+        log.warning('%d ops refer to missing transactions or accounts, they are kept in ops_lost', count)
+    else:
+        execute_raw('DROP TABLE ops_lost')
+
+
+def _archive_table(name: str) -> str:
+    """Creates archive table with the same definition, keys included, as the main one
+
+    Columns added to the main table later are added to the archive one on the next close.
+    """
+    cols = [it[1] for it in execute_raw(f'pragma main.table_info({name})')]
+    existing = {it[1] for it in execute_raw(f'pragma archive.table_info({name})')}
+    if not existing:
+        sql = execute(sqlf(f"@SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = {name}")).scalar()
+        execute_raw(re.sub(r'^CREATE TABLE "?\w+"?', f'CREATE TABLE archive.{name}', sql))
+    for col in cols:
+        if existing and col not in existing:
+            execute_raw(f'ALTER TABLE archive.{name} ADD COLUMN {col}')
+    return ', '.join(cols)
+
+
+RETAINED_EARNINGS = 'Retained earnings'
+
+
+def _retained_earnings() -> str:
+    """Equity account income and expenses are closed into, created on first use"""
+    q = f'@SELECT aid FROM accounts WHERE parent IS NULL AND type = {AccType.EQUITY} ORDER BY id LIMIT 1'
+    root = execute(sqlf(q)).scalar() or create_account(None, 'Equity', AccType.EQUITY)
+    aid = execute(sqlf(f'@SELECT aid FROM accounts WHERE parent = {root} AND name = {RETAINED_EARNINGS}')).scalar()
+    return aid or create_account(root, RETAINED_EARNINGS, AccType.EQUITY)
+
+
+def close_year(year: int, desc: str = 'Opening balance') -> int:
+    """Moves transactions up to the end of year into archive database
+
+    Closing totals of balance sheet accounts are kept as opening-balance
+    transactions (one per currency) dated by the last second of the year.
+    Income and expense totals are closed into the RETAINED_EARNINGS equity
+    account, so they start from zero and the closed December isn't inflated
+    by lifetime totals. Balance sheet accounts keep their balances, per
+    currency leftovers of exchanges are posted to RETAINED_EARNINGS too.
+    """
+    end = datetime(year + 1, 1, 1)
+    ts = int(end.timestamp())
+    attach_archive()
+    with transaction():
+        closing = balance(end=ts)
+
+        tcols = _archive_table('transactions')
+        ocols = _archive_table('ops')
+        execute_raw('CREATE INDEX IF NOT EXISTS archive.idx_ops_acc_date ON ops (acc_id, date)')
+        execute_raw('CREATE INDEX IF NOT EXISTS archive.idx_transactions_date ON transactions (date)')
+
+        closed = 'SELECT id FROM main.transactions WHERE date < :end'
+        params = {'end': ts}
+        execute_raw(f'INSERT INTO archive.ops ({ocols}) SELECT {ocols} FROM main.ops WHERE tx_id IN ({closed})', params)
+        count = execute_raw(
+            f'INSERT INTO archive.transactions ({tcols}) SELECT {tcols} FROM main.transactions WHERE date < :end',
+            params,
+        ).rowcount
+        execute_raw(f'DELETE FROM main.ops WHERE tx_id IN ({closed})', params)
+        execute_raw('DELETE FROM main.transactions WHERE date < :end', params)
+
+        types: dict[str, str] = dict(execute(text('SELECT aid, type FROM accounts')))
+        retained = None
+        if any(types[aid] not in sheet_accounts for aid in closing):
+            retained = _retained_earnings()
+
+        # In cents, so per currency leftovers are exact
+        totals: dict[tuple[str, str], int] = {}
+        for aid, state in closing.items():
+            dest = aid if types[aid] in sheet_accounts else retained
+            assert dest
+            for cur, amount in state.items():
+                totals[dest, cur] = totals.get((dest, cur), 0) + round(amount.sum * 100)
+
+        # Currency exchanges leave a per currency leftover, it goes to equity
+        # to keep every opening transaction balanced
+        leftovers: dict[str, int] = {}
+        for (aid, cur), value in totals.items():
+            leftovers[cur] = leftovers.get(cur, 0) + value
+        for cur, value in leftovers.items():
+            if value:
+                retained = retained or _retained_earnings()
+                totals[retained, cur] = totals.get((retained, cur), 0) - value
+
+        by_cur: dict[str, list[Operation]] = {}
+        for (aid, cur), value in totals.items():
+            if value:
+                by_cur.setdefault(cur, []).append(op(aid, value / 100, cur))
+
+        for cur, ops in sorted(by_cur.items()):
+            create_transaction(ops, datetime.fromtimestamp(ts - 1), f'{desc} {year + 1}')
+
+    return count
 
 
 @transaction()
@@ -558,6 +1388,173 @@ def create_tables() -> None:
     for _ in version(5):
         execute_raw('ALTER TABLE transactions ADD COLUMN meta TEXT')
 
+    for _ in version(6):
+        # Was ops.fp import fingerprint, v10 dropped it: duplicates are matched on (acc_id, date) of ops
+        pass
+
+    for _ in version(7):
+        execute_raw(
+            """\
+                CREATE TABLE rates (
+                    cur TEXT NOT NULL,
+                    date INTEGER NOT NULL,
+                    rate REAL NOT NULL,
+                    PRIMARY KEY (cur, date)
+                ) WITHOUT ROWID
+            """
+        )
+
+    for _ in version(8):
+        # Was ops.date on text keys, v10 creates ops with the date column
+        pass
+
+    for _ in version(9):
+        # Was account_closure on text keys, v10 creates it with integer keys
+        pass
+
+    for _ in version(10):
+        # Integer surrogate keys: public tid/aid stay in transactions/accounts,
+        # ops reference rows by id and currencies are interned
+        stmts = """\
+            CREATE TABLE currencies (
+                id INTEGER PRIMARY KEY,
+                cur TEXT NOT NULL UNIQUE
+            );
+
+            INSERT INTO currencies (cur) SELECT DISTINCT cur FROM ops ORDER BY cur;
+
+            ALTER TABLE accounts RENAME TO accounts_old;
+
+            CREATE TABLE accounts (
+                id INTEGER PRIMARY KEY,
+                aid TEXT NOT NULL UNIQUE,
+                type TEXT NOT NULL,
+                name TEXT NOT NULL,
+                desc TEXT,
+                parent TEXT,
+                is_placeholder INTEGER NOT NULL DEFAULT 0,
+                is_hidden INTEGER
+            );
+
+            INSERT INTO accounts (aid, type, name, desc, parent, is_placeholder, is_hidden)
+            SELECT aid, type, name, desc, parent, is_placeholder, is_hidden FROM accounts_old ORDER BY rowid;
+
+            DROP TABLE accounts_old;
+
+            CREATE UNIQUE INDEX idx_accounts_uniq_name ON accounts (parent, name);
+
+            ALTER TABLE transactions RENAME TO transactions_old;
+
+            CREATE TABLE transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tid TEXT NOT NULL UNIQUE,
+                date INTEGER NOT NULL,
+                desc TEXT,
+                meta TEXT
+            );
+
+            INSERT INTO transactions (tid, date, desc, meta)
+            SELECT tid, date, desc, meta FROM transactions_old ORDER BY date, tid;
+
+            DROP TABLE transactions_old;
+
+            CREATE INDEX idx_transactions_date ON transactions (date);
+
+            ALTER TABLE ops RENAME TO ops_old;
+
+            CREATE TABLE ops (
+                tx_id INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                acc_id INTEGER NOT NULL,
+                cur_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                date INTEGER NOT NULL,
+                is_main INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (tx_id, n)
+            ) WITHOUT ROWID;
+
+            INSERT INTO ops (tx_id, n, acc_id, cur_id, amount, date, is_main)
+            SELECT t.id, row_number() OVER (PARTITION BY t.id ORDER BY o.rowid) - 1,
+                   a.id, c.id, o.amount, t.date, coalesce(o.is_main, 1)
+            FROM ops_old o
+            INNER JOIN transactions t ON t.tid = o.tid
+            INNER JOIN accounts a ON a.aid = o.aid
+            INNER JOIN currencies c ON c.cur = o.cur;
+
+            CREATE TABLE ops_lost AS
+            SELECT * FROM ops_old o
+            WHERE NOT EXISTS (SELECT 1 FROM transactions t WHERE t.tid = o.tid)
+                  OR NOT EXISTS (SELECT 1 FROM accounts a WHERE a.aid = o.aid);
+
+            DROP TABLE ops_old;
+
+            CREATE INDEX idx_ops_acc_date ON ops (acc_id, date);
+
+            CREATE INDEX idx_ops_date ON ops (date, acc_id, cur_id, amount);
+
+            CREATE TABLE account_closure (
+                ancestor INTEGER NOT NULL,
+                descendant INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                PRIMARY KEY (ancestor, descendant)
+            ) WITHOUT ROWID;
+
+            CREATE INDEX idx_account_closure_descendant ON account_closure (descendant)
+        """
+        for q in stmts.split(';\n'):
+            execute_raw(q)
+        _report_lost_ops()
+        rebuild_account_closure()
+
+    for _ in version(11):
+        # Change journal filled by triggers, survives drop_tables
+        execute_raw(
+            """\
+                CREATE TABLE IF NOT EXISTS changes (
+                    version INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    key TEXT,
+                    date INTEGER NOT NULL
+                )
+            """
+        )
+        execute_raw('CREATE INDEX IF NOT EXISTS idx_changes_key ON changes (kind, key)')
+        for table, kind, key in (
+            ('accounts', 'account', 'aid'),
+            ('transactions', 'transaction', 'tid'),
+            ('params', 'param', 'name'),
+        ):
+            for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+                execute_raw(f"""\
+                    CREATE TRIGGER changes_{table}_{event.lower()} AFTER {event} ON {table} BEGIN
+                        INSERT INTO changes (kind, key, date) VALUES ('{kind}', {row}.{key}, unixepoch());
+                    END
+                """)
+        # Ops are moved to another account by delete_account
+        execute_raw("""\
+            CREATE TRIGGER changes_ops_update AFTER UPDATE OF acc_id ON ops BEGIN
+                INSERT INTO changes (kind, key, date)
+                SELECT 'transaction', tid, unixepoch() FROM transactions WHERE id = NEW.tx_id;
+            END
+        """)
+        # Clients synced before this point have to reload everything
+        execute_raw("INSERT INTO changes (kind, date) VALUES ('*', unixepoch())")
+
+    for _ in version(12):
+        execute_raw(
+            """\
+                CREATE TABLE payee_index (
+                    src_id INTEGER NOT NULL,
+                    term TEXT NOT NULL,
+                    acc_id INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    last INTEGER NOT NULL,
+                    PRIMARY KEY (src_id, term, acc_id)
+                ) WITHOUT ROWID
+            """
+        )
+        rebuild_payee_index()
+
 
 def create_initial_accounts() -> None:
     if execute(text('SELECT count(1) from accounts')).scalar(0) > 0:
@@ -572,6 +1569,7 @@ def create_initial_accounts() -> None:
     ]
     for aid, name in initial_accounts:
         execute(sqlf(f'@INSERT OR IGNORE INTO accounts {VALUES(aid=aid, type=aid, name=name)}'))
+        execute(sqlf(f'@INSERT OR IGNORE INTO account_closure SELECT id, id, 0 FROM accounts WHERE aid = {aid}'))
 
 
 @transaction()
@@ -581,4 +1579,10 @@ def drop_tables() -> None:
     execute_raw('DROP TABLE IF EXISTS ops')
     execute_raw('DROP TABLE IF EXISTS params')
     execute_raw('DROP TABLE IF EXISTS seen_transactions')
+    execute_raw('DROP TABLE IF EXISTS rates')
+    execute_raw('DROP TABLE IF EXISTS account_closure')
+    execute_raw('DROP TABLE IF EXISTS currencies')
+    execute_raw('DROP TABLE IF EXISTS payee_index')
+    execute_raw('DROP TABLE IF EXISTS ops_lost')
+    # changes stay to keep versions monotonic, create_tables marks the reset
     set_version(0)
@@ -1,46 +1,15 @@
-import csv
 from collections.abc import Collection
 from datetime import datetime
-from typing import IO, Literal, TypedDict
+from typing import IO, NotRequired, TypedDict
 
-from .model import Operation, account_by_id, create_transaction, decode_account_id, dop2
-
-FMT = '%d/%m/%Y:%H:%M:%S'
-
-State = Literal['imported'] | Literal['seen']
-
-
-class TransactionData(TypedDict):
-    date: datetime
-    type: str
-    cur: str
-    key: str
-    amount: float
-    category: str
-    name: str
-    state: State | None
+from .bankcsv import CHUNK_SIZE, MONZO, State, TransactionData, chunked, parse
+from .db import transaction
+from .jobs import Job
+from .model import Operation, account_by_id, create_transaction, decode_account_id, dop2, update_payee_index
 
 
 def prepare(data_stream: IO[str]) -> list[TransactionData]:
-    data = csv.DictReader(data_stream)
-    result: list[TransactionData] = []
-    for row in data:
-        amount = float(row['Amount'])
-        dt = datetime.strptime(row['Date'].strip() + ':' + row['Time'].strip(), FMT)
-        key = row['Type'].strip() + ':' + row['Name'].strip()
-        result.append(
-            {
-                'date': dt,
-                'type': row['Type'].strip(),
-                'cur': 'GBP',
-                'key': key,
-                'amount': amount,
-                'category': row['Category'].strip(),
-                'name': row['Name'].strip(),
-                'state': None,
-            }
-        )
-    return result
+    return list(parse(data_stream, MONZO))
 
 
 class ImportTransaction(TypedDict):
@@ -52,20 +21,48 @@ class ImportTransaction(TypedDict):
     desc: str | None
     state: State | None
     txkey: str
+    category: NotRequired[str | None]
+
 
+def import_data(src: str, data: list[ImportTransaction], job: Job | None = None) -> int:
+    """Creates transactions for import rows
 
-def import_data(src: str, data: list[ImportTransaction]) -> None:
+    Without a job any invalid row aborts the import before anything is written,
+    with a job invalid rows are reported as row errors and skipped.
+    """
     transactions: list[tuple[Collection[Operation], datetime, str | None]] = []
-    for it in data:
-        dt = datetime.fromtimestamp(it['date'])
-        dest = it['dest']
-        amount = it['amount']
-        cur = it['cur']
-        ops = dop2(src, dest, -amount, cur)
-        ddest = decode_account_id(dest)[0]
-        _account = account_by_id(ddest)
-        assert _account, f'{ddest} not found'
-        transactions.append((ops, dt, it.get('desc') or it['name'] or None))
+    payees: list[tuple[str | None, str | None, str, int]] = []
+    for idx, it in enumerate(data):
+        try:
+            dt = datetime.fromtimestamp(it['date'])
+            dest = it['dest']
+            amount = it['amount']
+            cur = it['cur']
+            ops = dop2(src, dest, -amount, cur)
+            ddest = decode_account_id(dest)[0]
+            _account = account_by_id(ddest)
+            assert _account, f'{ddest} not found'
+        except Exception as e:
+            if not job:
+                raise
+            job.row_error(idx, str(e) or type(e).__name__)
+            continue
+        desc = it.get('desc') or it['name'] or None
+        transactions.append((ops, dt, desc))
+        # Descriptions of simple transactions are indexed on create, the bank name only when it differs
+        name = it['name'] if it['name'] != desc or len(ops) != 2 else None
+        payees.append((name, it.get('category'), ddest, int(it['date'])))
 
-    for tran in transactions:
-        create_transaction(*tran)
+    done = 0
+    if job:
+        job.progress(done, len(transactions))
+    src_aid = decode_account_id(src)[0]
+    for chunk in chunked(zip(transactions, payees), CHUNK_SIZE):
+        with transaction():
+            for tran, _ in chunk:
+                create_transaction(*tran)
+            update_payee_index(src_aid, (payee for _, payee in chunk))
+        done += len(chunk)
+        if job:
+            job.progress(done)
+    return done
@@ -0,0 +1,85 @@
+import csv
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import IO, Iterable, Iterator, Optional
+
+from wadwise import model as m
+
+DATE_FMT = '%Y-%m-%d'
+
+
+class RateTable:
+    """As-of exchange rates
+
+    Rate is a price of one unit of a currency in some common reference
+    currency, so any two currencies can be crossed.
+    """
+
+    def __init__(self, rows: Iterable[tuple[str, int, float]]):
+        self.dates: dict[str, list[int]] = {}
+        self.rates: dict[str, list[float]] = {}
+        for cur, date, rate in rows:
+            self.dates.setdefault(cur, []).append(date)
+            self.rates.setdefault(cur, []).append(rate)
+
+    def rate(self, cur: str, ts: float) -> Optional[float]:
+        dates = self.dates.get(cur)
+        if not dates:
+            return None
+        idx = bisect_right(dates, ts) - 1
+        if idx < 0:
+            return None
+        return self.rates[cur][idx]
+
+    def cross(self, cur: str, base: str, ts: float) -> Optional[float]:
+        if cur == base:
+            return 1.0
+        rate = self.rate(cur, ts)
+        base_rate = self.rate(base, ts)
+        if rate is None or not base_rate:
+            return None
+        return rate / base_rate
+
+
+@dataclass
+class Converted:
+    base: str
+    values: dict[str, float] = field(default_factory=dict)
+    missing: set[str] = field(default_factory=set)
+
+
+def convert(balances: m.Balance, amap: m.AccountMap, table: RateTable, base: str, ts: float) -> Converted:
+    """Converts self totals of all accounts into base currency and rolls them up the tree
+
+    Each currency rate is resolved once for the whole balance.
+    """
+    curs = {cur for state in balances.values() for cur in state}
+    factors = {cur: table.cross(cur, base, ts) for cur in curs}
+
+    result = Converted(base)
+    result.missing = {cur for cur, f in factors.items() if f is None}
+    values = result.values
+    for aid, state in balances.items():
+        values[aid] = sum(amount.sum * f for cur, amount in state.items() if (f := factors[cur]) is not None)
+
+    accounts = sorted((it for it in amap.values() if it.aid), key=lambda it: -len(it.parents))
+    for it in accounts:
+        value = values.get(it.aid)
+        if value and it.parent:
+            values[it.parent] = values.get(it.parent, 0.0) + value
+
+    return result
+
+
+def parse_csv(data_stream: IO[str], ref: Optional[str] = None) -> Iterator[tuple[str, int, float]]:
+    """Reads cur,date,rate rows, `ref` is added as the reference currency with rate 1"""
+    if ref:
+        yield ref, 0, 1.0
+    for row in csv.DictReader(data_stream):
+        dt = datetime.strptime(row['date'].strip(), DATE_FMT)
+        yield row['cur'].strip().upper(), int(dt.timestamp()), float(row['rate'])
+
+
+def load_csv(data_stream: IO[str], ref: Optional[str] = None) -> int:
+    return m.set_rates(parse_csv(data_stream, ref))
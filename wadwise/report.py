@@ -0,0 +1,41 @@
+from datetime import datetime
+from typing import Iterator, Optional, TypedDict
+
+from wadwise import model as m
+from wadwise import state
+
+
+class Report(TypedDict):
+    by: str
+    periods: list[str]
+    accounts: dict[str, list[m.BState]]
+
+
+def subtree(amap: m.AccountMap, aid: Optional[str]) -> Iterator[str]:
+    for it in amap[aid].children if aid else amap.top:
+        yield it
+        yield from subtree(amap, it)
+
+
+def report(
+    by: str = 'month', start: Optional[datetime] = None, end: Optional[datetime] = None, aid: Optional[str] = None
+) -> Report:
+    """Per-period totals rolled up the account tree
+
+    Accounts without movements in the whole range are omitted.
+    """
+    balances = state.period_balance(by, start, end)
+    periods = list(balances)
+    amap = state.account_map()
+
+    aids = list(subtree(amap, aid))
+    if aid:
+        aids.insert(0, aid)
+
+    accounts: dict[str, list[m.BState]] = {}
+    for it in aids:
+        totals = [balances[p][it].total for p in periods]
+        if any(v for t in totals for v in t.values()):
+            accounts[it] = totals
+
+    return {'by': by, 'periods': periods, 'accounts': accounts}
@@ -2,10 +2,10 @@ import json
 from collections import namedtuple
 from datetime import date, datetime
 from functools import cached_property
-from typing import Optional
+from typing import Iterable, Optional
 
+from wadwise import jsonlib, rates, utils
 from wadwise import model as m
-from wadwise import utils
 
 Option = namedtuple('Option', 'value title hidden')
 Option2 = namedtuple('Option2', 'value title')
@@ -28,21 +28,24 @@ class Env:
         return account_map()
 
     @cached_property
+    def balances(self) -> dict[str, 'BalanceMap']:
+        return month_balances(utils.month_start(self.today))
+
+    @property
     def current(self) -> 'BalanceMap':
-        return current_balance(utils.next_month_start(self.today))
+        return self.balances['current']
 
-    @cached_property
+    @property
     def prev(self) -> 'BalanceMap':
-        return current_balance(utils.month_start(self.today))
+        return self.balances['prev']
 
-    @cached_property
+    @property
     def month(self) -> 'BalanceMap':
-        dt = utils.month_start(self.today)
-        return month_balance(dt)
+        return self.balances['month']
 
     def total(self, aid: str) -> m.BState:
         acc = self.amap[aid]
-        if acc['is_sheet']:
+        if acc.is_sheet:
             return self.current[aid].total
         else:
             return self.month[aid].total
@@ -62,25 +65,38 @@ class Env:
             keys |= self.total(it).keys()
         return sorted(keys, key=Env.cur_sort_key1)
 
+    @cached_property
+    def base_cur(self) -> str:
+        return get_cur_list()[0]
+
+    @cached_property
+    def current_base(self) -> rates.Converted:
+        return base_balance(utils.month_start(self.today), self.base_cur)
+
+    def net_worth(self) -> float:
+        values = self.current_base.values
+        net_types = {m.AccType.ASSET, m.AccType.LIABILITY}
+        return sum(values.get(it, 0.0) for it in self.amap.top if self.amap[it].type in net_types)
+
     @cached_property
     def joint_accounts(self) -> dict[str, m.JointAccount]:
         return m.get_joint_accounts()
 
     def account_title(self, aid: str) -> str:
         aid, typ = m.decode_account_id(aid)
-        return self.amap[aid]['full_name'] + self.special_types[typ]
+        return self.amap[aid].full_name + self.special_types[typ]
 
 
 class AccState:
     def __init__(self, account: m.AccountExt, bmap: 'BalanceMap'):
         self.account = account
-        self.self_total2 = bmap.balances.get(account['aid'], {})
+        self.self_total2 = bmap.balances.get(account.aid, {})
         self.bmap = bmap
 
     @cached_property
     def total2(self) -> m.BState2:
-        if self.account['children']:
-            return m.combine_states(self.self_total2, *(self.bmap[it].total2 for it in self.account['children']))
+        if self.account.children:
+            return m.combine_states(self.self_total2, *(self.bmap[it].total2 for it in self.account.children))
         return self.self_total2
 
     @cached_property
@@ -106,6 +122,10 @@ class BalanceMap:
         self.balances = balances
         self.cache: dict[str, AccState] = {}
 
+    @classmethod
+    def split(cls, balances: dict[str, m.Balance], amap: m.AccountMap) -> dict[str, 'BalanceMap']:
+        return {name: cls(it, amap) for name, it in balances.items()}
+
     def __getitem__(self, key: str) -> AccState:
         try:
             return self.cache[key]
@@ -121,7 +141,7 @@ def account_map() -> m.AccountMap:
 
 
 def get_favs() -> list[str]:
-    return json.loads(m.get_param('accounts.favs') or '[]') or []
+    return jsonlib.loads(m.get_param('accounts.favs') or '[]') or []
 
 
 def set_favs(ids: list[str]) -> None:
@@ -129,7 +149,7 @@ def set_favs(ids: list[str]) -> None:
 
 
 def get_cur_list() -> list[str]:
-    return json.loads(m.get_param('cur_list', '[]')) or [DEFAULT_CUR]
+    return jsonlib.loads(m.get_param('cur_list', '[]')) or [DEFAULT_CUR]
 
 
 def set_cur_list(cur_list: list[str]) -> None:
@@ -147,11 +167,93 @@ def current_balance(dt: Optional[datetime] = None) -> BalanceMap:
     return BalanceMap(m.balance(end=dt.timestamp() if dt else None), account_map())
 
 
+@utils.cached
+def month_balances(dt: datetime) -> dict[str, BalanceMap]:
+    """Balances at the end of dt's month (current), at its start (prev) and of the month itself
+
+    All of them are computed in a single pass over ops.
+    """
+    start = dt.timestamp()
+    end = utils.next_month_start(dt).timestamp()
+    ranges: dict[str, m.Range] = {'current': (None, end), 'prev': (None, start), 'month': (start, end)}
+    return BalanceMap.split(m.multi_balance(ranges), account_map())
+
+
+@utils.cached
+def period_balance(by: str, start: Optional[datetime] = None, end: Optional[datetime] = None) -> dict[str, BalanceMap]:
+    balances = m.period_balance(by, start.timestamp() if start else None, end.timestamp() if end else None)
+    return BalanceMap.split(balances, account_map())
+
+
+def account_transactions(aid: Optional[str], archived: bool = False, subtree: bool = False) -> list[m.TransactionAny]:
+    """Account view transactions with running balance
+
+    Results are shared between requests and must not be mutated.
+    """
+    return _account_transactions(aid, archived, subtree, m.changes_version())
+
+
+@utils.lru_cached(64)
+def _account_transactions(
+    aid: Optional[str], archived: bool, subtree: bool, changes_version: int
+) -> list[m.TransactionAny]:
+    return m.account_transactions(aid=aid, running=True, archived=archived, subtree=subtree)
+
+
+def balance_series(aid: str, step: str, start: datetime, end: datetime) -> m.Series:
+    return _balance_series(aid, step, start, end, m.changes_version())
+
+
+@utils.lru_cached(64)
+def _balance_series(aid: str, step: str, start: datetime, end: datetime, changes_version: int) -> m.Series:
+    return m.balance_series(aid, step, start, end)
+
+
+def rate_table() -> rates.RateTable:
+    return _rate_table(m.rates_version())
+
+
+@utils.cached
+def _rate_table(version: Optional[str]) -> rates.RateTable:
+    return rates.RateTable(m.get_rates())
+
+
+def base_balance(dt: datetime, base: str) -> rates.Converted:
+    """Balance at the end of dt's month converted into base currency"""
+    return _base_balance(dt, base, m.rates_version())
+
+
+@utils.cached
+def _base_balance(dt: datetime, base: str, rates_version: Optional[str]) -> rates.Converted:
+    end = utils.next_month_start(dt)
+    balances = month_balances(utils.month_start(dt))['current'].balances
+    return rates.convert(balances, account_map(), rate_table(), base, end.timestamp() - 1)
+
+
 def accounts_changed() -> None:
     account_map.clear()  # type: ignore[attr-defined]
     transactions_changed()
 
 
-def transactions_changed() -> None:
+def transactions_changed(aids: Optional[Iterable[str]] = None) -> None:
+    """Drops caches depending on transactions
+
+    With `aids` only transaction lists and balance series of these accounts
+    and their parents (sub-account views) are dropped, otherwise all of them.
+    Lists and series are keyed by the change journal version as well, writes
+    of other processes make them miss without a call here.
+    """
+    if aids is None:
+        _account_transactions.clear()  # type: ignore[attr-defined]
+        _balance_series.clear()  # type: ignore[attr-defined]
+    else:
+        amap = account_map()
+        affected = {None, *(p for aid in aids if aid in amap for p in amap[aid].parents), *aids}
+        _account_transactions.discard(lambda aid, *_: aid in affected)  # type: ignore[attr-defined]
+        _balance_series.discard(lambda aid, *_: aid in affected)  # type: ignore[attr-defined]
+
     month_balance.clear()  # type: ignore[attr-defined]
+    month_balances.clear()  # type: ignore[attr-defined]
     current_balance.clear()  # type: ignore[attr-defined]
+    period_balance.clear()  # type: ignore[attr-defined]
+    _base_balance.clear()  # type: ignore[attr-defined]
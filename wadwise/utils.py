@@ -1,41 +1,116 @@
 import logging
+import threading
+from collections import OrderedDict
 from datetime import date as dt_date
 from datetime import datetime, timedelta
 from datetime import time as dt_time
 from functools import wraps
 from typing import Any, Callable, Mapping, ParamSpec, TypeVar
 
+from wadwise import db
+
 K = TypeVar('K')
 V = TypeVar('V')
 R = TypeVar('R', covariant=True)
 P = ParamSpec('P')
 
+CACHED_MAXSIZE = 128
+
 
 def pick_keys(d: Mapping[K, V], *keys: K) -> dict[K, V]:
     return {k: d[k] for k in keys}
 
 
 def cached(fn: Callable[P, R]) -> Callable[P, R]:
-    cache: dict[Any, R] = {}
+    """Memoizes results by positional arguments
+
+    Caches are kept per ledger database, `invalidate` and `clear` only touch
+    the current one. The oldest result is dropped above CACHED_MAXSIZE entries
+    per ledger, arguments may come from requests. `on_hit(args, result)`,
+    when set, is called for every cache hit.
+    """
+    caches: dict[str, dict[Any, R]] = {}
 
     @wraps(fn)
     def inner(*args: P.args, **kwargs: P.kwargs) -> R:
+        cache = caches.setdefault(db.db_path(), {})
         try:
-            return cache[args]
+            result = cache[args]
         except KeyError:
             pass
+        else:
+            if inner.on_hit:  # type: ignore[attr-defined]
+                inner.on_hit(args, result)  # type: ignore[attr-defined]
+            return result
 
         result = cache[args] = fn(*args, **kwargs)
+        if len(cache) > CACHED_MAXSIZE:
+            cache.pop(next(iter(cache)), None)
         return result
 
     def invalidate(*args: P.args, **kwargs: P.kwargs) -> None:
-        cache.pop(args, None)
+        caches.get(db.db_path(), {}).pop(args, None)
+
+    def clear() -> None:
+        caches.pop(db.db_path(), None)
 
     inner.invalidate = invalidate  # type: ignore[attr-defined]
-    inner.clear = cache.clear  # type: ignore[attr-defined]
+    inner.clear = clear  # type: ignore[attr-defined]
+    inner.on_hit = None  # type: ignore[attr-defined]
     return inner
 
 
+def lru_cached(maxsize: int) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    """Like `cached` but keeps at most `maxsize` recently used results per ledger
+
+    Ledgers don't evict each other. `discard(pred)` drops entries which
+    argument tuples match a predicate. `on_hit` is the same as for `cached`.
+    """
+
+    def decorator(fn: Callable[P, R]) -> Callable[P, R]:
+        caches: dict[str, OrderedDict[Any, R]] = {}
+        lock = threading.Lock()
+
+        @wraps(fn)
+        def inner(*args: P.args, **kwargs: P.kwargs) -> R:
+            scope = db.db_path()
+            with lock:
+                cache = caches.setdefault(scope, OrderedDict())
+                hit = args in cache
+                if hit:
+                    cache.move_to_end(args)
+                    result = cache[args]
+            if hit:
+                if inner.on_hit:  # type: ignore[attr-defined]
+                    inner.on_hit(args, result)  # type: ignore[attr-defined]
+                return result
+
+            result = fn(*args, **kwargs)
+            with lock:
+                cache = caches.setdefault(scope, OrderedDict())
+                cache[args] = result
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+
+        def discard(pred: Callable[..., bool]) -> None:
+            with lock:
+                cache = caches.get(db.db_path(), OrderedDict())
+                for key in [it for it in cache if pred(*it)]:
+                    del cache[key]
+
+        def clear() -> None:
+            with lock:
+                caches.pop(db.db_path(), None)
+
+        inner.discard = discard  # type: ignore[attr-defined]
+        inner.clear = clear  # type: ignore[attr-defined]
+        inner.on_hit = None  # type: ignore[attr-defined]
+        return inner
+
+    return decorator
+
+
 def month_start(dt: dt_date) -> datetime:
     return datetime.combine(dt.replace(day=1), dt_time())
 
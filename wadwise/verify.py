@@ -0,0 +1,167 @@
+"""Shadow verification of cached balances and transaction lists
+
+With a non-zero `rate` that fraction of cache hits in `state` is recomputed
+straight from SQL in a background thread and compared with the cached
+value. Mismatches are logged with differing accounts or transactions.
+Samples are skipped when the ledger changed between the hit and the
+recomputation (change journal version moved), those can't be judged.
+"""
+
+import contextvars
+import logging
+import random
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+from wadwise import model as m
+from wadwise import state, utils
+
+log = logging.getLogger(__name__)
+
+MAX_PENDING = 16
+MAX_DETAILS = 10
+EPSILON = 1e-6
+
+rate = 0.0
+stats: Counter[str] = Counter()
+
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='wadwise-verify')
+pending = 0
+lock = threading.Lock()
+
+Check = Callable[[tuple[Any, ...], Any], list[str]]
+
+
+def _ts(dt: Optional[datetime]) -> Optional[float]:
+    return dt.timestamp() if dt else None
+
+
+def diff_balances(cached: dict[str, m.Balance], fresh: dict[str, m.Balance]) -> list[str]:
+    result = []
+    zero = m.Amount2()
+    for name in sorted(cached.keys() | fresh.keys()):
+        c, f = cached.get(name, {}), fresh.get(name, {})
+        for aid in sorted(c.keys() | f.keys()):
+            ca, fa = c.get(aid, {}), f.get(aid, {})
+            for cur in sorted(ca.keys() | fa.keys()):
+                cv, fv = ca.get(cur, zero), fa.get(cur, zero)
+                if abs(cv.credit - fv.credit) > EPSILON or abs(cv.debit - fv.debit) > EPSILON:
+                    result.append(f'{name} {aid} {cur}: cached {cv}, actual {fv}')
+    return result
+
+
+def diff_transactions(cached: list[m.TransactionAny], fresh: list[m.TransactionAny]) -> list[str]:
+    c = {it['tid']: it for it in cached}
+    f = {it['tid']: it for it in fresh}
+    result = []
+    for tid in c.keys() - f.keys():
+        result.append(f'{tid}: stale')
+    for tid in f.keys() - c.keys():
+        result.append(f'{tid}: missing')
+    for tid in c.keys() & f.keys():
+        if c[tid] != f[tid]:
+            result.append(f'{tid}: cached {c[tid]}, actual {f[tid]}')
+    if not result and [it['tid'] for it in cached] != [it['tid'] for it in fresh]:
+        result.append('order differs')
+    return result
+
+
+def check_month_balance(args: tuple[Any, ...], cached: state.BalanceMap) -> list[str]:
+    (dt,) = args
+    fresh = m.balance(dt.timestamp(), utils.next_month_start(dt).timestamp())
+    return diff_balances({'month': cached.balances}, {'month': fresh})
+
+
+def check_current_balance(args: tuple[Any, ...], cached: state.BalanceMap) -> list[str]:
+    fresh = m.balance(end=_ts(args[0] if args else None))
+    return diff_balances({'current': cached.balances}, {'current': fresh})
+
+
+def check_month_balances(args: tuple[Any, ...], cached: dict[str, state.BalanceMap]) -> list[str]:
+    (dt,) = args
+    start = dt.timestamp()
+    end = utils.next_month_start(dt).timestamp()
+    # Plain per-range scans instead of the single-pass multi_balance
+    fresh = {'current': m.balance(end=end), 'prev': m.balance(end=start), 'month': m.balance(start, end)}
+    return diff_balances({k: v.balances for k, v in cached.items()}, fresh)
+
+
+def check_period_balance(args: tuple[Any, ...], cached: dict[str, state.BalanceMap]) -> list[str]:
+    by, start, end = (args + (None, None))[:3]
+    fresh = m.period_balance(by, _ts(start), _ts(end))
+    return diff_balances({k: v.balances for k, v in cached.items()}, fresh)
+
+
+def check_account_transactions(args: tuple[Any, ...], cached: list[m.TransactionAny]) -> list[str]:
+    aid, archived, subtree = (args + (False, False))[:3]
+    fresh = m.account_transactions(aid=aid, running=True, archived=archived, subtree=subtree)
+    return diff_transactions(cached, fresh)
+
+
+checks: dict[Callable[..., Any], Check] = {
+    state.month_balance: check_month_balance,
+    state.current_balance: check_current_balance,
+    state.month_balances: check_month_balances,
+    state.period_balance: check_period_balance,
+    state._account_transactions: check_account_transactions,
+}
+
+
+def run_check(name: str, check: Check, args: tuple[Any, ...], cached: Any, version: int) -> None:
+    global pending
+    try:
+        details = check(args, cached)
+        if m.changes_version() != version:
+            stats['skipped'] += 1
+        elif details:
+            stats['mismatch'] += 1
+            log.error(
+                'Cache mismatch in %s%r, %d differences: %s',
+                name,
+                args,
+                len(details),
+                '; '.join(details[:MAX_DETAILS]),
+            )
+        else:
+            stats['ok'] += 1
+    except Exception:
+        stats['failed'] += 1
+        log.exception('Verification of %s%r failed', name, args)
+    finally:
+        with lock:
+            pending -= 1
+
+
+def sampler(name: str, check: Check) -> Callable[[tuple[Any, ...], Any], None]:
+    def on_hit(args: tuple[Any, ...], cached: Any) -> None:
+        global pending
+        if random.random() >= rate:
+            return
+        with lock:
+            if pending >= MAX_PENDING:
+                stats['dropped'] += 1
+                return
+            pending += 1
+
+        # Version is taken before recomputation, a write in between invalidates the sample
+        version = m.changes_version()
+        ctx = contextvars.copy_context()
+        executor.submit(ctx.run, run_check, name, check, args, cached, version)
+
+    return on_hit
+
+
+def enable(value: float) -> None:
+    """Starts sampling `value` fraction of cache hits, 0 disables verification"""
+    global rate
+    rate = value
+    for fn, check in checks.items():
+        fn.on_hit = sampler(fn.__name__, check) if value else None  # type: ignore[attr-defined]
+
+
+def wait() -> None:
+    """Blocks until all submitted samples are checked"""
+    executor.submit(lambda: None).result()
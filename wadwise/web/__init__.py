@@ -1,16 +1,54 @@
+import contextlib
 import functools
 import json
+import logging
 import os
+import re
+import threading
+import time
 from datetime import date, datetime
 from pathlib import Path
-from typing import Any, TypedDict, cast
+from typing import TYPE_CHECKING, Any, Iterable, Optional, TypedDict, cast
 
 from flask import Flask, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import NotFound
+from werkzeug.wsgi import ClosingIterator
 
+if TYPE_CHECKING:
+    from _typeshed.wsgi import StartResponse, WSGIApplication, WSGIEnvironment
+
+from wadwise import db, jobs, jsonlib, state
 from wadwise import model as m
-from wadwise import state
 
-app = Flask(__name__)
+log = logging.getLogger(__name__)
+
+
+class JSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o: Any) -> Any:
+        if isinstance(o, m.AccountExt):
+            return o.to_json()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        # Pretty output (indent) is only requested in dev mode, leave it to stdlib
+        if kwargs.get('indent'):
+            return super().dumps(obj, **kwargs)
+        if jsonlib.backend == 'json':
+            kwargs.setdefault('separators', (',', ':'))
+            return super().dumps(obj, **kwargs)
+        return jsonlib.dumps(obj, default=self.default, sort_keys=self.sort_keys)
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return jsonlib.loads(s)
+
+
+class App(Flask):
+    json_provider_class = JSONProvider
+
+
+app = App(__name__)
 app.url_map.strict_slashes = False
 app.config.from_mapping(
     SECRET_KEY='boo',
@@ -25,6 +63,124 @@ def init() -> None:
     m.create_initial_accounts()
 
 
+# Directory with ledger databases, <name>.sqlite each. None disables multi-ledger hosting.
+ledgers_dir: Optional[str] = None
+LEDGER_HEADER = 'X-Wadwise-Ledger'
+LEDGER_PREFIX = '/l/'
+LEDGER_NAME = re.compile(r'\w+')
+
+ledgers: set[str] = set()
+ledgers_lock = threading.Lock()
+
+
+def ledger_path(name: str, exists: bool = True) -> Optional[str]:
+    """Database of ledger `name`, None for invalid names and, with `exists`, missing files"""
+    if not ledgers_dir or not LEDGER_NAME.fullmatch(name):
+        return None
+    path = os.path.join(ledgers_dir, name + '.sqlite')
+    if exists and not os.path.exists(path):
+        return None
+    return path
+
+
+def create_ledger(name: str) -> str:
+    """Creates a new ledger database, requests can't, they only reach existing ones"""
+    path = ledger_path(name, exists=False)
+    if not path:
+        raise ValueError(f'Invalid ledger name {name!r} or ledgers directory is not set')
+    if os.path.exists(path):
+        raise ValueError(f'Ledger {name} already exists')
+    open_ledger(path)
+    return path
+
+
+def open_ledger(path: str) -> None:
+    """Migrates ledger tables on first use"""
+    with ledgers_lock:
+        if path in ledgers:
+            return
+        with db.use(path):
+            init()
+        ledgers.add(path)
+
+
+def ledger_paths() -> Iterable[str]:
+    """Default database and all ledgers opened so far"""
+    return [db.DB, *sorted(ledgers)]
+
+
+class LedgerMiddleware:
+    """Selects a ledger by /l/<name>/ URL prefix or X-Wadwise-Ledger header
+
+    The prefix is moved into SCRIPT_NAME, so generated URLs keep pointing
+    to the same ledger. Each ledger has its own connection pool and caches.
+    """
+
+    def __init__(self, wsgi_app: 'WSGIApplication'):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ: 'WSGIEnvironment', start_response: 'StartResponse') -> Iterable[bytes]:
+        name = environ.get('HTTP_' + LEDGER_HEADER.upper().replace('-', '_'))
+        path_info = environ.get('PATH_INFO', '')
+        if path_info.startswith(LEDGER_PREFIX):
+            name, _, rest = path_info[len(LEDGER_PREFIX) :].partition('/')
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + LEDGER_PREFIX + name
+            environ['PATH_INFO'] = '/' + rest
+
+        # Streamed bodies are produced after return, the ledger and its
+        # pooled connection are kept until the body is closed
+        stack = contextlib.ExitStack()
+        if name is not None:
+            path = ledger_path(name)
+            if not path:
+                return NotFound()(environ, start_response)
+            open_ledger(path)
+            stack.enter_context(db.use(path))
+        stack.enter_context(db.pooled())
+        try:
+            return ClosingIterator(self.wsgi_app(environ, start_response), stack.close)
+        except BaseException:
+            stack.close()
+            raise
+
+
+app.wsgi_app = LedgerMiddleware(app.wsgi_app)  # type: ignore[method-assign]
+
+
+last_request = time.monotonic()
+
+
+@app.before_request
+def track_activity() -> None:
+    global last_request
+    last_request = time.monotonic()
+
+
+def maintain_job(job: jobs.Job) -> None:
+    m.compact_changes()
+    result = db.maintain()
+    log.info('Maintenance of %s done: %s', db.db_path(), result)
+
+
+def start_idle_maintenance(idle: float, interval: float = 86400) -> threading.Thread:
+    """Queues `db.maintain` of every ledger after `idle` seconds without requests, at most once per `interval`"""
+
+    def loop() -> None:
+        last_run = 0.0
+        while True:
+            time.sleep(min(idle, 60))
+            now = time.monotonic()
+            if now - last_request >= idle and (not last_run or now - last_run >= interval):
+                last_run = now
+                for path in ledger_paths():
+                    with db.use(path):
+                        jobs.submit('maintain', maintain_job).wait()
+
+    thread = threading.Thread(target=loop, name='wadwise-maintain', daemon=True)
+    thread.start()
+    return thread
+
+
 class RequestState(TypedDict):
     env: state.Env
     today: date
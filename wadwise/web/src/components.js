@@ -85,6 +85,40 @@ export const nav = hh.div['flex bg-base-200 shadow-sm/20 rounded-box items-cente
 export const delim = hh.span.delim()
 export const curSpan = hh.span['text-xs font-mono text-slate-500']
 
+function dropJobParam() {
+    const params = new URLSearchParams(window.location.search)
+    params.delete('job')
+    window.location.search = params
+}
+
+export function JobProgress({ job, title, onDone = dropJobParam }) {
+    const st = useSignal(null)
+
+    useEffect(() => {
+        const source = new EventSource(job.events)
+        source.onmessage = (e) => {
+            st.value = JSON.parse(e.data)
+            if (st.value.status == 'done' || st.value.status == 'failed') {
+                source.close()
+                if (st.value.status == 'done' && !st.value.errors.length) {
+                    onDone(st.value)
+                }
+            }
+        }
+        return () => source.close()
+    }, [])
+
+    const it = st.value
+    return hh.div['bg-sky-100 p-2 rounded-box text-sm shadow-sm/20 text-slate-800'](
+        !it && `${title} queued`,
+        it && [
+            it.status == 'failed' ? `${title} failed: ${it.error}` : `${title} ${it.status}`,
+            it.total > 0 && `: ${it.done} / ${it.total}`,
+            it.errors.map((err) => hh.div(`Row ${err.row + 1}: ${err.error}`)),
+        ],
+    )
+}
+
 if (import.meta.hot) {
     import.meta.hot.invalidate()
 }
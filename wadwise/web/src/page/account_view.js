@@ -4,7 +4,7 @@ import { useSignal } from '@preact/signals'
 
 import { preventDefault, urlqs, join } from '../utils.js'
 import { hh as h, nbsp } from '../html.js'
-import { input, card, delim, curSpan, vstack, vcard, nav } from '../components.js'
+import { input, card, delim, curSpan, vstack, vcard, nav, JobProgress } from '../components.js'
 import * as icons from '../icons.js'
 
 const { div, span, ul, li, a, nobr, form } = h
@@ -109,6 +109,18 @@ function AccountStatus({ account, balance, accCur }) {
     }
 }
 
+function NetWorth({ netWorth }) {
+    const { value, cur, missing } = netWorth
+    return card(
+        div['grid grid-cols-2 w-full'](
+            'Net worth',
+            div['col-2 justify-self-end'](fmtNumber(value), nbsp, curSpan(cur)),
+            missing.length > 0 &&
+                div['col-span-full text-xs text-slate-500']('No rates for ', missing.join(', ')),
+        ),
+    )
+}
+
 function SubAccounts({ accCur, accounts, accounts_totals, urls, today_str }) {
     return vcard['gap-2'](
         accounts.map((it) =>
@@ -122,29 +134,50 @@ function SubAccounts({ accCur, accounts, accounts_totals, urls, today_str }) {
     )
 }
 
-function AccountLinks({ account, urls, jointAccounts }) {
+function SubtreeLink({ account, urls, subtree }) {
+    return li(
+        a(
+            { href: urlqs(urls.account_view, { aid: account.aid, subtree: subtree ? 0 : 1 }) },
+            subtree ? 'Exclude sub-accounts' : 'Include sub-accounts',
+        ),
+    )
+}
+
+function AccountLinks({ account, urls, jointAccounts, importProfiles }) {
     const jaid = account.aid + '.joint'
 
-    function handleImport(e, aid) {
+    function handleImport(e, aid, profile) {
         e.preventDefault()
         window.formImportData.src.value = aid
+        window.formImportData.profile.value = profile
         window.formImportData.monzo.click()
     }
 
+    function importLinks(aid, title) {
+        return importProfiles.map((profile, idx) =>
+            li(
+                a(
+                    { href: '#import', onClick: (e) => handleImport(e, aid, profile) },
+                    idx ? `${title} (${profile})` : title,
+                ),
+            ),
+        )
+    }
+
     return [
         li(div['h-0']()),
         li(a({ href: urlqs(urls.transaction_edit, { dest: account.aid }) }, 'Add transaction')),
         li(a({ href: urlqs(urls.transaction_edit, { dest: account.aid, split: 1 }) }, 'Add Split')),
         account.aid in jointAccounts &&
             li(a({ href: urlqs(urls.transaction_edit, { dest: jaid }) }, 'Add Joint')),
+        li(a({ href: urlqs(urls.account_view, { aid: account.aid, archived: 1 }) }, 'Archive')),
         li(div['h-0']()),
-        li(a({ href: '#import', onClick: (e) => handleImport(e, account.aid) }, 'Import')),
-        account.aid in jointAccounts &&
-            li(a({ href: '#import', onClick: (e) => handleImport(e, jaid) }, 'Import Joint')),
+        importLinks(account.aid, 'Import'),
+        account.aid in jointAccounts && importLinks(jaid, 'Import Joint'),
     ]
 }
 
-function TransactionList({ account, transactions, amap, urls }) {
+function TransactionList({ account, transactions, amap, urls, archived }) {
     const ispos = 'qa'.includes(account.type)
 
     function fmtAmount(acc, amnt) {
@@ -170,7 +203,9 @@ function TransactionList({ account, transactions, amap, urls }) {
 
     function gotoTransaction(e) {
         const target = e.target.closest('[data-href]')
-        window.location.href = target.dataset.href
+        if (target) {
+            window.location.href = target.dataset.href
+        }
     }
 
     function TransactionBody(it) {
@@ -194,15 +229,24 @@ function TransactionList({ account, transactions, amap, urls }) {
     }
 
     function Transaction(it) {
-        const turl = urlqs(urls.transaction_edit, { tid: it.tid, dest: account.aid })
+        const turl = !archived && urlqs(urls.transaction_edit, { tid: it.tid, dest: account.aid })
         return card['grid grid-cols-2'](
-            { id: 't-' + it.tid, onClick: gotoTransaction, 'data-href': turl },
+            { id: 't-' + it.tid, onClick: gotoTransaction, 'data-href': turl || undefined },
             it.desc &&
                 div['col-span-full'](
                     { class: { 'border-b-1 border-gray-300': it.split && !it.meta?.type } },
                     it.desc,
                 ),
             TransactionBody(it),
+            it.balance &&
+                div['col-span-full justify-self-end text-xs text-slate-500'](
+                    join(
+                        nbsp,
+                        Object.entries(it.balance).map(([cur, value]) =>
+                            nobr(fmtNumber(value), nbsp, curSpan(cur)),
+                        ),
+                    ),
+                ),
         )
     }
 
@@ -242,6 +286,7 @@ export function AccountView(config) {
             form['#formImportData.hidden [method=POST]'](
                 { action: urls.import_monzo, enctype: 'multipart/form-data' },
                 input.text({ name: 'src' }),
+                input.text({ name: 'profile' }),
                 input.file({
                     name: 'monzo',
                     accept: '.csv',
@@ -258,6 +303,7 @@ export function AccountView(config) {
                         ](
                             account && li(a({ href: urls.account_view }, 'Home')),
                             li(a({ href: urls.settings }, 'Settings')),
+                            account && !!accounts.length && h(SubtreeLink, config),
                             account && !account.is_placeholder && h(AccountLinks, config),
                         ),
                     ),
@@ -265,7 +311,9 @@ export function AccountView(config) {
                 !account && div['flex-1'](span['text-sm font-medium']('Home')),
                 account && h(AccountHeader, config),
             ),
+            config.job && h(JobProgress, { job: config.job, title: 'Import' }),
             account && [h(Toast, config), h(AccountStatus, config)],
+            !account && config.netWorth && h(NetWorth, config),
             !!accounts.length && h(SubAccounts, config),
             account && h(AccountBody, config),
         ),
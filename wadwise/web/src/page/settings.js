@@ -3,11 +3,11 @@ import { signal, computed, batch } from '@preact/signals'
 
 import { deleteIdxSignal, idify, fieldModel, pushSignal } from '../utils.js'
 import { hh as h } from '../html.js'
-import { button, submit, vstack, input, card, textarea, nav } from '../components.js'
+import { button, submit, vstack, input, card, textarea, nav, JobProgress } from '../components.js'
 import * as icons from '../icons.js'
 import { AccountSelector } from '../account_selector.js'
 
-const { div, form, a } = h
+const { div, span, form, a } = h
 const header = h.h2['text-lg font-medium mb-1']
 
 function wrapItem(item) {
@@ -150,11 +150,34 @@ function FavsForm({ favAccounts }) {
     ]
 }
 
+function fmtSize(size) {
+    return size > 1 << 20 ? `${(size / (1 << 20)).toFixed(1)} MB` : `${Math.ceil(size / 1024)} KB`
+}
+
+function BackupForm({ backups, job }) {
+    return [
+        header('Backup'),
+        vstack['gap-2'](
+            job && h(JobProgress, { job, title: 'Backup' }),
+            form({ method: 'POST', action: './backup' }, submit.primary('Backup database')),
+            backups.map((it) =>
+                div['flex justify-between text-sm'](
+                    a['link']({ href: it.url }, it.name),
+                    span['text-slate-500'](fmtSize(it.size)),
+                ),
+            ),
+        ),
+    ]
+}
+
 function Settings(config) {
-    const { curList } = config
+    const { curList, customProfiles, urls } = config
     return [
         vstack['gap-2'](
-            nav['p-2'](a['font-medium text-sm']({ href: '/account' }, 'Home'), div['h-4 m-2'](' ')),
+            nav['p-2'](
+                a['font-medium text-sm']({ href: urls.account_view }, 'Home'),
+                div['h-4 m-2'](' '),
+            ),
             card(h(FavsForm, config)),
             card(h(JointForm, config)),
             card(
@@ -171,9 +194,19 @@ function Settings(config) {
                 ),
             ),
             card(
-                header('Backup'),
-                form({ method: 'POST', action: './backup' }, submit.primary('Share database')),
+                header('Import profiles'),
+                form(
+                    { method: 'POST', action: './import-profiles' },
+                    vstack['gap-2'](
+                        textarea['w-full field-sizing-content font-mono text-sm']({
+                            name: 'data',
+                            defaultValue: JSON.stringify(customProfiles, null, 2),
+                        }),
+                        div(submit.primary('Save')),
+                    ),
+                ),
             ),
+            card(h(BackupForm, config)),
         ),
     ]
 }
@@ -85,7 +85,7 @@ function SrcDest({ form, accountTitle, curList, isError, favAccounts, urls }) {
         if (mode.value == 'target') {
             const form = window.transactionEdit
             const resp = await fetch(
-                urlqs('/api/balance', { date: form.date.value, aid: src.value }),
+                urlqs(urls.api_balance, { date: form.date.value, aid: src.value }),
             )
             const balance = (await resp.json()).result[cur.value] || 0
             current.value = balance
@@ -1,17 +1,20 @@
 import io
 import json
+import os
+import shutil
 import subprocess
+import tempfile
 from datetime import date as ddate
 from datetime import datetime, timedelta
 from itertools import groupby
-from typing import TYPE_CHECKING, Any, Callable, Iterable, Optional, TypedDict, Union, cast
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, Optional, TypedDict, Union, cast
 
 from covador import Date, DateTime, enum, opt
 from covador.flask import form, query_string
-from flask import abort, flash, jsonify, redirect, render_template, request, url_for
+from flask import abort, flash, jsonify, redirect, render_template, request, send_from_directory, url_for
 from werkzeug.wrappers import Response
 
-from wadwise import db, monzo, state, utils
+from wadwise import audit, bankcsv, db, jobs, monzo, report, state, utils
 from wadwise import model as m
 from wadwise.web import app, get_request_state
 
@@ -52,23 +55,25 @@ def render_entrypoint(module: str, data: dict[str, Any]) -> str:
                 'account_edit': url_for('account_edit'),
                 'account_delete': url_for('account_delete'),
                 'transaction_edit': url_for('transaction_edit'),
+                'api_balance': url_for('api_account_balance'),
                 'import_monzo': url_for('import_monzo'),
                 'import_transactions_apply': url_for('import_transactions_apply'),
             },
+            'importProfiles': list(bankcsv.get_profiles()),
         }
     )
     return render_template('app.html', module='src/page/' + module, data=data)
 
 
 @app.route('/account')
-@query_string(aid=opt(str))
-def account_view(aid: Optional[str]) -> str:
+@query_string(aid=opt(str), archived=opt(bool, False), subtree=opt(bool, False), job=opt(str))
+def account_view(aid: Optional[str], archived: bool, subtree: bool, job: Optional[str]) -> str:
     if aid:
         account = state.account_map()[aid]
     else:
         account = None
     accounts = m.get_sub_accounts(aid)
-    data = m.account_transactions(aid=aid)
+    data = state.account_transactions(aid, archived, subtree)
 
     now = datetime.now()
 
@@ -82,17 +87,24 @@ def account_view(aid: Optional[str]) -> str:
 
     cur_list = {}
     balance = {}
+    net_worth = None
     if account:
-        cur_list['total'] = env.sorted_curs(env.total(account['aid']))
-        balance['current_total'] = env.current[account['aid']].total
-        balance['month_total'] = env.month[account['aid']].total
-        if account['is_sheet']:
-            balance['month_debit'] = mdeb = env.month[account['aid']].debit
-            balance['month_credit'] = mcred = env.month[account['aid']].credit
-            balance['prev_total'] = prev_tot = env.prev[account['aid']].total
+        cur_list['total'] = env.sorted_curs(env.total(account.aid))
+        balance['current_total'] = env.current[account.aid].total
+        balance['month_total'] = env.month[account.aid].total
+        if account.is_sheet:
+            balance['month_debit'] = mdeb = env.month[account.aid].debit
+            balance['month_credit'] = mcred = env.month[account.aid].credit
+            balance['prev_total'] = prev_tot = env.prev[account.aid].total
             cur_list['full'] = env.sorted_curs(prev_tot, mdeb, mcred)
     else:
         cur_list['total'] = env.top_sorted_curs()
+        if state.rate_table().dates:
+            net_worth = {
+                'value': env.net_worth(),
+                'cur': env.base_cur,
+                'missing': sorted(env.current_base.missing),
+            }
 
     view_data = {
         'accCur': cur_list,
@@ -102,6 +114,10 @@ def account_view(aid: Optional[str]) -> str:
         'today_str': st['today_str'],
         'today_dsp': st['today'].strftime('%b %Y'),
         'balance': balance,
+        'netWorth': net_worth,
+        'archived': archived,
+        'subtree': subtree,
+        'job': job and jobs.get(job) and {'id': job, 'events': url_for('api_job_events', jid=job)},
         'transactions': transactions,
     }
 
@@ -162,7 +178,15 @@ def account_delete(aid: str) -> Response:
 def transaction_edit(dest: str, tid: Optional[str], split: bool) -> str:
     assert tid or dest
     if tid:
-        (trn,) = m.account_transactions(aid=dest, tid=tid)
+        trns = m.account_transactions(aid=dest, tid=tid)
+        if not trns:
+            # Sub-account views link with the viewed parent, edit from the sub-account holding the op
+            op_aids = {op[0] for it in m.account_transactions(tid=tid) for op in it['ops']}
+            dest = next((it for it in m.account_subtree(dest) if it in op_aids), dest)
+            trns = m.account_transactions(aid=dest, tid=tid)
+        if not trns:
+            return abort(404)
+        (trn,) = trns
         form = cast(dict[str, Any], trn)
         if meta := trn.get('meta'):
             form['split'] = False
@@ -219,28 +243,30 @@ def transaction_save_helper(
     desc: Optional[str],
     meta: dict[str, Any] | None,
 ) -> Response:
+    ops = list(ops)
     if action == 'delete':
         assert tid
-        m.delete_transaction(tid)
+        aids = m.delete_transaction(tid)
     else:
         if action == 'copy-now':
             date = datetime.now()
         if tid and action not in ('copy', 'copy-now'):
-            m.update_transaction(tid, ops, date, desc, meta)
+            aids = m.update_transaction(tid, ops, date, desc, meta)
         else:
             tid = m.create_transaction(ops, date, desc, meta)
+            aids = {op['aid'] for op in ops}
 
-    state.transactions_changed()
+    state.transactions_changed(aids)
 
     amap = state.account_map()
     cbal = state.current_balance()
     flashed: set[str] = set()
     for op in ops:
         aid = op['aid']
-        if aid != dest and amap[aid]['is_sheet'] and aid not in flashed:
+        if aid != dest and amap[aid].is_sheet and aid not in flashed:
             aurl = url_for('account_view', aid=aid)
             flash(
-                f"""<a href="{aurl}">{amap[aid]['full_name']}</a>: {cbal[aid].total.get(op['cur'], 0):.2f} {op['cur']}"""
+                f"""<a href="{aurl}">{amap[aid].full_name}</a>: {cbal[aid].total.get(op['cur'], 0):.2f} {op['cur']}"""
             )
             flashed.add(aid)
 
@@ -259,56 +285,59 @@ def import_data() -> str:
 
 @app.route('/import/', methods=['POST'])
 def import_data_apply() -> Response:
-    if 'gnucash' in request.files:
-        from wadwise import gnucash
+    if 'gnucash' not in request.files:
+        return redirect(url_for('account_view'))
 
-        gnucash.import_data(request.files['gnucash'])  # type: ignore[attr-defined]
+    # Uploaded stream is closed after the request, job works on a copy
+    fd, fname = tempfile.mkstemp(suffix='.gnucash')
+    with os.fdopen(fd, 'wb') as f:
+        request.files['gnucash'].save(f)
+    job = jobs.submit('import-gnucash', import_gnucash_job, fname)
+    return redirect(url_for('account_view', job=job.id))
 
-    state.accounts_changed()
-    state.transactions_changed()
-    return redirect(url_for('account_view'))
+
+def import_gnucash_job(job: jobs.Job, fname: str) -> None:
+    from wadwise import gnucash
+
+    try:
+        gnucash.import_data(fname, job)  # type: ignore[attr-defined]
+    finally:
+        os.remove(fname)
+        state.accounts_changed()
 
 
 @app.route('/import/monzo', methods=['POST'])
-@form(src=str)
-def import_monzo(src: str) -> str:
-    if 'monzo' in request.files:
-        data = monzo.prepare(io.StringIO(request.files['monzo'].read().decode()))
+@form(src=str, profile=opt(str, bankcsv.MONZO['name']))
+def import_monzo(src: str, profile: str) -> str:
+    if 'monzo' not in request.files:
+        abort(400)
 
-    src_aid = m.decode_account_id(src)[0]
-    data.sort(reverse=True, key=lambda x: x['date'])
-    max_dt = data[0]['date']
-    min_dt = data[-1]['date']
+    iprofile = bankcsv.get_profiles().get(profile)
+    if not iprofile:
+        abort(404)
 
-    def get_amount(tr: m.TransactionAny) -> tuple[float, str]:
-        for aid, amount, cur, _ in tr['ops']:
-            if aid in src_aids:
-                return (amount, cur)
-        raise RuntimeError('Never')
+    stream = io.TextIOWrapper(request.files['monzo'].stream, encoding='utf-8-sig')
+    rows: Iterable[bankcsv.TransactionData] = bankcsv.parse(stream, iprofile)
 
+    src_aid = m.decode_account_id(src)[0]
     joints = m.get_joint_accounts()
     src_joint = joints.get(src_aid)
     if src_joint:
-        src_aids = set(src_joint['joints'])
-        data = [it for it in data if it['amount'] > 0]
-        existing = m.account_transactions(
-            aids=src_joint['joints'], start_date=min_dt, end_date=max_dt + timedelta(seconds=1)
-        )
+        src_aids = src_joint['joints']
+        rows = (it for it in rows if it['amount'] > 0)
     else:
-        src_aids = {src_aid}
-        existing = m.account_transactions(aid=src_aid, start_date=min_dt, end_date=max_dt + timedelta(seconds=1))
+        src_aids = [src_aid]
 
-    existing_keys = set(m.seen_tx_key(it['date'], *get_amount(it)) for it in existing)
-    seen_keys = m.seen_transactions(src_aid)
+    data = list(bankcsv.mark_known(rows, src_aid, src_aids))
+    if not data:
+        abort(400)
+    bankcsv.suggest_dest(data, src_aid)
+
+    data.sort(reverse=True, key=lambda x: x['date'])
+    max_dt = data[0]['date']
 
     for it in data:
         dt = it['date']
-        key = m.seen_tx_key(dt, it['amount'], it['cur'])
-        it['txkey'] = key  # type: ignore[typeddict-unknown-key]
-        if key in existing_keys:
-            it['state'] = 'imported'
-        elif key in seen_keys:
-            it['state'] = 'seen'
         it['date'] = dt.timestamp()  # type: ignore[typeddict-item]
         it['date_str'] = dt.strftime('%Y-%m-%d')  # type: ignore[typeddict-unknown-key]
 
@@ -333,14 +362,35 @@ def import_transactions_apply(src: str, transactions: list[monzo.ImportTransacti
     if seen_keys:
         m.update_seen_transactions(aid, datetime.fromtimestamp(transactions[0]['date']), seen_keys)
     transactions_to_import = [it for it in transactions if not it['state']]
-    monzo.import_data(src, transactions_to_import)
-    state.transactions_changed()
-    return redirect(url_for('account_view', aid=aid))
+    job = jobs.submit('import-transactions', import_transactions_job, src, transactions_to_import)
+    return redirect(url_for('account_view', aid=aid, job=job.id))
+
+
+def import_transactions_job(job: jobs.Job, src: str, transactions: list[monzo.ImportTransaction]) -> None:
+    try:
+        monzo.import_data(src, transactions, job)
+    finally:
+        state.transactions_changed()
 
 
 @app.route('/settings/')
-def settings() -> str:
-    return render_entrypoint('settings.js', {})
+@query_string(job=opt(str))
+def settings(job: Optional[str]) -> str:
+    profiles = [it for it in bankcsv.get_profiles().values() if it is not bankcsv.MONZO]
+    backups = [
+        {
+            'name': it,
+            'size': os.path.getsize(os.path.join(db.backup_dir(), it)),
+            'url': url_for('backup_download', name=it),
+        }
+        for it in db.backup_list()
+    ]
+    view_data = {
+        'customProfiles': profiles,
+        'backups': backups,
+        'job': job and jobs.get(job) and {'id': job, 'events': url_for('api_job_events', jid=job)},
+    }
+    return render_entrypoint('settings.js', view_data)
 
 
 @app.route('/settings/favs', methods=['POST'])
@@ -357,6 +407,13 @@ def join_accounts_edit_apply(data: list[object]) -> Response:
     return redirect(url_for('settings'))
 
 
+@app.route('/settings/import-profiles', methods=['POST'])
+@form(data=json.loads)
+def import_profiles_edit_apply(data: list[bankcsv.Profile]) -> Response:
+    bankcsv.set_profiles(data)
+    return redirect(url_for('settings'))
+
+
 @app.route('/settings/cur-list', methods=['POST'])
 @form(cur_list=str)
 def cur_list_edit_apply(cur_list: str) -> Response:
@@ -367,9 +424,21 @@ def cur_list_edit_apply(cur_list: str) -> Response:
 
 @app.route('/settings/backup', methods=['POST'])
 def backup_db() -> Response:
-    fname = db.backup()
-    subprocess.run(['termux-open', '--send', fname], check=True)
-    return redirect(url_for('settings'))
+    job = jobs.submit('backup', backup_job)
+    return redirect(url_for('settings', job=job.id))
+
+
+def backup_job(job: jobs.Job) -> None:
+    fname = db.backup(lambda status, remaining, total: job.progress(total - remaining, total))
+    if shutil.which('termux-open'):
+        subprocess.run(['termux-open', '--send', fname], check=True)
+
+
+@app.route('/settings/backup/<name>')
+def backup_download(name: str) -> Response:
+    if name not in db.backup_list():
+        abort(404)
+    return send_from_directory(db.backup_dir(), name, as_attachment=True)
 
 
 @app.route('/api/balance')
@@ -377,3 +446,65 @@ def backup_db() -> Response:
 def api_account_balance(aid: str, date: ddate) -> Response:
     aid = m.decode_account_id(aid)[0]
     return jsonify({'result': state.current_balance(utils.next_month_start(date))[aid].total})
+
+
+@app.route('/api/balance/series')
+@query_string(
+    aid=str,
+    step=opt(str, 'day') | enum(*m.SERIES_STEPS),
+    start=opt(str | datetime_trunc_t, src='from'),
+    end=opt(str | datetime_trunc_t, src='to'),
+)
+def api_balance_series(aid: str, step: str, start: Optional[datetime], end: Optional[datetime]) -> Response:
+    """Columnar balance series of account subtree, `to` date is inclusive, defaults to a year up to today"""
+    end = (end or datetime.combine(ddate.today(), datetime.min.time())) + timedelta(days=1)
+    start = start or end - timedelta(days=365)
+    aid = m.decode_account_id(aid)[0]
+    return jsonify({'result': state.balance_series(aid, step, start, end)})
+
+
+@app.route('/api/report')
+@query_string(
+    by=opt(str, 'month') | enum(*m.PERIODS),
+    start=opt(str | datetime_trunc_t),
+    end=opt(str | datetime_trunc_t),
+    aid=opt(str),
+)
+def api_report(by: str, start: Optional[datetime], end: Optional[datetime], aid: Optional[str]) -> Response:
+    return jsonify({'result': report.report(by, start, end, aid and m.decode_account_id(aid)[0])})
+
+
+@app.route('/api/changes')
+@query_string(since=opt(int, 0))
+def api_changes(since: int) -> Response:
+    return jsonify({'result': m.changes_since(since)})
+
+
+@app.route('/api/audit')
+def api_audit() -> Response:
+    return jsonify({'result': audit.audit()})
+
+
+@app.route('/api/jobs/<jid>')
+def api_job(jid: str) -> Response:
+    job = jobs.get(jid)
+    if not job:
+        abort(404)
+    return jsonify({'result': job.state()})
+
+
+@app.route('/api/jobs/<jid>/events')
+def api_job_events(jid: str) -> Response:
+    job = jobs.get(jid)
+    if not job:
+        abort(404)
+
+    def events() -> Iterator[str]:
+        version = -1
+        while True:
+            version = job.wait_change(version, 15)
+            yield f'data: {json.dumps(job.state())}\n\n'
+            if job.finished:
+                break
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})